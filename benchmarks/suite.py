@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""Measure what tikibar costs, end to end and for its hottest code paths.
+
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --output new.json --compare results.json
+
+The end-to-end benchmarks request the testproject's benchmark views (N
+queries, nested templates, heavy logging) through the Django test client,
+with tikibar absent, installed but inactive, active, and active with the
+stack sampler. The micro benchmarks time the database wrapper with the
+tikibar on and off, write_metrics, the sampler's signal handler, rendering the tikibar view
+and an inactive span with and without a request, and importing tikibar's modules is timed in fresh
+interpreters. Results are written as JSON, and --compare prints the change
+from an earlier run.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'testproject'))
+
+from django.conf import settings  # noqa: E402
+
+TIKIBAR_MIDDLEWARE = [
+    'tikibar.middleware.SetCorrelationIDMiddleware',
+    'tikibar.middleware.TikibarMiddleware',
+]
+DJANGO_TEMPLATES = 'django.template.backends.django.DjangoTemplates'
+TIKIBAR_TEMPLATES = 'tikibar.template_backend.TikibarDjangoTemplates'
+
+settings.configure(
+    DEBUG=True,
+    SECRET_KEY='benchmark',
+    ALLOWED_HOSTS=['*'],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'events', 'tikibar'],
+    ROOT_URLCONF='events.urls',
+    MIDDLEWARE=[],
+    TEMPLATES=[{'BACKEND': DJANGO_TEMPLATES, 'APP_DIRS': True}],
+    TIKIBAR_SETTINGS={'blacklist': []},
+    ENABLE_TIKIBAR=True,
+    LOGGING_CONFIG=None,
+)
+
+import django  # noqa: E402
+django.setup()
+
+from django.core.signing import get_cookie_signer  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client, RequestFactory, override_settings  # noqa: E402
+
+import tikibar  # noqa: E402
+from tikibar import views  # noqa: E402
+from tikibar.middleware import (  # noqa: E402
+    TikibarDatabaseWrapper, clear_current_request, set_current_request,
+)
+from tikibar.sampler import Sampler  # noqa: E402
+from tikibar.tiki_logger import TikiLogHandler  # noqa: E402
+from tikibar.toolbar_metrics import ToolbarMetricsContainer  # noqa: E402
+from tikibar.utils import TIKI_COOKIE, TIKI_SALT_HTTPS, TIKIBAR_VIEW_COOKIE_NAME  # noqa: E402
+
+VIEWS = ['/queries/', '/templates/', '/logging/']
+
+# name -> (tikibar installed, tikibar turned on, TIKIBAR_SETTINGS)
+CONFIGURATIONS = [
+    ('absent', False, False, {}),
+    ('inactive', True, False, {}),
+    ('active', True, True, {}),
+    ('active_profiler', True, True, {'enable_profiler': True, 'profile_interval': 0.001}),
+]
+
+TOKEN = 'benchmark'
+
+
+def set_tikibar_cookies(client_or_request):
+    cookies = {
+        TIKI_COOKIE: get_cookie_signer(salt=TIKI_COOKIE).sign(TOKEN),
+        TIKIBAR_VIEW_COOKIE_NAME: get_cookie_signer(
+            salt=TIKIBAR_VIEW_COOKIE_NAME + TIKI_SALT_HTTPS
+        ).sign(TOKEN),
+    }
+    for name, value in cookies.items():
+        if isinstance(client_or_request, Client):
+            client_or_request.cookies[name] = value
+        else:
+            client_or_request.COOKIES[name] = value
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        'requests': len(durations),
+        'mean_ms': statistics.mean(durations) * 1000,
+        'p50_ms': durations[len(durations) // 2] * 1000,
+        'p95_ms': durations[int(len(durations) * 0.95)] * 1000,
+        'requests_per_second': len(durations) / sum(durations),
+    }
+
+
+def run_end_to_end(requests, n):
+    results = {}
+    event_logger = logging.getLogger('events')
+    event_logger.setLevel(logging.INFO)
+    event_logger.propagate = False
+    for name, installed, active, tikibar_settings in CONFIGURATIONS:
+        handler = TikiLogHandler() if installed else logging.NullHandler()
+        event_logger.handlers = [handler]
+        with override_settings(
+            MIDDLEWARE=TIKIBAR_MIDDLEWARE if installed else [],
+            TEMPLATES=[{
+                'BACKEND': TIKIBAR_TEMPLATES if installed else DJANGO_TEMPLATES,
+                'APP_DIRS': True,
+            }],
+            TIKIBAR_SETTINGS=dict({'blacklist': []}, **tikibar_settings),
+        ):
+            client = Client()
+            if active:
+                set_tikibar_cookies(client)
+            results[name] = {}
+            for path in VIEWS:
+                for i in range(max(requests // 10, 1)):
+                    client.get(path, {'n': n})
+                durations = []
+                for i in range(requests):
+                    start = time.perf_counter()
+                    client.get(path, {'n': n})
+                    durations.append(time.perf_counter() - start)
+                results[name][path] = summarize(durations)
+    return results
+
+
+def time_per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e9
+
+
+def active_request():
+    request = RequestFactory().get('/')
+    request.correlation_id = 'benchmark'
+    request.toolbar_metrics = ToolbarMetricsContainer('benchmark')
+    set_current_request(request)
+    return request
+
+
+def populated_toolbar(n):
+    toolbar = ToolbarMetricsContainer('benchmark')
+    now = time.time()
+    for i in range(n):
+        toolbar.add_sql_query_metric('default', 'SELECT * FROM t WHERE id = %s', now, now + 0.001, params=[i])
+        toolbar.add_log_record(logging.LogRecord('events', logging.INFO, __file__, 1, 'line %d', (i,), None))
+    toolbar.add_singular_metric('total_time', {'d': [now, now + 0.1]})
+    toolbar.add_singular_metric('user_cpu', {'d': [0, 0.05]})
+    toolbar.add_singular_metric('system_cpu', {'d': [0, 0.01]})
+    toolbar.add_singular_metric('rss_growth', 0)
+    toolbar.add_singular_metric('release', 'benchmark')
+    toolbar.add_singular_metric('request_path', '/')
+    return toolbar
+
+
+def run_micro(n):
+    results = {}
+
+    active_request()
+    wrapper = TikibarDatabaseWrapper()
+    context = {'connection': connection}
+
+    def execute(sql, params, many, context):
+        return None
+
+    results['database_wrapper'] = time_per_call(
+        lambda: wrapper(execute, 'SELECT %s', [1], False, context), 10000,
+    )
+
+    def write_metrics():
+        populated_toolbar(n).write_metrics()
+
+    results['write_metrics'] = time_per_call(write_metrics, 100)
+
+    sampler = Sampler()
+    frame = sys._getframe()
+    # Only the handler is timed, so re-arming the timer isn't wanted
+    sampler.interval = 0
+    results['sampler_sample'] = time_per_call(lambda: sampler._sample(None, frame), 10000)
+
+    toolbar = populated_toolbar(n)
+    toolbar.write_metrics()
+    request = RequestFactory().get('/tikibar/', {'correlation_id': 'benchmark', 'render': 1})
+    set_tikibar_cookies(request)
+    results['tikibar_view_render'] = time_per_call(lambda: views.tikibar(request), 20)
+
+    def inactive_span():
+        with tikibar.span('section'):
+            pass
+
+    clear_current_request()
+    results['span_no_request'] = time_per_call(inactive_span, 100000)
+    # A request that doesn't have the tikibar turned on
+    request = RequestFactory().get('/')
+    request.correlation_id = 'benchmark'
+    set_current_request(request)
+    results['span_inactive_request'] = time_per_call(inactive_span, 100000)
+    # What every query pays while the tikibar is off, which isn't counted
+    # in process_overhead()
+    results['database_wrapper_inactive'] = time_per_call(
+        lambda: wrapper(execute, 'SELECT %s', [1], False, context), 10000,
+    )
+    clear_current_request()
+    return {name: {'ns_per_call': ns} for name, ns in results.items()}
+
+
+# Modules a Django worker imports anyway, loaded before timing tikibar's
+IMPORT_BASELINE = 'import django.http, django.db, django.template, django.core.cache, django.shortcuts'
+IMPORT_MODULES = ['tikibar.middleware', 'tikibar.views', 'tikibar.template_backend', 'tikibar.tiki_logger']
+# Only loaded when a feature that needs them is used
+LAZY_MODULES = ['sqlparse', 'tracemalloc', 'tikibar.sampler', 'tikibar.memory', 'urllib.request']
+
+IMPORT_SNIPPET = """
+import json, sys, time
+%s
+start = time.perf_counter()
+%s
+print(json.dumps({'ms': (time.perf_counter() - start) * 1000, 'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def run_import_times(repeat):
+    """Time importing tikibar's modules in fresh interpreters."""
+    results = {}
+    for module in IMPORT_MODULES:
+        snippet = IMPORT_SNIPPET % (IMPORT_BASELINE, 'import ' + module, LAZY_MODULES)
+        runs = [
+            json.loads(subprocess.check_output([sys.executable, '-c', snippet], cwd=ROOT))
+            for i in range(repeat)
+        ]
+        results[module] = {
+            'ms': statistics.median(run['ms'] for run in runs),
+            'eagerly_loaded': runs[0]['loaded'],
+        }
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Print the change in every number that both runs measured."""
+    for name, paths in sorted(new['end_to_end'].items()):
+        for path, result in sorted(paths.items()):
+            before = old.get('end_to_end', {}).get(name, {}).get(path)
+            if before:
+                print('%-16s %-12s p50 %8.3fms -> %8.3fms (%+.1f%%)' % (
+                    name, path, before['p50_ms'], result['p50_ms'],
+                    (result['p50_ms'] / before['p50_ms'] - 1) * 100,
+                ))
+    for module, result in sorted(new['import_time'].items()):
+        before = old.get('import_time', {}).get(module)
+        if before:
+            print('import %-26s %8.1fms -> %8.1fms (%+.1f%%)' % (
+                module, before['ms'], result['ms'], (result['ms'] / before['ms'] - 1) * 100,
+            ))
+    for name, result in sorted(new['micro'].items()):
+        before = old.get('micro', {}).get(name)
+        if before:
+            print('%-29s %10.0fns -> %10.0fns (%+.1f%%)' % (
+                name, before['ns_per_call'], result['ns_per_call'],
+                (result['ns_per_call'] / before['ns_per_call'] - 1) * 100,
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='An earlier results file to compare against')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per view and configuration')
+    parser.add_argument('--n', type=int, default=20, help='Queries, template includes or log lines per request')
+    parser.add_argument('--import-repeat', type=int, default=5, help='Fresh interpreters per import timing')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'timestamp': time.time(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'requests': args.requests,
+            'n': args.n,
+        },
+        'end_to_end': run_end_to_end(args.requests, args.n),
+        'micro': run_micro(args.n),
+        'import_time': run_import_times(args.import_repeat),
+    }
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+
+    for name, paths in results['end_to_end'].items():
+        for path, result in paths.items():
+            print('%-16s %-12s p50 %8.3fms  p95 %8.3fms  %8.0f req/s' % (
+                name, path, result['p50_ms'], result['p95_ms'], result['requests_per_second'],
+            ))
+    for name, result in results['micro'].items():
+        print('%-29s %10.0fns' % (name, result['ns_per_call']))
+    for module, result in results['import_time'].items():
+        print('import %-26s %8.1fms%s' % (
+            module, result['ms'],
+            '  loads %s' % ', '.join(result['eagerly_loaded']) if result['eagerly_loaded'] else '',
+        ))
+
+    if args.compare:
+        with open(args.compare) as fp:
+            print('\nCompared with %s:' % args.compare)
+            compare(json.load(fp), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,8 @@ setup(
     url='https://github.com/eventbrite/tikibar',
     packages=[
         'tikibar',
+        'tikibar.management',
+        'tikibar.management.commands',
     ],
     include_package_data=True,
     install_requires=[
@@ -0,0 +1,9 @@
+from django.conf.urls import url
+
+from events import views
+
+urlpatterns = [
+    url(r'^queries/$', views.queries_view),
+    url(r'^templates/$', views.templates_view),
+    url(r'^logging/$', views.logging_view),
+]
@@ -1,6 +1,36 @@
+import logging
+
+from django.db import connection
+from django.http import HttpResponse
+from django.shortcuts import render
 from django.views.generic import TemplateView
 
 
+logger = logging.getLogger(__name__)
+
+
 class HomeView(TemplateView):
 
-    template_name="home.html"
\ No newline at end of file
+    template_name="home.html"
+
+
+# Views exercised by benchmarks/suite.py, each sized by a ?n= parameter
+
+def queries_view(request):
+    with connection.cursor() as cursor:
+        for i in range(int(request.GET.get('n', 20))):
+            cursor.execute('SELECT %s', [i])
+            cursor.fetchone()
+    return HttpResponse('<html><head></head><body>queries</body></html>')
+
+
+def templates_view(request):
+    return render(request, 'benchmark/page.html', {
+        'items': range(int(request.GET.get('n', 20))),
+    })
+
+
+def logging_view(request):
+    for i in range(int(request.GET.get('n', 20))):
+        logger.info('Benchmark log line %d of %s', i, request.path)
+    return HttpResponse('<html><head></head><body>logging</body></html>')
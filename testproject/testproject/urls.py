@@ -21,5 +21,6 @@ from events.views import HomeView
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^tikibar/', include(tikibar_urls)),
+    url(r'^benchmark/', include('events.urls')),
     url(r'^$', HomeView.as_view()),
 ]
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.test import RequestFactory, SimpleTestCase
+
+from tikibar import views
+from tikibar.aggregates import Histogram, bucket_bounds, bucket_for
+
+
+class TestHistogram(SimpleTestCase):
+
+    def test_buckets_contain_their_values(self):
+        for value in (0, 0.03, 0.99, 1, 1.5, 7, 1000, 123456.7):
+            low, high = bucket_bounds(bucket_for(value))
+            self.assertTrue(low <= value < high, (value, low, high))
+
+    def test_percentiles_are_within_bucket_error(self):
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+        self.assertAlmostEqual(histogram.percentile(50), 500, delta=500 / 16)
+        self.assertAlmostEqual(histogram.percentile(99), 990, delta=990 / 16)
+        self.assertEqual(histogram.percentile(100), 1000)
+
+    def test_merge_matches_recording_everything(self):
+        first, second, both = Histogram(), Histogram(), Histogram()
+        for value in range(100):
+            (first if value % 3 else second).record(value)
+            both.record(value)
+        first.merge(Histogram.from_dict(second.to_dict()))
+        self.assertEqual(first.to_dict(), both.to_dict())
+
+
+class TestAggregatesView(SimpleTestCase):
+
+    def test_insecure_requests_are_redirected(self):
+        request = RequestFactory().get('/tikibar/aggregates/')
+        response = views.tikibar_aggregates(request)
+        self.assertEqual(response.status_code, 301)
+        self.assertTrue(response['Location'].startswith('https://'))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.core.cache import cache, caches
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar import views
+from tikibar.cache_metrics import instrument_caches
+from tikibar.core import MetricsContainer
+
+
+@override_settings(TIKIBAR_SETTINGS={})
+class TestCacheRecorder(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.toolbar = MetricsContainer('cid')
+
+    def recorded(self):
+        return [
+            val
+            for alias, val, *rest in self.toolbar.metrics['queries']['Cache']
+        ]
+
+    def test_calls_are_recorded_once(self):
+        with instrument_caches(self.toolbar):
+            cache.set('event:1', 'x' * 10)
+            cache.get('event:1')
+            cache.get('event:2')
+            # The locmem backend implements get_many with get
+            cache.get_many(['event:1', 'event:2'])
+            cache.delete('event:1')
+        self.assertEqual(self.recorded(), [
+            'SET event:1 (10 bytes)',
+            'GET event:1 (hit, 10 bytes)',
+            'GET event:2 (miss)',
+            'GET_MANY event:1, event:2 (1 hits, 1 misses, 10 bytes)',
+            'DELETE event:1',
+        ])
+
+    def test_tikibar_keys_are_skipped(self):
+        with instrument_caches(self.toolbar):
+            cache.set('tikibar:history:token', '[]')
+            cache.get('tikibar:history:token')
+            cache.get_many(['event:1', 'tikibar:summary:cid'])
+        self.assertEqual(self.recorded(), [])
+
+    def test_backend_is_restored(self):
+        with instrument_caches(self.toolbar):
+            pass
+        cache.get('event:1')
+        self.assertEqual(self.recorded(), [])
+        self.assertNotIn('get', vars(caches['default']))
+
+
+@override_settings(
+    ENABLE_TIKIBAR=True,
+    TIKIBAR_SETTINGS={'blacklist': []},
+    TEMPLATES=[
+        {
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+        }
+    ],
+)
+class TestQueryTextIsEscaped(SimpleTestCase):
+
+    def test_cache_keys_and_http_requests_are_escaped(self):
+        toolbar = MetricsContainer('escaped', storage=cache)
+        toolbar.add_query_metric(
+            'Cache',
+            'default',
+            'GET <script>alert(1)</script> (miss)',
+            1.0,
+            1.1,
+        )
+        toolbar.add_http_request(
+            'example.com:80',
+            'GET',
+            '/<img src=x onerror=alert(2)>',
+            200,
+            10,
+            False,
+            1.2,
+            1.3,
+        )
+        toolbar.add_singular_metric('total_time', {'d': [1.0, 2.0]})
+        toolbar.add_singular_metric('release', 'master')
+        toolbar.add_singular_metric('request_path', '/')
+        toolbar.write_metrics()
+
+        request = RequestFactory().get(
+            '/tikibar/',
+            {'correlation_id': 'escaped', 'render': '1'},
+            secure=True,
+        )
+        with mock.patch(
+            'tikibar.views.get_tiki_token_or_false_for_tikibar_view',
+            return_value='token',
+        ):
+            content = views.tikibar(request).content.decode('utf8')
+        self.assertNotIn('<script>alert(1)</script>', content)
+        self.assertIn(
+            'GET &lt;script&gt;alert(1)&lt;/script&gt; (miss)', content
+        )
+        self.assertNotIn('<img src=x', content)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+
+from django.test import SimpleTestCase, override_settings
+
+from tikibar.call_sites import get_call_site
+
+
+@override_settings(TIKIBAR_SETTINGS={})
+class TestCallSites(SimpleTestCase):
+
+    def test_first_application_frame_is_found(self):
+        filepath, line, function = get_call_site(sys._getframe(0))
+        self.assertTrue(filepath.endswith('test_call_sites.py'))
+        self.assertEqual(function, 'test_first_application_frame_is_found')
+
+    def test_call_sites_are_interned(self):
+        call_sites = [get_call_site(sys._getframe(0)) for i in range(2)]
+        self.assertIs(call_sites[0], call_sites[1])
+
+    def test_walk_is_bounded(self):
+        self.assertIsNone(get_call_site(sys._getframe(0), max_depth=0))
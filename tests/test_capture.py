@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar import views
+from tikibar.capture import (
+    SAMPLED,
+    TAIL,
+    capture_mode_for_request,
+    capture_reason,
+)
+
+
+class TestCaptureMode(SimpleTestCase):
+
+    @override_settings(TIKIBAR_SETTINGS={'sample_rate': 0.1})
+    def test_sample_rate_picks_a_fraction_of_requests(self):
+        with mock.patch('tikibar.capture.random.random', return_value=0.05):
+            self.assertEqual(capture_mode_for_request(), SAMPLED)
+        with mock.patch('tikibar.capture.random.random', return_value=0.5):
+            self.assertIsNone(capture_mode_for_request())
+
+    @override_settings(
+        TIKIBAR_SETTINGS={'sample_rate': 0.1, 'tail_threshold': 500}
+    )
+    def test_unsampled_requests_are_tail_captured(self):
+        with mock.patch('tikibar.capture.random.random', return_value=0.5):
+            self.assertEqual(capture_mode_for_request(), TAIL)
+
+    @override_settings(TIKIBAR_SETTINGS={})
+    def test_nothing_is_captured_by_default(self):
+        self.assertIsNone(capture_mode_for_request())
+
+
+class TestCaptureReason(SimpleTestCase):
+
+    @override_settings(TIKIBAR_SETTINGS={'tail_threshold': 500})
+    def test_slow_and_failed_requests_are_kept(self):
+        self.assertEqual(capture_reason(TAIL, 0.6, 200), 'slow')
+        self.assertEqual(capture_reason(TAIL, 0.1, 503), 'error')
+        self.assertIsNone(capture_reason(TAIL, 0.1, 404))
+
+    @override_settings(TIKIBAR_SETTINGS={'tail_threshold': 500})
+    def test_sampled_requests_are_always_kept(self):
+        self.assertEqual(capture_reason(SAMPLED, 0.1, 200), SAMPLED)
+        self.assertEqual(capture_reason(SAMPLED, 0.6, 200), 'slow')
+
+
+class TestCapturedView(SimpleTestCase):
+
+    def test_insecure_requests_are_redirected(self):
+        request = RequestFactory().get('/tikibar/captured/')
+        response = views.tikibar_captured(request)
+        self.assertEqual(response.status_code, 301)
+        self.assertTrue(response['Location'].startswith('https://'))
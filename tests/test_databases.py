@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+
+from django.db import connections
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar.context import clear_current_request, set_current_request
+from tikibar.middleware import TikibarDatabaseWrapper, install_database_hooks
+from tikibar.threads import propagate
+from tikibar.toolbar_metrics import ToolbarMetricsContainer
+
+
+def make_connection(alias):
+    return DatabaseWrapper(
+        dict(connections['default'].settings_dict, NAME=':memory:'),
+        alias=alias,
+    )
+
+
+@override_settings(TIKIBAR_SETTINGS={'blacklist': []})
+class TestDatabaseInstrumentation(SimpleTestCase):
+    databases = {'default'}
+
+    def setUp(self):
+        install_database_hooks()
+        self.request = RequestFactory().get('/')
+        self.request.correlation_id = 'cid'
+        self.request.toolbar_metrics = self.toolbar = ToolbarMetricsContainer(
+            'cid', True
+        )
+        self.request.tikibar_database_wrapper = TikibarDatabaseWrapper()
+        set_current_request(self.request)
+        self.addCleanup(clear_current_request)
+
+    def queries(self, metric_type):
+        queries = self.toolbar.metrics['queries'][metric_type]
+        return [(alias, val) for alias, val, *rest in queries]
+
+    def test_queries_on_every_alias_are_recorded(self):
+        other = make_connection('other')
+        self.addCleanup(other.close)
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+        with other.cursor() as cursor:
+            cursor.execute('SELECT 2')
+        self.assertEqual(
+            self.queries('SQL'),
+            [('default', 'SELECT 1'), ('other', 'SELECT 2')],
+        )
+        self.assertIn(('other', 'CONNECT'), self.queries('DB'))
+
+    def test_untouched_aliases_are_left_alone(self):
+        other = make_connection('other')
+        self.assertFalse(
+            set(vars(other))
+            & {'connect', 'commit', 'rollback', 'set_autocommit'}
+        )
+        self.assertEqual(other.execute_wrappers, [])
+
+    def test_requests_without_a_wrapper_are_not_recorded(self):
+        del self.request.tikibar_database_wrapper
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertEqual(self.queries('SQL'), [])
+
+    def test_nested_propagation_records_once(self):
+        def query():
+            with connections['default'].cursor() as cursor:
+                cursor.execute('SELECT 1')
+
+        outer = propagate(lambda: propagate(query)())
+        errors = []
+
+        def run():
+            try:
+                outer()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.queries('SQL'), [('default', 'SELECT 1')])
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from tikibar import explain
+from tikibar.core import (
+    EXPLAINS_KEY,
+    MetricsContainer,
+    load_metrics,
+    publish_metrics,
+)
+from tikibar.fingerprints import fingerprint_sql
+from tikibar.middleware import TikibarDatabaseWrapper
+
+
+class FakeConnection:
+    alias = 'default'
+    vendor = 'sqlite'
+
+
+def slow_execute(sql, params, many, context):
+    time.sleep(0.02)
+
+
+def fast_execute(sql, params, many, context):
+    pass
+
+
+@override_settings(
+    TIKIBAR_SETTINGS={'explain_threshold': 10, 'explain_max_per_request': 2}
+)
+class TestExplainCandidates(SimpleTestCase):
+
+    def setUp(self):
+        self.toolbar = MetricsContainer('cid')
+        patcher = mock.patch(
+            'tikibar.middleware.get_toolbar', return_value=self.toolbar
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def execute(self, execute, sql):
+        TikibarDatabaseWrapper()(
+            execute, sql, [], False, {'connection': FakeConnection()}
+        )
+
+    def test_only_queries_over_the_threshold_are_explained(self):
+        self.execute(fast_execute, 'SELECT 1')
+        self.execute(slow_execute, 'SELECT 2')
+        self.assertEqual(
+            [
+                sql
+                for alias, fid, sql, params in self.toolbar.explain_candidates
+            ],
+            ['SELECT 2'],
+        )
+
+    def test_only_selects_are_explained(self):
+        self.execute(slow_execute, 'UPDATE events SET name = %s')
+        self.assertEqual(self.toolbar.explain_candidates, [])
+        connection = FakeConnection()
+        self.assertTrue(explain.can_explain(connection, '  select 1'))
+        connection.vendor = 'oracle'
+        self.assertFalse(explain.can_explain(connection, 'SELECT 1'))
+
+    def test_one_plan_per_fingerprint_and_capped(self):
+        self.execute(slow_execute, 'SELECT * FROM events WHERE id = 1')
+        self.execute(slow_execute, 'SELECT * FROM events WHERE id = 2')
+        self.execute(slow_execute, 'SELECT * FROM venues')
+        self.execute(slow_execute, 'SELECT * FROM artists')
+        self.assertEqual(len(self.toolbar.explain_candidates), 2)
+        self.assertEqual(len(self.toolbar.metrics['sql_explains']), 2)
+
+
+@override_settings(TIKIBAR_SETTINGS={})
+class TestExplainWorker(SimpleTestCase):
+    databases = {'default'}
+
+    def setUp(self):
+        explain._plan_cache.clear()
+        self.addCleanup(explain._plan_cache.clear)
+
+    def test_plans_are_stored_apart_and_merged_on_load(self):
+        toolbar = MetricsContainer('explained', storage=cache)
+        toolbar.add_explain_candidate('default', 'SELECT 1', None, 0, 1, 5)
+        publish_metrics(cache, 'explained', toolbar.metrics)
+        explain.explain_later('explained', toolbar.explain_candidates)
+
+        deadline = time.time() + 5
+        while (
+            cache.get(EXPLAINS_KEY % 'explained') is None
+            and time.time() < deadline
+        ):
+            time.sleep(0.01)
+        fingerprint_id = fingerprint_sql('SELECT 1')[0]
+        explains = load_metrics(cache, 'explained')['sql_explains']
+        plan = explains[fingerprint_id]['plan']
+        self.assertTrue(plan)
+        self.assertFalse(plan[0].startswith('EXPLAIN failed'))
+
+    def test_plans_are_cached_per_fingerprint(self):
+        fingerprint_id = fingerprint_sql('SELECT 1')[0]
+        candidates = [('default', fingerprint_id, 'SELECT 1', None)]
+        with mock.patch(
+            'tikibar.explain._explain', return_value=['plan']
+        ) as run_explain:
+            explain._explain_job('first', candidates)
+            explain._explain_job('second', candidates)
+        self.assertEqual(run_explain.call_count, 1)
+        self.assertEqual(
+            cache.get(EXPLAINS_KEY % 'second'), {fingerprint_id: ['plan']}
+        )
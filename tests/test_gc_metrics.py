@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gc
+import threading
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar.context import clear_current_request, set_current_request
+from tikibar.core import MemoryStorage, MetricsContainer
+from tikibar.gc_metrics import install_gc_hooks
+
+
+@override_settings(TIKIBAR_SETTINGS={})
+class TestGcMetrics(SimpleTestCase):
+
+    def setUp(self):
+        install_gc_hooks()
+        self.toolbar = MetricsContainer('cid', storage=MemoryStorage())
+
+    def record_queries(self):
+        request = RequestFactory().get('/')
+        request.toolbar_metrics = self.toolbar
+        set_current_request(request)
+        try:
+            for i in range(2000):
+                self.toolbar.add_query_metric(
+                    'Cache', 'default', 'GET event:%d' % i, 0.0, 0.1
+                )
+        finally:
+            clear_current_request()
+
+    def test_collections_while_recording_do_not_deadlock(self):
+        threshold = gc.get_threshold()
+        self.addCleanup(gc.set_threshold, *threshold)
+        gc.set_threshold(1)
+        worker = threading.Thread(target=self.record_queries, daemon=True)
+        worker.start()
+        worker.join(timeout=10)
+        gc.set_threshold(*threshold)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(len(self.toolbar.metrics['queries']['Cache']), 2000)
+        self.toolbar.write_metrics()
+        collection = self.toolbar.metrics['gc'][0]
+        self.assertEqual(
+            set(collection),
+            {'generation', 'collected', 'uncollectable', 'timing'},
+        )
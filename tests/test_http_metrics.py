@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import http.client
+import http.server
+import threading
+
+import mock
+from django.test import SimpleTestCase
+
+from tikibar.http_metrics import install_http_hooks
+from tikibar.toolbar_metrics import ToolbarMetricsContainer
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'hello'
+        self.send_response(200 if self.path != '/missing' else 404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPMetrics(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        install_http_hooks()
+        cls.server = http.server.HTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.toolbar = ToolbarMetricsContainer('cid')
+        patcher = mock.patch(
+            'tikibar.http_metrics.get_toolbar', return_value=self.toolbar
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_are_recorded_with_connection_reuse(self):
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        for path in ('/one', '/missing'):
+            connection.request('GET', path)
+            connection.getresponse().read()
+        connection.close()
+
+        requests = self.toolbar.metrics['queries']['HTTP']
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(
+            requests[0][0], '127.0.0.1:%d' % self.server.server_address[1]
+        )
+        self.assertEqual(
+            requests[0][1], 'GET /one 200 (5 bytes, new connection)'
+        )
+        self.assertEqual(
+            requests[1][1], 'GET /missing 404 (5 bytes, reused connection)'
+        )
+        self.assertEqual(
+            self.toolbar.metrics['http_connections'], {'new': 1, 'reused': 1}
+        )
+
+    def test_inactive_toolbar_records_nothing(self):
+        self.toolbar._is_active = False
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        connection.request('GET', '/one')
+        connection.getresponse().read()
+        connection.close()
+        self.assertEqual(self.toolbar.metrics['queries']['HTTP'], [])
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import builtins
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar.aggregates import aggregator
+from tikibar.middleware import TikibarMiddleware
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed by features that are off by default
+LAZY_MODULES = [
+    'sqlparse',
+    'tracemalloc',
+    'tikibar.sampler',
+    'tikibar.memory',
+    'urllib.request',
+]
+
+# Imported by the middleware only once their feature is turned on
+FEATURE_MODULES = [
+    'tikibar.aggregates',
+    'tikibar.cache_metrics',
+    'tikibar.call_sites',
+    'tikibar.capture',
+    'tikibar.explain',
+    'tikibar.gc_metrics',
+    'tikibar.http_metrics',
+    'tikibar.live_feed',
+]
+
+
+class TestLazyImports(SimpleTestCase):
+
+    def loaded(self, imports, modules):
+        snippet = (
+            'import json, sys\nimport %s\n'
+            'print(json.dumps([m for m in %r if m in sys.modules]))'
+        ) % (imports, modules)
+        return json.loads(
+            subprocess.check_output([sys.executable, '-c', snippet], cwd=ROOT)
+        )
+
+    def test_heavy_modules_are_not_imported_up_front(self):
+        loaded = self.loaded(
+            'tikibar.middleware, tikibar.views, tikibar.template_backend',
+            LAZY_MODULES,
+        )
+        self.assertEqual(loaded, [])
+
+    def test_middleware_leaves_optional_features_unloaded(self):
+        self.assertEqual(
+            self.loaded('tikibar.middleware', FEATURE_MODULES), []
+        )
+
+
+def query_view(request):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    return HttpResponse('ok')
+
+
+@override_settings(ENABLE_TIKIBAR=True, TIKIBAR_SETTINGS={
+    'blacklist': [],
+    'capture_sql_call_sites': True,
+    'explain_threshold': 0,
+    'instrument_cache': True,
+    'instrument_gc': True,
+    'aggregate_views': True,
+    'enable_profiler': True,
+    'sample_rate': 1,
+    'live_feed_path': os.path.join(tempfile.mkdtemp(), 'feed'),
+})
+class TestFeaturesAreBoundOnce(SimpleTestCase):
+    databases = {'default'}
+
+    def middleware_imports(self, func):
+        """The relative imports tikibar.middleware runs while calling func."""
+        imports = []
+        original = builtins.__import__
+
+        def spy(name, globals=None, locals=None, fromlist=(), level=0):
+            if (
+                level
+                and (globals or {}).get('__name__') == 'tikibar.middleware'
+            ):
+                imports.append(name)
+            return original(name, globals, locals, fromlist, level)
+
+        with mock.patch('builtins.__import__', spy):
+            func()
+        return imports
+
+    def test_requests_do_not_import_features(self):
+        middleware = TikibarMiddleware(query_view)
+        self.addCleanup(aggregator.flush)
+        self.assertIsNotNone(middleware.record_request)
+        self.assertIsNotNone(middleware.database_wrapper.get_call_site)
+
+        def run(token):
+            with mock.patch(
+                'tikibar.toolbar_metrics.get_tiki_token_or_false',
+                return_value=token,
+            ), mock.patch(
+                'tikibar.middleware.get_tiki_token_or_false',
+                return_value=token,
+            ), mock.patch.object(
+                middleware, 'explain_later'
+            ):
+                request = RequestFactory().get('/', secure=True)
+                request.correlation_id = 'cid-%s' % bool(token)
+                middleware(request)
+
+        # A recorded request, then one that's only captured
+        self.assertEqual(self.middleware_imports(lambda: run('token')), [])
+        self.assertEqual(self.middleware_imports(lambda: run(False)), [])
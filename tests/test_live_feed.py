@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+from django.test import RequestFactory, SimpleTestCase
+
+from tikibar import views
+from tikibar.live_feed import (
+    DATA_OFFSET,
+    SEQUENCE,
+    SLOT_SIZE,
+    LiveFeed,
+    read_feed,
+)
+
+
+class TestLiveFeed(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'feed')
+        self.feed = LiveFeed(self.path, slots=4)
+
+    def test_reads_what_was_written_since_the_last_read(self):
+        self.feed.append(
+            0.25,
+            sql_count=3,
+            status=200,
+            method='GET',
+            path='/events/',
+            recorded=True,
+        )
+        records, last = read_feed(self.path)
+        self.assertEqual(last, 1)
+        [record] = records
+        self.assertEqual(record['ms'], 250)
+        self.assertEqual(
+            (record['path'], record['sql_count'], record['recorded']),
+            ('/events/', 3, True),
+        )
+        self.feed.append(0.5, path='/next/')
+        records, last = read_feed(self.path, since=last)
+        self.assertEqual([record['path'] for record in records], ['/next/'])
+
+    def test_only_the_latest_slots_are_kept(self):
+        for i in range(10):
+            self.feed.append(0.1, path='/%d/' % i)
+        records, last = read_feed(self.path)
+        self.assertEqual(
+            [record['path'] for record in records],
+            ['/6/', '/7/', '/8/', '/9/'],
+        )
+
+    def test_slots_being_written_are_skipped(self):
+        self.feed.append(0.1, path='/done/')
+        self.feed.append(0.1, path='/half-written/')
+        # What a writer that died mid-write leaves behind
+        SEQUENCE.pack_into(self.feed._mmap, DATA_OFFSET + 2 * SLOT_SIZE, 0)
+        records, last = read_feed(self.path)
+        self.assertEqual([record['path'] for record in records], ['/done/'])
+        self.assertEqual(last, 2)
+
+    def test_missing_feed_is_empty(self):
+        self.assertEqual(read_feed(self.path + '-missing', since=5), ([], 5))
+
+
+class TestLiveView(SimpleTestCase):
+
+    def test_insecure_requests_are_redirected(self):
+        request = RequestFactory().get('/tikibar/live/')
+        response = views.tikibar_live(request)
+        self.assertEqual(response.status_code, 301)
+        self.assertTrue(response['Location'].startswith('https://'))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar.context import clear_current_request, set_current_request
+from tikibar.core import MemoryStorage, MetricsContainer
+from tikibar.tiki_logger import TikiLogHandler
+from tikibar.utils import TIKIBAR_LOG_LEVEL_COOKIE, get_log_level_for_request
+
+
+@override_settings(TIKIBAR_SETTINGS={})
+class TestLogCapture(SimpleTestCase):
+
+    def setUp(self):
+        self.toolbar = MetricsContainer('cid', storage=MemoryStorage())
+        request = RequestFactory().get('/')
+        request.toolbar_metrics = self.toolbar
+        set_current_request(request)
+        self.addCleanup(clear_current_request)
+        self.logger = logging.getLogger('tikibar.tests.logging')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        handler = TikiLogHandler()
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+
+    def messages(self):
+        self.toolbar.format_log_records()
+        return [
+            message
+            for level, message, *rest in self.toolbar.metrics['loglines']
+        ]
+
+    def test_records_below_the_level_are_ignored(self):
+        self.toolbar.log_level = logging.WARNING
+        self.logger.info('skipped')
+        self.logger.warning('kept %d', 1)
+        self.assertEqual(self.messages(), ['kept 1'])
+
+    def test_buffer_keeps_the_most_recent_records(self):
+        self.toolbar.log_buffer_size = 3
+        for i in range(5):
+            self.logger.info('line %d', i)
+        self.assertEqual(self.messages(), ['line 2', 'line 3', 'line 4'])
+        self.assertEqual(self.toolbar.metrics['loglines_dropped'], 2)
+
+    def test_dropped_count_matches_truncated_logs(self):
+        for i in range(5):
+            self.logger.info('line %d', i)
+        self.toolbar.max_size = 100
+        self.toolbar.add_singular_metric('total_time', {'d': [0, 1]})
+        self.toolbar.write_metrics()
+        self.assertEqual(
+            self.toolbar.metrics['loglines'],
+            [('ERROR', 'Logs too big for memcached')],
+        )
+        self.assertEqual(self.toolbar.metrics['loglines_dropped'], 5)
+
+
+class TestLogLevelForRequest(SimpleTestCase):
+
+    def request(self, level=None):
+        request = RequestFactory().get('/')
+        if level is not None:
+            request.COOKIES[TIKIBAR_LOG_LEVEL_COOKIE] = level
+        return request
+
+    @override_settings(TIKIBAR_SETTINGS={'log_level': 'INFO'})
+    def test_setting_is_the_default(self):
+        self.assertEqual(
+            get_log_level_for_request(self.request()), logging.INFO
+        )
+
+    @override_settings(TIKIBAR_SETTINGS={'log_level': 'INFO'})
+    def test_cookie_overrides_the_setting(self):
+        self.assertEqual(
+            get_log_level_for_request(self.request('error')), logging.ERROR
+        )
+
+    @override_settings(TIKIBAR_SETTINGS={})
+    def test_unknown_levels_capture_everything(self):
+        self.assertEqual(
+            get_log_level_for_request(self.request('loud')), logging.DEBUG
+        )
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import tracemalloc
+
+from django.test import SimpleTestCase
+
+from tikibar.memory import AllocationProfiler
+
+
+class TestAllocationProfiler(SimpleTestCase):
+
+    def test_allocations_are_attributed(self):
+        profiler = AllocationProfiler(frames=1, top=5)
+        profiler.start()
+        kept = [bytearray(10000) for i in range(20)]
+        stats = profiler.output_stats()
+        self.assertGreaterEqual(stats['peak'], 200000)
+        filepath, line = stats['by_size'][0]['traceback'][0]
+        self.assertTrue(filepath.endswith('test_memory.py'))
+        self.assertEqual(len(kept), 20)
+
+    def test_tracing_stops_with_the_last_profiler(self):
+        first, second = AllocationProfiler(), AllocationProfiler()
+        first.start()
+        second.start()
+        first.stop()
+        self.assertTrue(tracemalloc.is_tracing())
+        second.stop()
+        self.assertFalse(tracemalloc.is_tracing())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import io
+import os
+import tempfile
+
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase
+
+from tikibar.capture import TAIL
+from tikibar.core import MetricsContainer
+from tikibar.offline import (
+    Summary,
+    diff_counts,
+    iter_records,
+    read_records,
+    write_records,
+)
+
+
+def payload(ids):
+    return {
+        'total_time': {'d': (100.0, 100.5)},
+        'request_path': '/events/',
+        'queries': {
+            'SQL': [
+                (
+                    'default',
+                    'SELECT * FROM event WHERE id = %d' % i,
+                    True,
+                    {'d': (100.1, 100.11)},
+                    None,
+                    1,
+                )
+                for i in ids
+            ],
+        },
+        'template_tree': [
+            {
+                'name': 'page.html',
+                'kind': 'template',
+                'timing': {'d': (100.3, 100.4)},
+                'children': [
+                    {
+                        'name': 'item.html',
+                        'kind': 'include',
+                        'timing': {'d': (100.31, 100.35)},
+                        'children': [],
+                    }
+                ],
+            }
+        ],
+        'stack_samples': '"main(app);render(app) 3","main(app);query(db) 2"',
+    }
+
+
+class TestSummary(SimpleTestCase):
+
+    def test_round_trip_through_a_file(self):
+        fp = io.StringIO()
+        write_records(iter_records(payload(range(3)), 'abc'), fp)
+        fp.seek(0)
+        summary = Summary.from_records(read_records(fp))
+        self.assertEqual(summary.request['correlation_id'], 'abc')
+        self.assertEqual(summary.query_count, 3)
+        [(text, count, seconds)] = summary.top_queries(10)
+        self.assertEqual(
+            (text, count), ('SELECT * FROM event WHERE id = ?', 3)
+        )
+        self.assertAlmostEqual(summary.template_time, 0.1)
+        self.assertEqual(
+            [name for name, count, seconds in summary.top_templates(10)],
+            ['page.html', 'item.html'],
+        )
+        self.assertEqual(
+            summary.leaf_frames, {'render(app)': 3, 'query(db)': 2}
+        )
+
+    def test_diff_lists_changed_keys(self):
+        before = Summary.from_records(iter_records(payload(range(2))))
+        after = Summary.from_records(iter_records(payload(range(40))))
+        [(key, (count_before, _), (count_after, _))] = diff_counts(
+            before.queries, after.queries, 10
+        )
+        self.assertEqual((count_before, count_after), (2, 40))
+        self.assertEqual(
+            diff_counts(before.templates, after.templates, 10), []
+        )
+
+
+def captured_payload():
+    """A payload as published for a request captured with the tikibar off."""
+    toolbar = MetricsContainer('abc', is_active=False)
+    toolbar.capture_mode = TAIL
+    for start in (100.0, 100.1, 100.2):
+        toolbar.add_query_summary('default', start, start + 0.02)
+    toolbar.add_singular_metric('total_time', {'d': [100.0, 100.5]})
+    toolbar.add_singular_metric('status', 200)
+    toolbar.add_singular_metric(
+        'capture', {'reason': 'slow', 'method': 'GET', 'status': 200}
+    )
+    return toolbar.metrics
+
+
+class TestIterRecords(SimpleTestCase):
+
+    def test_captured_requests_count_their_queries(self):
+        summary = Summary.from_records(iter_records(captured_payload(), 'abc'))
+        self.assertEqual(summary.query_count, 3)
+        self.assertAlmostEqual(summary.query_time, 0.06)
+        [(text, count, seconds)] = summary.top_queries(10)
+        self.assertEqual(
+            (text, count), ('SQL on default (not recorded individually)', 3)
+        )
+
+    def test_only_sql_counts_as_queries(self):
+        metrics = payload(range(2))
+        metrics['queries']['Cache'] = [
+            (
+                'default',
+                'GET event:1 (miss)',
+                False,
+                {'d': (100.2, 100.3)},
+                None,
+                1,
+            )
+        ]
+        summary = Summary.from_records(iter_records(metrics))
+        self.assertEqual(summary.query_count, 2)
+        self.assertAlmostEqual(summary.query_time, 0.02)
+        self.assertIn('Cache GET event:1 (miss)', summary.queries)
+
+    def test_status_comes_from_the_response(self):
+        metrics = dict(payload([]), status=404)
+        [request] = [
+            record
+            for record in iter_records(metrics)
+            if record['record'] == 'request'
+        ]
+        self.assertEqual(request['status'], 404)
+        metrics = dict(payload([]), capture={'status': 500})
+        [request] = [
+            record
+            for record in iter_records(metrics)
+            if record['record'] == 'request'
+        ]
+        self.assertEqual(request['status'], 500)
+
+    def test_truncated_logs_are_kept(self):
+        metrics = dict(
+            payload([]), loglines=[('ERROR', 'Logs too big for memcached')]
+        )
+        [log] = [
+            record
+            for record in iter_records(metrics)
+            if record['record'] == 'log'
+        ]
+        self.assertEqual(
+            (log['level'], log['message'], log['created']),
+            ('ERROR', 'Logs too big for memcached', None),
+        )
+
+
+class TestMetricsCommand(SimpleTestCase):
+
+    def test_files_without_a_request_are_rejected(self):
+        path = os.path.join(tempfile.mkdtemp(), 'empty.jsonl')
+        open(path, 'w').close()
+        for args in (('summary', path), ('diff', path, path)):
+            with self.assertRaisesMessage(
+                CommandError, 'has no request record'
+            ):
+                call_command('tikibar_metrics', *args, stdout=io.StringIO())
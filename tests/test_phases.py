@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.template import engines
+from django.template.response import TemplateResponse
+from django.test import Client, SimpleTestCase, override_settings
+from django.urls import path
+
+from tikibar.core import PHASES_KEY, load_metrics, publish_metrics
+from tikibar.phases import install_phase_hooks
+from tikibar.toolbar_metrics import ToolbarMetricsContainer
+
+
+class RecordingMiddleware:
+    """Turns the tikibar on for every request, like TikibarMiddleware."""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.correlation_id = request.GET['cid']
+        request.toolbar_metrics = ToolbarMetricsContainer(
+            request.correlation_id, request.GET.get('active') == '1'
+        )
+        return self.get_response(request)
+
+
+def plain_view(request):
+    return HttpResponse('ok')
+
+
+def template_view(request):
+    return TemplateResponse(request, engines['django'].from_string('ok'))
+
+
+urlpatterns = [
+    path('plain/', plain_view),
+    path('template/', template_view),
+]
+
+
+@override_settings(
+    ROOT_URLCONF='tests.test_phases',
+    MIDDLEWARE=['tests.test_phases.RecordingMiddleware'],
+    TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}],
+)
+class TestPhases(SimpleTestCase):
+
+    def setUp(self):
+        install_phase_hooks()
+        cache.clear()
+
+    def timings(self, correlation_id):
+        stored = cache.get(PHASES_KEY % correlation_id)
+        return (
+            [name for name, timing in stored['middleware_layers']],
+            [name for name, timing in stored['phases']],
+        )
+
+    def test_layers_and_phases_are_timed(self):
+        Client().get('/template/', {'cid': 'timed', 'active': '1'})
+        layers, phases = self.timings('timed')
+        self.assertEqual(layers, ['RecordingMiddleware', 'Handler'])
+        self.assertEqual(
+            phases, ['URL resolution', 'View', 'Response rendering']
+        )
+        stored = cache.get(PHASES_KEY % 'timed')
+        (outer_start, outer_stop), (inner_start, inner_stop) = [
+            timing['d'] for name, timing in stored['middleware_layers']
+        ]
+        self.assertLessEqual(outer_start, inner_start)
+        self.assertLessEqual(inner_stop, outer_stop)
+
+    def test_inactive_requests_store_nothing(self):
+        Client().get('/plain/', {'cid': 'inactive'})
+        self.assertIsNone(cache.get(PHASES_KEY % 'inactive'))
+
+    def test_payload_is_not_written_again(self):
+        with mock.patch.object(
+            ToolbarMetricsContainer, 'write_metrics'
+        ) as write_metrics:
+            Client().get('/plain/', {'cid': 'once', 'active': '1'})
+        write_metrics.assert_not_called()
+
+    def test_timings_are_merged_into_the_payload(self):
+        publish_metrics(cache, 'merged', {'total_time': {'d': (0, 1)}})
+        Client().get('/plain/', {'cid': 'merged', 'active': '1'})
+        metrics = load_metrics(cache, 'merged')
+        self.assertEqual(
+            [name for name, timing in metrics['phases']],
+            ['URL resolution', 'View'],
+        )
+        self.assertEqual(len(metrics['middleware_layers']), 2)
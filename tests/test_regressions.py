@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar import views
+from tikibar.regressions import compare_releases
+
+
+def summary(p50_ms, p95_ms, sql_count, sql_count_p95):
+    return {
+        'count': 100,
+        'p50_ms': p50_ms,
+        'p95_ms': p95_ms,
+        'sql_ms': 1.0,
+        'sql_count': sql_count,
+        'sql_count_p95': sql_count_p95,
+    }
+
+
+@override_settings(TIKIBAR_SETTINGS={})
+class TestCompareReleases(SimpleTestCase):
+
+    def test_slower_p95_is_flagged(self):
+        reasons = compare_releases(
+            summary(50, 100, 3, 3), summary(52, 140, 3, 3)
+        )
+        self.assertEqual(reasons, ['p95 100.0ms -> 140.0ms'])
+
+    def test_small_absolute_changes_are_ignored(self):
+        self.assertEqual(
+            compare_releases(summary(1, 2, 3, 3), summary(2, 4, 3, 3)), []
+        )
+
+    def test_extra_queries_are_flagged_without_latency_change(self):
+        reasons = compare_releases(
+            summary(50, 100, 3, 3), summary(50, 100, 3, 25)
+        )
+        self.assertEqual(reasons, ['p95 queries 3 -> 25'])
+
+
+class TestRegressionsView(SimpleTestCase):
+
+    def test_insecure_requests_are_redirected(self):
+        request = RequestFactory().get('/tikibar/regressions/')
+        response = views.tikibar_regressions(request)
+        self.assertEqual(response.status_code, 301)
+        self.assertTrue(response['Location'].startswith('https://'))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar.context import clear_current_request, set_current_request
+from tikibar.spans import InactiveSpan, span, timed
+from tikibar.toolbar_metrics import ToolbarMetricsContainer
+
+
+@override_settings(TIKIBAR_SETTINGS={'blacklist': []})
+class TestSpans(SimpleTestCase):
+
+    def setUp(self):
+        self.addCleanup(clear_current_request)
+
+    def start_request(self, active=True):
+        request = RequestFactory().get('/')
+        request.correlation_id = 'cid'
+        request.toolbar_metrics = ToolbarMetricsContainer('cid', active)
+        set_current_request(request)
+        return request.toolbar_metrics
+
+    def test_inactive_spans_share_one_stateless_object(self):
+        outer = span('outer', {'user': 1})
+        inner = span('inner')
+        self.assertIs(outer, inner)
+        self.assertIsInstance(outer, InactiveSpan)
+        with self.assertRaises(AttributeError):
+            outer.name = 'changed'
+        self.start_request(active=False)
+        self.assertIs(span('section'), outer)
+
+    def test_spans_nest_with_their_own_names_and_tags(self):
+        toolbar = self.start_request()
+        with span('outer', {'user': 1}):
+            with span('inner'):
+                pass
+        spans = toolbar.metrics['spans']
+        self.assertEqual(
+            [(s['name'], s['tags'], s['parent']) for s in spans],
+            [('outer', {'user': '1'}, None), ('inner', {}, 0)],
+        )
+
+    def test_functions_decorated_while_inactive_record_later(self):
+        @timed('load-events', {'page': 2})
+        def load_events():
+            with span('query'):
+                return 'events'
+
+        toolbar = self.start_request()
+        self.assertEqual(load_events(), 'events')
+        self.assertEqual(
+            [(s['name'], s['tags']) for s in toolbar.metrics['spans']],
+            [('load-events', {'page': '2'}), ('query', {})],
+        )
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.test import SimpleTestCase
+
+from tikibar.sql_utils import fingerprint_sql
+from tikibar.toolbar_metrics import ToolbarMetricsContainer
+
+
+class TestFingerprintSQL(SimpleTestCase):
+
+    def test_literals_are_collapsed(self):
+        _, fingerprint = fingerprint_sql(
+            "SELECT \"t1\".\"id\" FROM \"t1\" "
+            "WHERE name = 'it''s' AND age > 21 LIMIT 10"
+        )
+        self.assertEqual(
+            fingerprint,
+            'SELECT "t1"."id" FROM "t1" WHERE name = ? AND age > ? LIMIT ?'
+        )
+
+    def test_in_lists_are_collapsed(self):
+        short = fingerprint_sql('SELECT * FROM a WHERE id IN (%s, %s)')
+        long = fingerprint_sql('SELECT * FROM a WHERE id IN (%s, %s, %s, %s)')
+        self.assertEqual(short, long)
+        self.assertEqual(short[1], 'SELECT * FROM a WHERE id IN (...)')
+
+    def test_multi_row_values_are_collapsed(self):
+        _, fingerprint = fingerprint_sql(
+            'INSERT INTO a (x, y) VALUES (%s, %s), (%s, %s)'
+        )
+        self.assertEqual(fingerprint, 'INSERT INTO a (x, y) VALUES (...)')
+
+
+class TestSQLFingerprintStats(SimpleTestCase):
+
+    def test_stats_are_aggregated_per_fingerprint(self):
+        toolbar = ToolbarMetricsContainer('cid')
+        sql = 'SELECT * FROM a WHERE id = %s'
+        toolbar.add_sql_query_metric('SQL', sql, 1.0, 1.5, params=(1,))
+        toolbar.add_sql_query_metric('SQL', sql, 2.0, 2.25, params=(2,))
+        toolbar.add_sql_query_metric('SQL', sql, 3.0, 3.25, params=(2,))
+
+        fingerprint_id, _ = fingerprint_sql(sql)
+        stats = toolbar.metrics['sql_fingerprints'][fingerprint_id]
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['distinct'], 2)
+        self.assertEqual(stats['total'], 1.0)
+        self.assertEqual(stats['max'], 0.5)
+        self.assertEqual(stats['first'], 1.0)
+        self.assertEqual(stats['last'], 3.0)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from tikibar.core import MetricsContainer
+from tikibar.context import clear_current_request
+from tikibar.template_backend import TikibarDjangoTemplates
+from tikibar.toolbar_metrics import get_toolbar
+
+
+TEMPLATES = {
+    'base.html': '<body>{% block content %}{% endblock %}</body>',
+    'page.html': (
+        "{% extends 'base.html' %}"
+        "{% block content %}"
+        "{% include 'item.html' %}{% include 'item.html' %}"
+        "{% endblock %}"
+    ),
+    'item.html': '<p>item</p>',
+}
+
+
+def make_backend(cached=False):
+    loaders = [('django.template.loaders.locmem.Loader', TEMPLATES)]
+    if cached:
+        loaders = [('django.template.loaders.cached.Loader', loaders)]
+    return TikibarDjangoTemplates({
+        'NAME': 'tikibar-tests',
+        'DIRS': [],
+        'APP_DIRS': False,
+        'OPTIONS': {'loaders': loaders},
+    })
+
+
+def shape(nodes):
+    return [
+        (node['name'], node['kind'], shape(node['children'])) for node in nodes
+    ]
+
+
+@override_settings(TIKIBAR_SETTINGS={})
+class TestRenderTree(SimpleTestCase):
+
+    def setUp(self):
+        self.toolbar = MetricsContainer('cid')
+        patcher = mock.patch(
+            'tikibar.template_backend.get_toolbar', return_value=self.toolbar
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_extends_blocks_and_includes_nest(self):
+        html = make_backend().get_template('page.html').render({})
+        self.assertEqual(html, '<body><p>item</p><p>item</p></body>')
+        self.assertEqual(shape(self.toolbar.metrics['template_tree']), [
+            ('page.html', 'template', [
+                ('base.html', 'extends', [
+                    ('content', 'block', [
+                        ('item.html', 'include', []),
+                        ('item.html', 'include', []),
+                    ]),
+                ]),
+            ]),
+        ])
+        root = self.toolbar.metrics['template_tree'][0]
+        start, stop = root['timing']['d']
+        self.assertLessEqual(start, stop)
+
+    def test_nodes_over_the_cap_are_counted_not_recorded(self):
+        backend = make_backend()
+        backend.max_tree_nodes = 2
+        backend.get_template('page.html').render({})
+        self.assertEqual(shape(self.toolbar.metrics['template_tree']), [
+            ('page.html', 'template', [('base.html', 'extends', [])]),
+        ])
+        self.assertEqual(self.toolbar.metrics['template_tree_dropped'], 3)
+
+    def test_inactive_requests_are_not_recorded(self):
+        self.toolbar._is_active = False
+        make_backend().get_template('page.html').render({})
+        self.assertNotIn('template_tree', self.toolbar.metrics)
+
+    def test_cached_loader_lookups_are_counted(self):
+        backend = make_backend(cached=True)
+        backend.get_template('page.html').render({})
+        misses = self.toolbar.metrics['template_cache']['misses']
+        hits = self.toolbar.metrics['template_cache']['hits']
+        self.assertGreater(misses, 0)
+        backend.get_template('page.html').render({})
+        self.assertEqual(
+            self.toolbar.metrics['template_cache']['misses'], misses
+        )
+        self.assertGreater(
+            self.toolbar.metrics['template_cache']['hits'], hits
+        )
+
+
+@override_settings(TIKIBAR_SETTINGS={})
+class TestOutsideRequests(SimpleTestCase):
+
+    def test_one_inactive_toolbar_is_shared_and_left_empty(self):
+        clear_current_request()
+        toolbar = get_toolbar()
+        self.assertIs(get_toolbar(), toolbar)
+        self.assertFalse(toolbar.is_active())
+        make_backend(cached=True).get_template('page.html').render({})
+        self.assertNotIn('templates', toolbar.metrics)
+        self.assertEqual(
+            toolbar.metrics['template_cache'], {'hits': 0, 'misses': 0}
+        )
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from tikibar.context import (
+    clear_current_request,
+    get_current_request,
+    set_current_request,
+)
+from tikibar.spans import span
+from tikibar.threads import TikibarThreadPoolExecutor, propagate
+from tikibar.tiki_logger import TikiLogHandler
+from tikibar.toolbar_metrics import ToolbarMetricsContainer
+
+
+logger = logging.getLogger('tikibar.tests.threads')
+
+
+def start_request(correlation_id, active=True):
+    request = RequestFactory().get('/')
+    request.correlation_id = correlation_id
+    request.toolbar_metrics = ToolbarMetricsContainer(correlation_id, active)
+    set_current_request(request)
+    return request.toolbar_metrics
+
+
+@override_settings(TIKIBAR_SETTINGS={'blacklist': []})
+class TestThreads(SimpleTestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        handler = TikiLogHandler()
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(clear_current_request)
+
+    def run_on_thread(self, func):
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+        return thread.ident
+
+    def test_functions_are_unchanged_without_an_active_request(self):
+        def task():
+            pass
+
+        self.assertIs(propagate(task), task)
+        start_request('inactive', active=False)
+        self.assertIs(propagate(task), task)
+
+    def test_calls_record_into_the_request_under_the_open_span(self):
+        toolbar = start_request('cid')
+
+        def task():
+            with span('task'):
+                logger.info('from the task')
+
+        with span('outer'):
+            task = propagate(task)
+        worker = self.run_on_thread(task)
+        self.assertIsNotNone(get_current_request())
+        spans = toolbar.metrics['spans']
+        self.assertEqual(
+            [(s['name'], s['parent'], s['thread']) for s in spans],
+            [
+                ('outer', None, toolbar.metrics['request_thread']),
+                ('task', 0, worker),
+            ],
+        )
+        toolbar.format_log_records()
+        [(level, message, name, created, thread)] = toolbar.metrics['loglines']
+        self.assertEqual((message, thread), ('from the task', worker))
+
+    def test_executor_credits_each_task_to_its_own_request(self):
+        executor = TikibarThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        # Both requests' tasks have to be running at once to get past this
+        both_running = threading.Barrier(2, timeout=10)
+        toolbars = {}
+
+        def task(correlation_id):
+            both_running.wait()
+            with span(correlation_id):
+                logger.info(correlation_id)
+
+        def handle_request(correlation_id):
+            toolbars[correlation_id] = start_request(correlation_id)
+            try:
+                executor.submit(task, correlation_id).result()
+            finally:
+                clear_current_request()
+
+        requests = [
+            threading.Thread(target=handle_request, args=(cid,))
+            for cid in ('first', 'second')
+        ]
+        for request in requests:
+            request.start()
+        for request in requests:
+            request.join()
+        for correlation_id, toolbar in toolbars.items():
+            toolbar.format_log_records()
+            self.assertEqual(
+                [s['name'] for s in toolbar.metrics['spans']], [correlation_id]
+            )
+            self.assertEqual(
+                [line[1] for line in toolbar.metrics['loglines']],
+                [correlation_id],
+            )
+            [line] = toolbar.metrics['loglines']
+            level, message, name, created, thread = line
+            self.assertEqual(thread, toolbar.metrics['spans'][0]['thread'])
+            self.assertNotEqual(thread, toolbar.metrics['request_thread'])
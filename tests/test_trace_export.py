@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.test import SimpleTestCase
+
+from tikibar.core import MemoryStorage, MetricsContainer
+from tikibar.trace_export import chrome_trace, otlp_spans
+
+
+def payload():
+    return {
+        'total_time': {'d': (100.0, 100.5)},
+        'request_path': '/events/',
+        'request_thread': 7,
+        'queries': {
+            'SQL': [
+                (
+                    'default',
+                    'SELECT 1',
+                    True,
+                    {'d': (100.1, 100.2)},
+                    ('app/views.py', 10, 'index'),
+                    8,
+                )
+            ],
+        },
+        'spans': [
+            {
+                'name': 'outer',
+                'tags': {},
+                'parent': None,
+                'thread': 7,
+                'timing': {'d': (100.0, 100.4)},
+            },
+            {
+                'name': 'inner',
+                'tags': {'n': '1'},
+                'parent': 0,
+                'thread': 7,
+                'timing': {'d': (100.1, 100.3)},
+            },
+        ],
+        'template_tree': [
+            {
+                'name': 'page.html',
+                'kind': 'template',
+                'timing': {'d': (100.3, 100.4)},
+                'children': [
+                    {
+                        'name': 'item.html',
+                        'kind': 'include',
+                        'timing': {'d': (100.31, 100.32)},
+                        'children': [],
+                    }
+                ],
+            }
+        ],
+        'loglines': [('WARNING', 'careful', 'events', 100.2, 8)],
+    }
+
+
+def oversized_payload():
+    """payload() as written when it doesn't fit, with its logs summarized."""
+    toolbar = MetricsContainer('abc', storage=MemoryStorage())
+    toolbar.metrics.update(payload())
+    toolbar.max_size = 100
+    toolbar.write_metrics()
+    return toolbar.metrics
+
+
+def export_spans(metrics):
+    """The spans otlp_spans gives for a payload, under trace id abc."""
+    trace = otlp_spans(metrics, 'abc')
+    return trace['resourceSpans'][0]['scopeSpans'][0]['spans']
+
+
+class TestChromeTrace(SimpleTestCase):
+
+    def test_events_are_in_microseconds_on_their_threads(self):
+        events = chrome_trace(payload(), 'abc')['traceEvents']
+        query = [event for event in events if event.get('cat') == 'SQL'][0]
+        self.assertAlmostEqual(query['ts'], 100.1e6)
+        self.assertAlmostEqual(query['dur'], 0.1e6, places=0)
+        self.assertEqual(query['tid'], 8)
+        self.assertEqual(
+            query['args']['call_site'], 'app/views.py:10 in index'
+        )
+        names = {
+            event['args']['name']
+            for event in events
+            if event['name'] == 'thread_name'
+        }
+        self.assertEqual(names, {'main', 'thread 1'})
+        [log] = [event for event in events if event['ph'] == 'i']
+        self.assertEqual((log['name'], log['tid']), ('careful', 8))
+
+    def test_truncated_logs_are_exported(self):
+        events = chrome_trace(oversized_payload(), 'abc')['traceEvents']
+        [log] = [event for event in events if event['ph'] == 'i']
+        self.assertEqual(log['name'], 'Logs too big for memcached')
+        self.assertAlmostEqual(log['ts'], 100.0e6)
+
+
+class TestOTLPSpans(SimpleTestCase):
+
+    def test_spans_keep_their_nesting(self):
+        spans = export_spans(payload())
+        by_name = {span['name']: span for span in spans}
+        self.assertEqual(
+            by_name['inner']['parentSpanId'], by_name['outer']['spanId']
+        )
+        self.assertEqual(
+            by_name['item.html']['parentSpanId'],
+            by_name['page.html']['spanId'],
+        )
+        self.assertEqual(
+            by_name['SELECT 1']['parentSpanId'], by_name['/events/']['spanId']
+        )
+        self.assertEqual(
+            by_name['/events/']['startTimeUnixNano'], '100000000000'
+        )
+        self.assertEqual(by_name['/events/']['events'][0]['name'], 'careful')
+        self.assertEqual({span['traceId'] for span in spans}, {'abc'})
+
+    def test_truncated_logs_are_exported(self):
+        spans = export_spans(oversized_payload())
+        [event] = spans[0]['events']
+        self.assertEqual(event['name'], 'Logs too big for memcached')
+        self.assertEqual(event['timeUnixNano'], '100000000000')
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import functools
+import os
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from django.views.generic import View
+
+from tikibar import toolbar_metrics
+from tikibar.toolbar_metrics import describe_view
+
+
+def event_detail(request, event_id, page=1):
+    pass
+
+
+class EventList(View):
+    def get(self, request):
+        pass
+
+
+@override_settings(
+    TIKIBAR_SETTINGS={
+        'filepath': os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    }
+)
+class TestDescribeView(SimpleTestCase):
+
+    def setUp(self):
+        toolbar_metrics._view_descriptions.clear()
+
+    def test_function_signature(self):
+        view, filepath = describe_view(event_detail)
+        self.assertEqual(view, 'event_detail(request, event_id, page=1)')
+        self.assertEqual(filepath, 'tests/test_view_descriptions.py')
+
+    def test_class_based_views_share_one_entry(self):
+        first = describe_view(EventList.as_view())
+        second = describe_view(EventList.as_view(http_method_names=['get']))
+        self.assertEqual(first[0], 'EventList(request, *args, **kwargs)')
+        self.assertEqual(first, second)
+        self.assertEqual(list(toolbar_metrics._view_descriptions), [EventList])
+
+    def test_partials_are_described_as_the_view_they_wrap(self):
+        for view_func in (
+            functools.partial(event_detail, page=2),
+            functools.partial(event_detail, page=3),
+            functools.partial(functools.partial(event_detail, None), 1),
+        ):
+            view, filepath = describe_view(view_func)
+            self.assertEqual(view, 'event_detail(request, event_id, page=1)')
+        self.assertEqual(
+            list(toolbar_metrics._view_descriptions), [event_detail]
+        )
+        self.assertEqual(
+            describe_view(event_detail)[0],
+            'event_detail(request, event_id, page=1)',
+        )
+
+    def test_cache_is_bounded(self):
+        for index in range(toolbar_metrics.VIEW_CACHE_SIZE + 5):
+            describe_view(lambda request: None)
+        self.assertEqual(
+            len(toolbar_metrics._view_descriptions),
+            toolbar_metrics.VIEW_CACHE_SIZE,
+        )
+
+    def test_least_recently_used_views_are_dropped(self):
+        with mock.patch.object(
+            toolbar_metrics,
+            '_describe_view',
+            wraps=toolbar_metrics._describe_view,
+        ) as described:
+            describe_view(event_detail)
+            for index in range(toolbar_metrics.VIEW_CACHE_SIZE + 5):
+                describe_view(lambda request: None)
+                # Seen on every request, so it's never the one dropped
+                describe_view(event_detail)
+        self.assertEqual(
+            [
+                call
+                for call in described.call_args_list
+                if call.args == (event_detail,)
+            ],
+            [
+                mock.call(event_detail),
+            ],
+        )
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+
+from django.core.signing import TimestampSigner
+from django.test import SimpleTestCase
+
+from tikibar.asgi import TikibarASGIMiddleware
+from tikibar.core import (
+    MemoryStorage,
+    Recorder,
+    SignedCookieVerifier,
+    get_current_toolbar,
+)
+from tikibar.wsgi import TikibarWSGIMiddleware
+
+
+PAGE = b'<html><head></head><body>Hello</body></html>'
+
+
+def wsgi_app(environ, start_response):
+    toolbar = get_current_toolbar()
+    if toolbar is not None:
+        toolbar.add_timed_metric('templates', 'page.html', 0, 1)
+    start_response(
+        '200 OK',
+        [('Content-Type', 'text/html'), ('Content-Length', str(len(PAGE)))],
+    )
+    return [PAGE]
+
+
+async def asgi_app(scope, receive, send):
+    await send(
+        {
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/html')],
+        }
+    )
+    await send({'type': 'http.response.body', 'body': PAGE})
+
+
+def verify_token(cookies):
+    return cookies.get('token', False)
+
+
+class TestWSGIMiddleware(SimpleTestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.app = TikibarWSGIMiddleware(
+            wsgi_app, Recorder(self.storage, verify_token)
+        )
+
+    def call(self, cookie=''):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = dict(headers)
+
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/page',
+            'QUERY_STRING': 'a=1',
+            'HTTP_COOKIE': cookie,
+        }
+        response['body'] = b''.join(self.app(environ, start_response))
+        return response
+
+    def test_requests_without_a_token_are_untouched(self):
+        response = self.call()
+        self.assertEqual(response['body'], PAGE)
+        self.assertNotIn('X-Correlation-ID', response['headers'])
+
+    def test_recorded_request_is_published(self):
+        response = self.call('token=abc')
+        correlation_id = response['headers']['X-Correlation-ID']
+        self.assertIn(
+            b'<meta name="correlation_id" value="%s">'
+            % correlation_id.encode(),
+            response['body'],
+        )
+        self.assertEqual(
+            int(response['headers']['Content-Length']), len(response['body'])
+        )
+        metrics = self.storage.get('tikibar:%s' % correlation_id)
+        self.assertEqual(metrics['request_path'], '/page?a=1')
+        self.assertEqual(metrics['templates'], [('page.html', {'d': (0, 1)})])
+        summary = self.storage.get('tikibar:summary:%s' % correlation_id)
+        self.assertEqual((summary['status'], summary['queries']), (200, 0))
+        history = json.loads(self.storage.get('tikibar:history:abc'))
+        self.assertEqual([entry['c'] for entry in history], [correlation_id])
+
+
+class TestASGIMiddleware(SimpleTestCase):
+
+    def test_recorded_request_is_published(self):
+        storage = MemoryStorage()
+        app = TikibarASGIMiddleware(asgi_app, Recorder(storage, verify_token))
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/',
+            'headers': [(b'cookie', b'token=abc')],
+        }
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(app(scope, None, send))
+        headers = dict(messages[0]['headers'])
+        self.assertIn(b'window.TIKI_PROTOCOL', messages[1]['body'])
+        self.assertIsNotNone(
+            storage.get('tikibar:%s' % headers[b'X-Correlation-ID'].decode())
+        )
+
+
+class TestSignedCookieVerifier(SimpleTestCase):
+
+    def test_reads_django_signed_cookies(self):
+        # What HttpResponse.set_signed_cookie would use with
+        # SECRET_KEY = 'secret'
+        signer = TimestampSigner(
+            'django.http.cookies' + 'secret',
+            salt='tikibar_active',
+            algorithm='sha256',
+        )
+        verify = SignedCookieVerifier('secret')
+        signed = signer.sign('abc')
+        self.assertEqual(verify({'tikibar_active': signed}), 'abc')
+        self.assertFalse(verify({'tikibar_active': signed[:-1] + 'x'}))
+        self.assertFalse(verify({'tikibar_active': signer.sign('disabled')}))
+        self.assertFalse(
+            SignedCookieVerifier('other')({'tikibar_active': signed})
+        )
@@ -1 +1,18 @@
 from tikibar.version import __version__, __version_info__  # noqa
+
+# Public helpers, imported lazily so that importing tikibar (e.g. from
+# setup.py) doesn't require Django to be configured
+_lazy_attributes = {
+    'span': 'tikibar.spans',
+    'timed': 'tikibar.spans',
+    'propagate': 'tikibar.threads',
+}
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        import importlib
+        value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module 'tikibar' has no attribute %r" % name)
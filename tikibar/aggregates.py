@@ -0,0 +1,284 @@
+import atexit
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .core import summarize_metrics
+
+
+# Each power of two is split into this many linear buckets, so any value
+# is placed within 1/SUB_BUCKETS (about 6%) of its true size
+SUB_BUCKETS = 16
+
+DEFAULT_WINDOW = 5 * 60
+DEFAULT_FLUSH_INTERVAL = 10
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_RETENTION = 7 * 24 * 60 * 60
+
+CACHE_KEY_PREFIX = 'tikibar:aggregates:'
+
+# Requests that didn't resolve to a view are lumped together, rather than
+# creating an aggregate per 404ing path
+UNRESOLVED = '<unresolved>'
+
+
+def bucket_for(value):
+    """Log-linear bucket index for a non-negative value."""
+    if value < 1:
+        return int(value * SUB_BUCKETS)
+    mantissa, exponent = math.frexp(value)
+    return exponent * SUB_BUCKETS + int((mantissa * 2 - 1) * SUB_BUCKETS)
+
+
+def bucket_bounds(index):
+    if index < SUB_BUCKETS:
+        return index / SUB_BUCKETS, (index + 1) / SUB_BUCKETS
+    exponent, sub_bucket = divmod(index, SUB_BUCKETS)
+    base = 2.0 ** (exponent - 1)
+    return (
+        base * (1 + sub_bucket / SUB_BUCKETS),
+        base * (1 + (sub_bucket + 1) / SUB_BUCKETS),
+    )
+
+
+class Histogram:
+    """
+    A mergeable histogram with log-linear buckets. Merging two histograms
+    gives the same result as recording both sets of values into one, so
+    they can be combined across processes, time windows and releases.
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def record(self, value):
+        value = max(value, 0.0)
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = bucket_for(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        """Estimate a percentile (0-100) as the middle of its bucket."""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * percent / 100.0))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                low, high = bucket_bounds(bucket)
+                return min(max((low + high) / 2, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'buckets': self.buckets,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        histogram.buckets = dict(data['buckets'])
+        return histogram
+
+
+class ViewAggregate:
+    """Histograms of the cost of recorded requests to one view and release."""
+    FIELDS = ('total_ms', 'sql_ms', 'sql_count', 'template_ms', 'cpu_ms')
+
+    def __init__(self, histograms=None):
+        self.histograms = histograms or {
+            field: Histogram() for field in self.FIELDS
+        }
+
+    def record(self, sample):
+        for field in self.FIELDS:
+            self.histograms[field].record(sample[field])
+
+    def merge(self, other):
+        for field in self.FIELDS:
+            self.histograms[field].merge(other.histograms[field])
+
+    @property
+    def count(self):
+        return self.histograms['total_ms'].count
+
+    def sql_share(self):
+        """Fraction of all the time spent in these requests that was SQL."""
+        total = self.histograms['total_ms'].total
+        return self.histograms['sql_ms'].total / total if total else None
+
+    def to_dict(self):
+        return {
+            field: self.histograms[field].to_dict() for field in self.FIELDS
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            {field: Histogram.from_dict(data[field]) for field in cls.FIELDS}
+        )
+
+
+def view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else UNRESOLVED
+
+
+class Aggregator:
+    """
+    Collects ViewAggregates in memory, per time window, view and release,
+    and merges them into the cache in batches. Recording a request costs a
+    handful of dictionary updates; the cache is only touched when a batch
+    is flushed, by whichever request fills it.
+
+    Flushing reads, merges and writes each window's entry, so two processes
+    flushing the same window at once can lose a batch, much like the
+    per-token history.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_requests = 0
+        self._last_flush = time.time()
+
+    def record(self, view, release, sample, now=None):
+        tikibar_settings = settings.TIKIBAR_SETTINGS
+        now = time.time() if now is None else now
+        window = tikibar_settings.get('aggregate_window', DEFAULT_WINDOW)
+        key = (int(now // window * window), view, release)
+        with self._lock:
+            aggregate = self._pending.get(key)
+            if aggregate is None:
+                aggregate = self._pending[key] = ViewAggregate()
+            aggregate.record(sample)
+            self._pending_requests += 1
+            batch_size = tikibar_settings.get(
+                'aggregate_batch_size', DEFAULT_BATCH_SIZE
+            )
+            flush_interval = tikibar_settings.get(
+                'aggregate_flush_interval', DEFAULT_FLUSH_INTERVAL
+            )
+            due = (
+                self._pending_requests >= batch_size
+                or now - self._last_flush >= flush_interval
+            )
+            if not due:
+                return
+            batch = self._take_batch(now)
+        self._write(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take_batch(time.time())
+        self._write(batch)
+
+    def _take_batch(self, now):
+        batch, self._pending = self._pending, {}
+        self._pending_requests = 0
+        self._last_flush = now
+        return batch
+
+    def _write(self, batch):
+        if not batch:
+            return
+        by_window = {}
+        for (window_start, view, release), aggregate in batch.items():
+            by_window.setdefault(window_start, {})[(view, release)] = aggregate
+        retention = settings.TIKIBAR_SETTINGS.get(
+            'aggregate_retention', DEFAULT_RETENTION
+        )
+        for window_start, aggregates in by_window.items():
+            cache_key = CACHE_KEY_PREFIX + str(window_start)
+            stored = cache.get(cache_key) or {}
+            for key, aggregate in aggregates.items():
+                if key in stored:
+                    aggregate.merge(ViewAggregate.from_dict(stored[key]))
+                stored[key] = aggregate.to_dict()
+            cache.set(cache_key, stored, retention)
+
+
+aggregator = Aggregator()
+atexit.register(aggregator.flush)
+
+
+def record_request(request, metrics):
+    """Add a finished request's metrics to the aggregates."""
+    aggregator.record(
+        view_label(request),
+        getattr(settings, 'RELEASE', 'master'),
+        summarize_metrics(metrics),
+    )
+
+
+def load_windows(since, until=None):
+    """Stored aggregates for windows starting from `since`, oldest first.
+
+    Returns a list of (window start, {(view, release): ViewAggregate}).
+    """
+    until = time.time() if until is None else until
+    window = settings.TIKIBAR_SETTINGS.get('aggregate_window', DEFAULT_WINDOW)
+    starts = range(int(since // window * window), int(until) + 1, window)
+    stored = cache.get_many(
+        [CACHE_KEY_PREFIX + str(start) for start in starts]
+    )
+    windows = []
+    for start in starts:
+        aggregates = stored.get(CACHE_KEY_PREFIX + str(start))
+        if aggregates:
+            windows.append(
+                (
+                    start,
+                    {
+                        key: ViewAggregate.from_dict(data)
+                        for key, data in aggregates.items()
+                    },
+                )
+            )
+    return windows
+
+
+def load_aggregates(since, until=None):
+    """Stored aggregates from `since` onwards, merged per (view, release)."""
+    merged = {}
+    for start, aggregates in load_windows(since, until):
+        for key, aggregate in aggregates.items():
+            if key in merged:
+                merged[key].merge(aggregate)
+            else:
+                merged[key] = aggregate
+    return merged
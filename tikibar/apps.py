@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class TikibarConfig(AppConfig):
+    name = 'tikibar'
+
+    def ready(self):
+        if getattr(settings, 'TIKIBAR_SETTINGS', {}).get('time_middleware'):
+            from .phases import install_phase_hooks
+            install_phase_hooks()
+        if getattr(settings, 'TIKIBAR_SETTINGS', {}).get('instrument_gc'):
+            from .gc_metrics import install_gc_hooks
+            install_gc_hooks()
@@ -0,0 +1,67 @@
+from .core import parse_cookies
+
+
+class TikibarASGIMiddleware:
+    """
+    Records requests to an ASGI application with the tikibar turned on,
+    using a tikibar.core.Recorder:
+
+        recorder = Recorder(storage, SignedCookieVerifier(SECRET_KEY))
+        app = TikibarASGIMiddleware(app, recorder)
+
+    Other requests, and anything that isn't HTTP, are passed straight
+    through. Recorded responses are buffered so the tikibar can be added
+    to HTML pages.
+    """
+    def __init__(self, app, recorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get('headers', ()))
+        path = scope.get('root_path', '') + scope['path']
+        full_path = path
+        if scope.get('query_string'):
+            full_path += '?' + scope['query_string'].decode('latin1')
+        recording = self.recorder.start(
+            scope.get('method', 'GET'),
+            scope['path'],
+            full_path,
+            parse_cookies(headers.get(b'cookie', b'').decode('latin1')),
+            scope.get('scheme') == 'https',
+        )
+        if recording is None:
+            return await self.app(scope, receive, send)
+
+        start = {}
+        chunks = []
+
+        async def buffering_send(message):
+            if message['type'] == 'http.response.start':
+                start.update(message)
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+            else:
+                await send(message)
+
+        try:
+            await self.app(scope, receive, buffering_send)
+        except BaseException:
+            recording.finish(500, [])
+            raise
+        response_headers, body = recording.finish(
+            start['status'],
+            [
+                (name.decode('latin1'), value.decode('latin1'))
+                for name, value in start.get('headers', ())
+            ],
+            b''.join(chunks),
+        )
+        start['headers'] = [
+            (name.encode('latin1'), value.encode('latin1'))
+            for name, value in response_headers
+        ]
+        await send(start)
+        await send({'type': 'http.response.body', 'body': body})
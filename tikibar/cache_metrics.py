@@ -0,0 +1,143 @@
+import contextlib
+import pickle
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# Tikibar's own reads and writes (payloads, history) are not recorded
+TIKIBAR_KEY_PREFIX = 'tikibar:'
+
+_MISSING = object()
+
+CACHE_METHODS = ('get', 'get_many', 'set', 'delete')
+
+
+def _payload_size(value):
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+def _describe_keys(keys, limit=5):
+    keys = list(keys)
+    description = ', '.join(str(key) for key in keys[:limit])
+    if len(keys) > limit:
+        description += ', ... (%d keys)' % len(keys)
+    return description
+
+
+class CacheRecorder:
+    """Timed replacements for one cache backend's methods.
+
+    Backends often implement one operation in terms of another (get_many
+    calling get), so only the outermost call is recorded.
+    """
+    def __init__(self, toolbar, alias, backend):
+        self.toolbar = toolbar
+        self.alias = alias
+        self.backend = backend
+        self.originals = {
+            name: getattr(backend, name) for name in CACHE_METHODS
+        }
+        self.busy = False
+
+    def install(self):
+        for name in CACHE_METHODS:
+            setattr(self.backend, name, getattr(self, name))
+
+    def uninstall(self):
+        for name in CACHE_METHODS:
+            delattr(self.backend, name)
+
+    def _skip(self, key):
+        return self.busy or str(key).startswith(TIKIBAR_KEY_PREFIX)
+
+    def _bypass(self, name, *args, **kwargs):
+        """Call the original without recording it, or anything it calls."""
+        busy, self.busy = self.busy, True
+        try:
+            return self.originals[name](*args, **kwargs)
+        finally:
+            self.busy = busy
+
+    def _call(self, name, *args, **kwargs):
+        self.busy = True
+        try:
+            start = time.time()
+            result = self.originals[name](*args, **kwargs)
+            return result, start, time.time()
+        finally:
+            self.busy = False
+
+    def _record(self, description, start, stop):
+        self.toolbar.add_query_metric(
+            'Cache', self.alias, description, start, stop
+        )
+
+    def get(self, key, default=None, version=None):
+        if self._skip(key):
+            return self._bypass('get', key, default, version)
+        value, start, stop = self._call('get', key, _MISSING, version)
+        if value is _MISSING:
+            self._record('GET %s (miss)' % key, start, stop)
+            return default
+        self._record(
+            'GET %s (hit, %d bytes)' % (key, _payload_size(value)), start, stop
+        )
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        # load_metrics fetches tikibar's keys in batches
+        if not keys or any(self._skip(key) for key in keys):
+            return self._bypass('get_many', keys, version)
+        values, start, stop = self._call('get_many', keys, version)
+        self._record('GET_MANY %s (%d hits, %d misses, %d bytes)' % (
+            _describe_keys(keys),
+            len(values),
+            len(keys) - len(values),
+            sum(_payload_size(value) for value in values.values()),
+        ), start, stop)
+        return values
+
+    def set(self, key, value, *args, **kwargs):
+        if self._skip(key):
+            return self._bypass('set', key, value, *args, **kwargs)
+        result, start, stop = self._call('set', key, value, *args, **kwargs)
+        self._record(
+            'SET %s (%d bytes)' % (key, _payload_size(value)), start, stop
+        )
+        return result
+
+    def delete(self, key, *args, **kwargs):
+        if self._skip(key):
+            return self._bypass('delete', key, *args, **kwargs)
+        result, start, stop = self._call('delete', key, *args, **kwargs)
+        self._record('DELETE %s' % key, start, stop)
+        return result
+
+
+@contextlib.contextmanager
+def instrument_caches(toolbar):
+    """Record cache traffic on every configured cache into `toolbar`.
+
+    Only the current thread's backend instances are touched, and only for
+    as long as the context is open, so requests that aren't being recorded
+    never go through these wrappers.
+    """
+    recorders = [
+        CacheRecorder(toolbar, alias, caches[alias])
+        for alias in settings.CACHES
+    ]
+    for recorder in recorders:
+        recorder.install()
+    try:
+        yield
+    finally:
+        for recorder in recorders:
+            recorder.uninstall()
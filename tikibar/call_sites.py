@@ -0,0 +1,97 @@
+import os
+import site
+import sys
+import sysconfig
+
+import django
+from django.conf import settings
+
+import tikibar
+
+
+DEFAULT_MAX_DEPTH = 40
+
+# Cap on the per-code-object and interning caches, so long-running processes
+# that exec() code don't grow them without bound
+MAX_CACHE_SIZE = 10000
+
+
+def _library_paths():
+    paths = [
+        os.path.dirname(django.__file__),
+        os.path.dirname(tikibar.__file__),
+        sysconfig.get_paths()['stdlib'],
+        sysconfig.get_paths()['purelib'],
+        sysconfig.get_paths()['platlib'],
+    ]
+    try:
+        paths.extend(site.getsitepackages())
+        paths.append(site.getusersitepackages())
+    except AttributeError:
+        # virtualenv's site.py doesn't have these
+        pass
+    return tuple(set(os.path.realpath(path) + os.sep for path in paths))
+
+
+_library_path_prefixes = None
+
+# code object -> None for library code, else (relative filepath, function name)
+_code_cache = {}
+
+# (filepath, line, function) -> the same tuple, so every query from one line
+# shares a single object
+_interned_call_sites = {}
+
+
+def _describe_code(code):
+    global _library_path_prefixes
+    if _library_path_prefixes is None:
+        _library_path_prefixes = _library_paths()
+
+    filename = code.co_filename
+    if filename.startswith('<'):
+        return None
+    filename = os.path.realpath(filename)
+    if filename.startswith(_library_path_prefixes):
+        return None
+
+    codebase = settings.TIKIBAR_SETTINGS.get('filepath')
+    if codebase:
+        codebase = os.path.realpath(codebase) + os.sep
+        if filename.startswith(codebase):
+            filename = filename[len(codebase):]
+    return filename, code.co_name
+
+
+def get_call_site(frame, max_depth=DEFAULT_MAX_DEPTH):
+    """Return the first application (file, line, function) above `frame`.
+
+    Frames in Django, tikibar, the standard library and site-packages are
+    skipped. Returns None if no application frame is found within
+    `max_depth` frames.
+    """
+    depth = 0
+    while frame is not None and depth < max_depth:
+        code = frame.f_code
+        try:
+            description = _code_cache[code]
+        except KeyError:
+            if len(_code_cache) > MAX_CACHE_SIZE:
+                _code_cache.clear()
+            description = _code_cache[code] = _describe_code(code)
+        if description is not None:
+            call_site = (description[0], frame.f_lineno, description[1])
+            interned = _interned_call_sites.get(call_site)
+            if interned is None:
+                if len(_interned_call_sites) > MAX_CACHE_SIZE:
+                    _interned_call_sites.clear()
+                interned = _interned_call_sites[call_site] = call_site
+            return interned
+        frame = frame.f_back
+        depth += 1
+    return None
+
+
+def current_call_site(max_depth=DEFAULT_MAX_DEPTH):
+    """Return the first application frame above the caller."""
+    return get_call_site(sys._getframe(1), max_depth)
@@ -0,0 +1,67 @@
+import json
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .utils import TIKIBAR_DATA_STORAGE_TIMEOUT
+
+
+CAPTURE_INDEX_KEY = 'tikibar:captured'
+DEFAULT_INDEX_SIZE = 100
+
+SAMPLED = 'sampled'
+TAIL = 'tail'
+
+
+def capture_mode_for_request():
+    """How to capture a request that doesn't have the tikibar turned on.
+
+    Returns SAMPLED for the TIKIBAR_SETTINGS['sample_rate'] fraction of
+    requests, which are always published, TAIL when a 'tail_threshold' is
+    set, for requests that are only published if they turn out slow or
+    fail, or None to leave the request alone.
+    """
+    tikibar_settings = settings.TIKIBAR_SETTINGS
+    sample_rate = tikibar_settings.get('sample_rate')
+    if sample_rate and random.random() < sample_rate:
+        return SAMPLED
+    if tikibar_settings.get('tail_threshold') is not None:
+        return TAIL
+    return None
+
+
+def capture_reason(mode, duration, status_code):
+    """Why a captured request should be published, or None to drop it."""
+    threshold = settings.TIKIBAR_SETTINGS.get('tail_threshold')
+    if threshold is not None:
+        if duration * 1000 >= threshold:
+            return 'slow'
+        if status_code >= 500:
+            return 'error'
+    if mode == SAMPLED:
+        return SAMPLED
+    return None
+
+
+def add_to_capture_index(entry):
+    """Add a published capture to the index shown by the captured view.
+
+    Like the per-token history this has a race between concurrent
+    requests, which can lose the odd entry.
+    """
+    index = json.loads(cache.get(CAPTURE_INDEX_KEY) or '[]')
+    index.append(entry)
+    size = settings.TIKIBAR_SETTINGS.get(
+        'capture_index_size', DEFAULT_INDEX_SIZE
+    )
+    index = index[-size:]
+    cache.set(
+        CAPTURE_INDEX_KEY, json.dumps(index), TIKIBAR_DATA_STORAGE_TIMEOUT
+    )
+
+
+def get_capture_index():
+    index = json.loads(cache.get(CAPTURE_INDEX_KEY) or '[]')
+    index.reverse()
+    return index
@@ -0,0 +1,25 @@
+import threading
+
+
+# Kept apart from the middleware, with no Django imports, so the log
+# handler, spans and the toolbar can find the current request without
+# importing it
+__current_instances = threading.local()
+
+
+def set_current_request(request):
+    """Store the current request for use by feature flag evaluation."""
+
+    __current_instances.request = request
+
+
+def get_current_request():
+    """Return the thread's current request, if any."""
+
+    return getattr(__current_instances, 'request', None)
+
+
+def clear_current_request():
+    """Clear the current request."""
+
+    __current_instances.request = None
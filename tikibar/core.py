@@ -0,0 +1,789 @@
+"""
+The parts of tikibar that don't depend on Django: the metrics container,
+request timing, correlation ids, token verification, publishing and
+injecting the toolbar into HTML responses. tikibar.wsgi and tikibar.asgi
+build middleware for other frameworks on top of these, and the Django
+middleware shares them.
+
+Storage is anything with the get, set, get_many and set_many methods of
+Django's cache, so passing the cache the tikibar views read from lets
+other services feed the same viewer.
+"""
+import base64
+import contextvars
+from collections import defaultdict, deque
+import functools
+import hashlib
+import hmac
+from http.cookies import SimpleCookie
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import uuid
+
+from .fingerprints import fingerprint_sql
+from .overhead import process_overhead, record_request_overhead
+
+
+TIKIBAR_DATA_STORAGE_TIMEOUT = 3000  # time to store cache data
+TIKI_COOKIE = 'tikibar_active'
+TIKI_COOKIE_ENABLED_EXPIRATION = 24 * 60 * 60  # 24 hours, in seconds
+TIKIBAR_DISABLED_STRING = 'disabled'
+HISTORY_LENGTH = 15
+SUMMARY_KEY = 'tikibar:summary:%s'
+EXPLAINS_KEY = 'tikibar:explains:%s'
+PHASES_KEY = 'tikibar:phases:%s'
+
+_current_toolbar = contextvars.ContextVar('tikibar_toolbar', default=None)
+
+
+def get_current_toolbar():
+    """The toolbar recording the current request, if any.
+
+    Set under tikibar.wsgi or tikibar.asgi.
+    """
+    return _current_toolbar.get()
+
+
+def new_correlation_id():
+    return uuid.uuid1(node=uuid.getnode(), clock_seq=None).hex
+
+
+def publish_metrics(
+    storage,
+    correlation_id,
+    metrics,
+    summary=None,
+    timeout=TIKIBAR_DATA_STORAGE_TIMEOUT,
+):
+    """Store a payload, and its summary_record if any, in one round trip."""
+    values = {"tikibar:%s" % correlation_id: metrics}
+    if summary is not None:
+        values[SUMMARY_KEY % correlation_id] = summary
+    storage.set_many(values, timeout)
+
+
+def load_metrics(storage, correlation_id):
+    """A stored payload, merged with anything published after the response.
+
+    EXPLAIN plans, and the timings of the middleware outside
+    TikibarMiddleware, are only known once the payload has been written, so
+    they are stored under their own keys rather than by writing the payload
+    again.
+    """
+    key = 'tikibar:%s' % correlation_id
+    explains_key = EXPLAINS_KEY % correlation_id
+    phases_key = PHASES_KEY % correlation_id
+    stored = storage.get_many([key, explains_key, phases_key])
+    metrics = stored.get(key)
+    if not metrics:
+        return None
+    metrics.update(stored.get(phases_key, {}))
+    explains = metrics.get('sql_explains', {})
+    for fingerprint_id, plan in stored.get(explains_key, {}).items():
+        if fingerprint_id in explains:
+            explains[fingerprint_id]['plan'] = plan
+    return metrics
+
+
+def iter_loglines(loglines):
+    """(level, message, logger, created, thread) for each of a payload's lines.
+
+    Payloads whose logs didn't fit only carry a (level, message) summary,
+    which comes back with no logger, time or thread, as does the thread of
+    lines written before threads were recorded.
+    """
+    for line in loglines:
+        yield (tuple(line) + (None, None, None))[:5]
+
+
+def get_summaries(storage, correlation_ids):
+    """{correlation id: summary record} for those still stored, in one trip."""
+    stored = storage.get_many(
+        [SUMMARY_KEY % correlation_id for correlation_id in correlation_ids]
+    )
+    return {
+        correlation_id: stored[SUMMARY_KEY % correlation_id]
+        for correlation_id in correlation_ids
+        if SUMMARY_KEY % correlation_id in stored
+    }
+
+
+def add_to_history(
+    storage, token, entry, timeout=TIKIBAR_DATA_STORAGE_TIMEOUT
+):
+    """Add a request to the list of the token's most recent requests.
+
+    Note that this has a race condition which could be solved using
+    memcached cas (or a Redis list), but in practice doesn't actually matter.
+    """
+    cache_key = 'tikibar:history:%s' % token
+    current = storage.get(cache_key)
+    history = json.loads(current) if current else []
+    history.append(entry)
+    storage.set(cache_key, json.dumps(history[-HISTORY_LENGTH:]), timeout)
+
+
+def _elapsed_ms(timing):
+    start, stop = timing['d']
+    return (stop - start) * 1000
+
+
+def summarize_metrics(metrics):
+    """The numbers aggregated for one request, from its toolbar metrics."""
+    sql_ms, sql_count = 0.0, 0
+    for query_type, val, needs_format, timing, *rest in metrics['queries'].get(
+        'SQL', ()
+    ):
+        sql_ms += _elapsed_ms(timing)
+        sql_count += 1
+    # Captured requests only count queries, see tikibar.capture
+    for summary in metrics.get('query_summary', {}).values():
+        sql_ms += summary['time'] * 1000
+        sql_count += summary['count']
+    if metrics.get('template_tree'):
+        template_ms = sum(
+            _elapsed_ms(root['timing'])
+            for root in metrics['template_tree']
+            if 'timing' in root
+        )
+    else:
+        template_ms = max(
+            [
+                _elapsed_ms(timing)
+                for name, timing in metrics.get('templates', ())
+            ]
+            or [0.0]
+        )
+    cpu_ms = sum(
+        _elapsed_ms(metrics[key])
+        for key in ('user_cpu', 'system_cpu')
+        if key in metrics
+    )
+    return {
+        'total_ms': _elapsed_ms(metrics['total_time']),
+        'sql_ms': sql_ms,
+        'sql_count': sql_count,
+        'template_ms': template_ms,
+        'cpu_ms': cpu_ms,
+    }
+
+
+def summary_record(metrics):
+    """The few numbers the minibar and request history show, times in ms."""
+    summary = summarize_metrics(metrics)
+    return {
+        'total': summary['total_ms'],
+        'sql': summary['sql_ms'],
+        'templates': summary['template_ms'],
+        'cpu': summary['cpu_ms'],
+        'queries': summary['sql_count'],
+        'status': metrics.get('status'),
+        'view': metrics.get('view'),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _toolbar_script():
+    # TODO: Figure out a staticfiles implementation that
+    # works for this.
+    with open(
+        os.path.join(os.path.dirname(__file__), 'static/js/tikibar.js'), 'r'
+    ) as js:
+        return (
+            '<script type="text/javascript" charset="utf-8">{}</script>'
+        ).format(js.read())
+
+
+def inject_toolbar(content, correlation_id, protocol):
+    """Add the correlation id and the tikibar script to an HTML page."""
+    content = content.replace(
+        b'</head>', ('<meta name="correlation_id" value="{}"></head>'.format(
+            correlation_id
+        )).encode("utf8")
+    )
+    script_str = (
+        '<script>window.TIKI_PROTOCOL = "{protocol}";</script>\n'.format(
+            protocol=protocol,
+        )
+    )
+    script_str += _toolbar_script()
+    return content.replace(b'</body>', (script_str + '</body>').encode("utf8"))
+
+
+class MemoryStorage:
+    """A storage for a single process, for development and tests."""
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires = self._data.get(key, (default, None))
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._data[key] = (
+                value,
+                time.time() + timeout if timeout else None,
+            )
+
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set_many(self, values, timeout=None):
+        for key, value in values.items():
+            self.set(key, value, timeout)
+
+
+_BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def _base62_decode(value):
+    number = 0
+    for char in value:
+        number = number * 62 + _BASE62.index(char)
+    return number
+
+
+class SignedCookieVerifier:
+    """
+    Reads the token from the tikibar_active cookie, signed the way Django's
+    set_signed_cookie signs it (SHA-256, Django 3.1 and later), so services
+    sharing the Django site's SECRET_KEY and cookie domain see the tikibar
+    turned on and off with it.
+
+    Token verifiers are called with the request's cookies and return the
+    token, or False when the tikibar isn't turned on.
+    """
+    def __init__(
+        self,
+        secret_key,
+        cookie_name=TIKI_COOKIE,
+        max_age=TIKI_COOKIE_ENABLED_EXPIRATION,
+    ):
+        self.key = ('django.http.cookies' + secret_key).encode('utf8')
+        self.cookie_name = cookie_name
+        self.max_age = max_age
+
+    def signature(self, value):
+        hasher_key = hashlib.sha256(
+            (self.cookie_name + 'signer').encode('utf8') + self.key
+        ).digest()
+        digest = hmac.new(
+            hasher_key, msg=value.encode('utf8'), digestmod=hashlib.sha256
+        ).digest()
+        return base64.urlsafe_b64encode(digest).strip(b'=').decode('ascii')
+
+    def __call__(self, cookies):
+        signed = cookies.get(self.cookie_name)
+        if not signed or signed.count(':') < 2:
+            return False
+        value, signature = signed.rsplit(':', 1)
+        if not hmac.compare_digest(signature, self.signature(value)):
+            return False
+        token, timestamp = value.rsplit(':', 1)
+        try:
+            age = time.time() - _base62_decode(timestamp)
+        except ValueError:
+            return False
+        if age > self.max_age or token == TIKIBAR_DISABLED_STRING:
+            return False
+        return token
+
+
+def parse_cookies(header):
+    cookies = SimpleCookie()
+    try:
+        cookies.load(header)
+    except Exception:
+        return {}
+    return {name: morsel.value for name, morsel in cookies.items()}
+
+
+class MetricsContainer:
+    """
+    Everything recorded about one request, published to `storage` as a
+    single payload under its correlation id by write_metrics.
+    """
+
+    # If the metrics are longer than this, they'll be dropped in an
+    # attempt to fit into memcached
+    max_size = 1000 * 1024
+
+    # Log records below this level are ignored, and only the most recent
+    # log_buffer_size are kept. The middleware sets both per request.
+    log_level = logging.NOTSET
+    log_buffer_size = 200
+
+    _log_formatter = logging.Formatter()
+
+    # Set by TikibarMiddleware for requests without the tikibar turned on
+    # that are captured anyway, see tikibar.capture. These only record
+    # cheap summaries, since every request may be paying for them.
+    capture_mode = None
+
+    def __init__(self, correlation_id, is_active=True, storage=None):
+        self.metrics = defaultdict(list)
+        self.metrics['queries'] = defaultdict(list)
+        self.metrics['sql_fingerprints'] = {}
+        self.metrics['sql_explains'] = {}
+        self.metrics['template_cache'] = {'hits': 0, 'misses': 0}
+        self.metrics['http_connections'] = {'new': 0, 'reused': 0}
+        # Records from other threads (see tikibar.threads) carry their own
+        # thread id; this is the one that handled the request
+        self.metrics['request_thread'] = threading.get_ident()
+        self._sql_statements = {}
+        self.explain_candidates = []
+        self._span_stacks = {}
+        self._log_records = None
+        self._log_records_seen = 0
+        # Seconds tikibar itself has spent on this request, per component.
+        # Updated without the lock: it's only ever a rough total.
+        self.overhead = {}
+        # Collections can start inside any allocation, including one made
+        # while the lock below is held, so they're kept apart from the
+        # metrics and appended to without it. See write_metrics.
+        self._gc_collections = []
+        self._lock = threading.Lock()
+        self.correlation_id = correlation_id
+        self.storage = storage
+        self.summary = None
+        self._is_active = is_active
+
+    def is_active(self):
+        return self._is_active
+
+    def add_timed_metric(self, metric_type, val, start, stop):
+        with self._lock:
+            self.metrics[metric_type].append((val, {'d': (start, stop)}))
+
+    def add_overhead(self, component, seconds):
+        self.overhead[component] = self.overhead.get(component, 0.0) + seconds
+
+    def add_gc_collection(
+        self, generation, start, stop, collected, uncollectable
+    ):
+        self._gc_collections.append({
+            'generation': generation,
+            'collected': collected,
+            'uncollectable': uncollectable,
+            'timing': {'d': (start, stop)},
+        })
+
+    def add_query_summary(self, alias, start, stop):
+        with self._lock:
+            summary = self.metrics.setdefault('query_summary', {}).setdefault(
+                alias, {'count': 0, 'time': 0.0}
+            )
+            summary['count'] += 1
+            summary['time'] += stop - start
+
+    def add_query_metric(
+        self,
+        metric_type,
+        query_type,
+        val,
+        start,
+        stop,
+        needs_format=False,
+        call_site=None,
+    ):
+        with self._lock:
+            self.metrics['queries'][metric_type].append(
+                (
+                    query_type,
+                    val,
+                    needs_format,
+                    {'d': (start, stop)},
+                    call_site,
+                    threading.get_ident(),
+                )
+            )
+
+    def add_sql_query_metric(
+        self, query_type, val, start, stop, params=None, call_site=None
+    ):
+        self.add_query_metric(
+            metric_type='SQL',
+            query_type=query_type,
+            val=val,
+            start=start,
+            stop=stop,
+            needs_format=True,
+            call_site=call_site,
+        )
+        self.add_sql_fingerprint(val, params, start, stop)
+
+    def add_sql_fingerprint(self, sql, params, start, stop):
+        """Fold a query into the per-fingerprint aggregate stats."""
+        fingerprint_id, fingerprint = fingerprint_sql(sql)
+        duration = stop - start
+        # Identical SQL with identical params is an exact duplicate
+        statement = (fingerprint_id, sql, repr(params))
+        with self._lock:
+            stats = self.metrics['sql_fingerprints'].get(fingerprint_id)
+            if stats is None:
+                stats = self.metrics['sql_fingerprints'][fingerprint_id] = {
+                    'sql': fingerprint,
+                    'count': 0,
+                    'distinct': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                    'first': start,
+                    'last': start,
+                }
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+            stats['last'] = start
+            seen = self._sql_statements.get(statement, 0)
+            if not seen:
+                stats['distinct'] += 1
+            self._sql_statements[statement] = seen + 1
+
+    def add_explain_candidate(self, alias, sql, params, start, stop, limit):
+        """Remember a slow query, to capture its plan after the response."""
+        fingerprint_id, _ = fingerprint_sql(sql)
+        with self._lock:
+            if (
+                fingerprint_id in self.metrics['sql_explains']
+                or len(self.explain_candidates) >= limit
+            ):
+                return
+            self.metrics['sql_explains'][fingerprint_id] = {
+                'sql': sql,
+                'params': [repr(param) for param in params or ()],
+                'alias': alias,
+                'time': stop - start,
+                'plan': None,
+            }
+            self.explain_candidates.append(
+                (alias, fingerprint_id, sql, params)
+            )
+
+    def add_http_request(
+        self, host, method, path, status, size, reused, start, stop
+    ):
+        with self._lock:
+            connections = self.metrics['http_connections']
+            connections['reused' if reused else 'new'] += 1
+        self.add_query_metric(
+            metric_type='HTTP',
+            query_type=host,
+            val='%s %s %s (%s bytes, %s connection)' % (
+                method,
+                path,
+                status,
+                size if size is not None else '?',
+                'reused' if reused else 'new',
+            ),
+            start=start,
+            stop=stop,
+        )
+
+    def add_template_tree(self, roots, dropped=0):
+        with self._lock:
+            self.metrics['template_tree'].extend(roots)
+            if dropped:
+                self.metrics['template_tree_dropped'] = (
+                    self.metrics.get('template_tree_dropped', 0) + dropped
+                )
+
+    def add_template_cache_lookup(self, hit):
+        with self._lock:
+            self.metrics['template_cache']['hits' if hit else 'misses'] += 1
+
+    def current_span(self):
+        """Return the id of the innermost open span on this thread, if any."""
+        stack = self._span_stacks.get(threading.get_ident())
+        return stack[-1] if stack else None
+
+    def enter_thread(self, parent_span):
+        """Start recording on this thread, under the span `parent_span`."""
+        self._span_stacks[threading.get_ident()] = (
+            [] if parent_span is None else [parent_span]
+        )
+
+    def exit_thread(self):
+        self._span_stacks.pop(threading.get_ident(), None)
+
+    def start_span(self, name, tags, start):
+        """Open a span under the innermost open span; returns its id."""
+        thread = threading.get_ident()
+        stack = self._span_stacks.setdefault(thread, [])
+        with self._lock:
+            span_id = len(self.metrics['spans'])
+            self.metrics['spans'].append(
+                {
+                    'name': name,
+                    'tags': {
+                        key: str(value) for key, value in (tags or {}).items()
+                    },
+                    'parent': stack[-1] if stack else None,
+                    'thread': thread,
+                    'timing': {'d': (start, start)},
+                }
+            )
+        stack.append(span_id)
+        return span_id
+
+    def stop_span(self, span_id, stop):
+        span = self.metrics['spans'][span_id]
+        span['timing'] = {'d': (span['timing']['d'][0], stop)}
+        stack = self._span_stacks.get(threading.get_ident())
+        if stack and stack[-1] == span_id:
+            stack.pop()
+
+    def add_log_record(self, record):
+        if self._log_records is None:
+            self._log_records = deque(maxlen=self.log_buffer_size)
+        self._log_records.append(record)
+        self._log_records_seen += 1
+
+    def format_log_records(self):
+        """Turn buffered log records into loglines, formatting each message."""
+        loglines = []
+        for record in self._log_records or ():
+            try:
+                message = record.getMessage()
+            except Exception as e:
+                message = 'Could not format %r: %s' % (record.msg, e)
+            if record.exc_info:
+                message += '\n' + self._log_formatter.formatException(
+                    record.exc_info
+                )
+            # Records from propagated calls (see tikibar.threads) keep the
+            # thread that logged them
+            loglines.append(
+                (
+                    record.levelname,
+                    message,
+                    record.name,
+                    record.created,
+                    record.thread,
+                )
+            )
+        self.metrics['loglines'] = loglines
+        dropped = self._log_records_seen - len(loglines)
+        self.metrics['loglines_dropped'] = dropped
+
+    def add_freeform_metric(self, metric_type, data):
+        with self._lock:
+            self.metrics[metric_type].append(data)
+
+    def add_singular_metric(self, metric_type, data):
+        self.metrics[metric_type] = data
+
+    def add_stack_samples(self, samples):
+        self.metrics['stack_samples'] = samples
+
+    def add_memory_profile(self, stats):
+        self.metrics['memory'] = stats
+
+    def write_metrics(self):
+        start = time.perf_counter()
+        self.format_log_records()
+        if self._gc_collections:
+            self.metrics['gc'] = list(self._gc_collections)
+        # If the metrics seem too long, start dropping parts to try and fit
+        if len(repr(self.metrics)) > self.max_size:
+            self.metrics["loglines"] = [
+                ("ERROR", "Logs too big for memcached")
+            ]
+            self.metrics["loglines_dropped"] = self._log_records_seen
+        if len(repr(self.metrics)) > self.max_size:
+            # The normalized text is already stored once per fingerprint, so
+            # queries can refer to it instead of carrying their own copy
+            sql_queries = self.metrics["queries"]["SQL"]
+            self.metrics["queries"]["SQL"] = [
+                (query_type, "#" + fingerprint_sql(val)[0], needs_format,
+                 timing, *rest)
+                for query_type, val, needs_format, timing, *rest in sql_queries
+            ]
+        if len(repr(self.metrics)) > self.max_size:
+            sql_queries = self.metrics["queries"]["SQL"]
+            self.metrics["queries"]["SQL"] = [
+                (query_type, "", needs_format, timing, *rest)
+                for query_type, val, needs_format, timing, *rest in sql_queries
+            ]
+        publish_start = time.perf_counter()
+        self.add_overhead('write_metrics', publish_start - start)
+        # Publishing can't time itself into the payload it's publishing, so
+        # its cost only reaches the process totals, see tikibar.overhead
+        self.metrics['overhead'] = dict(self.overhead)
+        if 'total_time' in self.metrics:
+            self.summary = summary_record(self.metrics)
+        self.publish()
+        self.add_overhead('publishing', time.perf_counter() - publish_start)
+
+    def publish(self):
+        publish_metrics(
+            self.storage, self.correlation_id, self.metrics, self.summary
+        )
+
+
+class Recorder:
+    """
+    Picks the requests to record and records them, for the middleware in
+    tikibar.wsgi and tikibar.asgi.
+
+    `storage` receives the payloads and each token's history, and
+    `verify_token` is called with a request's cookies and returns its
+    tikibar token, or False if the tikibar isn't turned on (see
+    SignedCookieVerifier). Requests to paths starting with anything in
+    `blacklist` are never recorded.
+    """
+    def __init__(self, storage, verify_token, release='master', blacklist=(),
+                 enable_profiler=False, profile_interval=0.01, debug=False):
+        self.storage = storage
+        self.verify_token = verify_token
+        self.release = release
+        self.blacklist = tuple(blacklist)
+        self.enable_profiler = enable_profiler
+        self.profile_interval = profile_interval
+        self.debug = debug
+
+    def start(self, method, path, full_path, cookies, secure):
+        """Start recording a request, returning a RecordedRequest or None."""
+        overhead_start = time.perf_counter()
+        if path.startswith(self.blacklist):
+            return None
+        token = self.verify_token(cookies)
+        if not token:
+            return None
+        return RecordedRequest(
+            self, token, method, full_path, secure, overhead_start
+        )
+
+
+class RecordedRequest:
+    """A request being recorded by a Recorder, until `finish` is called."""
+    def __init__(
+        self, recorder, token, method, full_path, secure, overhead_start
+    ):
+        self.recorder = recorder
+        self.token = token
+        self.method = method
+        self.full_path = full_path
+        self.secure = secure
+        self.toolbar = MetricsContainer(
+            new_correlation_id(), storage=recorder.storage
+        )
+        self.sampler = None
+        if recorder.enable_profiler:
+            from .sampler import Sampler
+            sampler = Sampler(interval=recorder.profile_interval)
+            try:
+                sampler.start()
+            except ValueError:
+                # Servers handling requests on other threads can't be sampled
+                pass
+            else:
+                self.sampler = sampler
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        self.rusage_start = rusage
+        self.start_time = time.time()
+        self._context_token = _current_toolbar.set(self.toolbar)
+        self.toolbar.add_overhead(
+            'process_request', time.perf_counter() - overhead_start
+        )
+
+    @property
+    def correlation_id(self):
+        return self.toolbar.correlation_id
+
+    def finish(self, status_code, headers, body=None):
+        """Stop recording and publish the metrics.
+
+        `headers` is a list of (name, value) strings. Returns the headers
+        and body to respond with: the timing and correlation id headers are
+        added, and the tikibar is added to an HTML `body`.
+        """
+        overhead_start = time.perf_counter()
+        stop = time.time()
+        _current_toolbar.reset(self._context_token)
+        toolbar = self.toolbar
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        # convert kB to MB
+        rss_growth = (rusage.ru_maxrss - self.rusage_start.ru_maxrss) / 1000
+        toolbar.add_singular_metric(
+            'total_time', {'d': [self.start_time, stop]}
+        )
+        toolbar.add_singular_metric(
+            'user_cpu', {'d': [self.rusage_start.ru_utime, rusage.ru_utime]}
+        )
+        toolbar.add_singular_metric(
+            'system_cpu', {'d': [self.rusage_start.ru_stime, rusage.ru_stime]}
+        )
+        toolbar.add_singular_metric('rss_growth', rss_growth)
+        toolbar.add_singular_metric('release', self.recorder.release)
+        toolbar.add_singular_metric('request_path', self.full_path)
+        toolbar.add_singular_metric('status', status_code)
+        if self.sampler is not None:
+            toolbar.add_overhead('sampler', self.sampler.overhead)
+            toolbar.add_stack_samples(self.sampler.output_stats())
+            toolbar.add_singular_metric(
+                'stack_sample_count', self.sampler.sample_count()
+            )
+            self.sampler.stop()
+        toolbar.add_singular_metric('process_overhead', process_overhead())
+        toolbar.add_overhead(
+            'process_response', time.perf_counter() - overhead_start
+        )
+        toolbar.write_metrics()
+
+        overhead_start = time.perf_counter()
+        response_headers = {name.lower(): value for name, value in headers}
+        suppress = 'x-suppress-tikibar' in response_headers
+        if (
+            body
+            and not suppress
+            and response_headers.get('content-type', '').startswith(
+                'text/html'
+            )
+            and 'content-encoding' not in response_headers
+        ):
+            insecure = self.recorder.debug and not self.secure
+            body = inject_toolbar(
+                body,
+                self.correlation_id,
+                'http' if insecure else 'https',
+            )
+            headers = [
+                (name, value)
+                for name, value in headers
+                if name.lower() != 'content-length'
+            ]
+            headers.append(('Content-Length', str(len(body))))
+        duration = stop - self.start_time
+        headers = list(headers) + [
+            ('X-Tiki-Time', str(duration)),
+            ('X-Correlation-ID', self.correlation_id),
+        ]
+        if not suppress:
+            add_to_history(self.recorder.storage, self.token, {
+                'd': duration,
+                't': self.start_time,
+                'u': self.full_path,
+                'c': self.correlation_id,
+                'v': self.method,
+                's': status_code,
+            })
+        toolbar.add_overhead(
+            'process_response', time.perf_counter() - overhead_start
+        )
+        record_request_overhead(duration, toolbar.overhead)
+        return headers, body
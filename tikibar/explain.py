@@ -0,0 +1,100 @@
+"""Run EXPLAIN for slow queries on a background thread.
+
+Slow queries are collected while the request runs, then handed to a single
+worker thread once the response is on its way out. The worker uses its own
+per-thread database connections, so the user's request never waits on an
+EXPLAIN. Plans are cached per fingerprint so a hot slow query is only
+explained once.
+
+The plans are stored under their own key, which the tikibar view merges
+into the payload, so the worker never touches the request's metrics.
+"""
+import collections
+import logging
+import queue
+import threading
+
+from django.core.cache import cache
+from django.db import connections
+
+from .core import EXPLAINS_KEY, TIKIBAR_DATA_STORAGE_TIMEOUT
+
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+MAX_PENDING_JOBS = 100
+MAX_CACHED_PLANS = 500
+
+_plan_cache = collections.OrderedDict()
+_jobs = queue.Queue(maxsize=MAX_PENDING_JOBS)
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def can_explain(connection, sql):
+    return (
+        connection.vendor in EXPLAIN_PREFIXES
+        and sql.lstrip()[:6].upper() == 'SELECT'
+    )
+
+
+def explain_later(correlation_id, candidates):
+    """Queue `candidates` to be explained, then store their plans."""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name='tikibar-explain')
+            _worker.daemon = True
+            _worker.start()
+    try:
+        _jobs.put_nowait((correlation_id, list(candidates)))
+    except queue.Full:
+        logger.warning(
+            'Tikibar: EXPLAIN queue full, dropping %s', correlation_id
+        )
+
+
+def _run():
+    while True:
+        job = _jobs.get()
+        try:
+            _explain_job(*job)
+        except Exception:
+            logger.exception('Tikibar: EXPLAIN failed')
+        finally:
+            connections.close_all()
+
+
+def _explain_job(correlation_id, candidates):
+    plans = {}
+    for alias, fingerprint_id, sql, params in candidates:
+        key = (alias, fingerprint_id)
+        plan = _plan_cache.get(key)
+        if plan is None:
+            plan = _explain(alias, sql, params)
+            _plan_cache[key] = plan
+            if len(_plan_cache) > MAX_CACHED_PLANS:
+                _plan_cache.popitem(last=False)
+        plans[fingerprint_id] = plan
+    cache.set(
+        EXPLAINS_KEY % correlation_id, plans, TIKIBAR_DATA_STORAGE_TIMEOUT
+    )
+
+
+def _explain(alias, sql, params):
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(EXPLAIN_PREFIXES[connection.vendor] + sql, params)
+            return [
+                ' '.join(str(column) for column in row)
+                for row in cursor.fetchall()
+            ]
+    except Exception as e:
+        return ['EXPLAIN failed: %s' % e]
@@ -0,0 +1,31 @@
+import functools
+import hashlib
+import re
+
+
+_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'(?<![\w."])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER_RE = re.compile(r'%s|%\(\w+\)s|\?')
+_VALUE_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_VALUE_ROWS_RE = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint_sql(sql):
+    """Normalize a SQL statement so queries differing only by literals match.
+
+    Returns a ``(fingerprint_id, fingerprint)`` tuple. String and numeric
+    literals become ``?`` and IN-lists / multi-row VALUES collapse to
+    ``(...)``.
+    """
+    fingerprint = _COMMENT_RE.sub('', sql)
+    fingerprint = _STRING_RE.sub('?', fingerprint)
+    fingerprint = _PLACEHOLDER_RE.sub('?', fingerprint)
+    fingerprint = _NUMBER_RE.sub('?', fingerprint)
+    fingerprint = _VALUE_LIST_RE.sub('(...)', fingerprint)
+    fingerprint = _VALUE_ROWS_RE.sub('(...)', fingerprint)
+    fingerprint = _WHITESPACE_RE.sub(' ', fingerprint).strip()
+    fingerprint_id = hashlib.md5(fingerprint.encode('utf8')).hexdigest()[:12]
+    return fingerprint_id, fingerprint
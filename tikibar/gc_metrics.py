@@ -0,0 +1,78 @@
+import gc
+import threading
+import time
+from collections import deque
+
+from .context import get_current_request
+
+
+# Pauses seen by instrumented requests, across the whole process
+RECENT_PAUSES = 100
+
+_hooks_installed = False
+
+# The toolbar and start time of the collection running on this thread, if
+# it started during an instrumented request
+_state = threading.local()
+
+_recent_pauses = deque(maxlen=RECENT_PAUSES)
+
+
+def _gc_callback(phase, info):
+    if phase == 'start':
+        request = get_current_request()
+        toolbar = getattr(request, 'toolbar_metrics', None)
+        if toolbar is None or not toolbar.is_active():
+            return
+        _state.pending = (toolbar, time.time())
+        return
+    pending = getattr(_state, 'pending', None)
+    if pending is None:
+        return
+    _state.pending = None
+    toolbar, start = pending
+    stop = time.time()
+    toolbar.add_gc_collection(
+        info['generation'],
+        start,
+        stop,
+        info['collected'],
+        info['uncollectable'],
+    )
+    _recent_pauses.append((info['generation'], stop - start))
+
+
+def install_gc_hooks():
+    """Time garbage collections that happen during active requests."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+    gc.callbacks.append(_gc_callback)
+
+
+def gc_summary():
+    """The collector's process-wide counters, plus recently recorded pauses."""
+    pauses = list(_recent_pauses)
+    durations = [duration for generation, duration in pauses]
+    return {
+        'generations': [
+            dict(
+                stats,
+                generation=generation,
+                threshold=threshold,
+                pending=pending,
+            )
+            for generation, (stats, threshold, pending) in enumerate(
+                zip(gc.get_stats(), gc.get_threshold(), gc.get_count())
+            )
+        ],
+        'recent': {
+            'count': len(pauses),
+            'total_ms': sum(durations) * 1000,
+            'max_ms': max(durations) * 1000 if durations else 0,
+            'mean_ms': (
+                sum(durations) * 1000 / len(durations) if durations else 0
+            ),
+        },
+    }
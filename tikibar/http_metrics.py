@@ -0,0 +1,72 @@
+import functools
+import http.client
+import time
+
+from .toolbar_metrics import get_toolbar
+
+
+_hooks_installed = False
+
+
+def _hook_putrequest(original):
+    @functools.wraps(original)
+    def putrequest(self, method, url, *args, **kwargs):
+        toolbar = get_toolbar()
+        if toolbar.is_active():
+            # An open socket means this request reuses a kept-alive connection
+            self._tikibar_request = (
+                toolbar,
+                method,
+                url,
+                self.sock is not None,
+                time.time(),
+            )
+        else:
+            self._tikibar_request = None
+        return original(self, method, url, *args, **kwargs)
+    return putrequest
+
+
+def _hook_getresponse(original):
+    @functools.wraps(original)
+    def getresponse(self):
+        pending = getattr(self, '_tikibar_request', None)
+        if pending is None:
+            return original(self)
+        self._tikibar_request = None
+        toolbar, method, url, reused, start = pending
+        status, size = 'error', None
+        try:
+            response = original(self)
+            status = response.status
+            size = response.getheader('content-length')
+            return response
+        finally:
+            toolbar.add_http_request(
+                host='%s:%s' % (self.host, self.port),
+                method=method,
+                path=url,
+                status=status,
+                size=int(size) if size and size.isdigit() else None,
+                reused=reused,
+                start=start,
+                stop=time.time(),
+            )
+    return getresponse
+
+
+def install_http_hooks():
+    """Record requests made through http.client.
+
+    That includes those made with urllib, urllib3 and requests.
+    """
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+    http.client.HTTPConnection.putrequest = _hook_putrequest(
+        http.client.HTTPConnection.putrequest
+    )
+    http.client.HTTPConnection.getresponse = _hook_getresponse(
+        http.client.HTTPConnection.getresponse
+    )
@@ -0,0 +1,231 @@
+"""
+A feed of every request on this host, shared by all its worker processes
+through a memory-mapped ring buffer, so recent requests can be watched
+live without a network round trip per request.
+
+The file starts with a header and a sequence counter, followed by fixed
+size slots. A writer takes the next sequence number under a short flock,
+then fills in slot `sequence % slots` without the lock: it zeroes the
+slot's sequence, writes the record and writes the sequence back. Readers
+never lock; they skip slots whose sequence isn't the one they expect, or
+changes while they read it, so a writer dying mid-write only loses its
+own record. flock is released by the kernel when a process dies, so a
+crashed worker can't leave the lock held.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'TIKIFEED'
+VERSION = 1
+DEFAULT_SLOTS = 4096
+SLOT_SIZE = 256
+
+HEADER = struct.Struct('<8sHII')  # magic, version, slots, slot size
+COUNTER = struct.Struct('<Q')
+COUNTER_OFFSET = 64
+DATA_OFFSET = 128
+
+SEQUENCE = struct.Struct('<Q')
+# time, total ms, SQL ms, queries, template ms, CPU ms, status, pid, flags,
+# method, correlation id, length of the path that follows
+RECORD = struct.Struct('<dffIffHIB7s32sH')
+MAX_PATH = SLOT_SIZE - SEQUENCE.size - RECORD.size
+
+# Flags
+RECORDED = 1  # the request has a full payload under its correlation id
+
+
+class LiveFeed:
+    """The ring buffer at `path`, created with `slots` slots if need be."""
+    def __init__(self, path, slots=DEFAULT_SLOTS):
+        self.path = path
+        self.slots = slots
+        self.slot_size = SLOT_SIZE
+        self._fd = None
+        self._mmap = None
+        self._pid = None
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        # The flock that claims sequence numbers must be on a descriptor
+        # this process opened: ones inherited over fork share their lock
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    header = os.pread(fd, HEADER.size, 0)
+                    if len(header) == HEADER.size and header.startswith(MAGIC):
+                        magic, version, slots, slot_size = HEADER.unpack(
+                            header
+                        )
+                    else:
+                        slots, slot_size = self.slots, SLOT_SIZE
+                        os.ftruncate(fd, DATA_OFFSET + slots * slot_size)
+                        os.pwrite(
+                            fd,
+                            HEADER.pack(MAGIC, VERSION, slots, slot_size),
+                            0,
+                        )
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                mapped = mmap.mmap(fd, DATA_OFFSET + slots * slot_size)
+            except BaseException:
+                os.close(fd)
+                raise
+            self.slots, self.slot_size = slots, slot_size
+            self._fd, self._mmap, self._pid = fd, mapped, os.getpid()
+
+    def append(
+        self,
+        duration,
+        sql_time=0.0,
+        sql_count=0,
+        template_time=0.0,
+        cpu_time=0.0,
+        status=0,
+        method='',
+        correlation_id='',
+        path='',
+        recorded=False,
+        timestamp=0.0,
+    ):
+        """Add a request, with times in seconds.
+
+        Returns False if the feed can't be written.
+        """
+        path = path.encode('utf8')[:MAX_PATH]
+        data = (
+            RECORD.pack(
+                timestamp,
+                duration * 1000,
+                sql_time * 1000,
+                sql_count,
+                template_time * 1000,
+                cpu_time * 1000,
+                status,
+                os.getpid(),
+                RECORDED if recorded else 0,
+                method.encode('ascii', 'replace')[:7],
+                correlation_id.encode('ascii', 'replace')[:32],
+                len(path),
+            )
+            + path
+        )
+        try:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                sequence = (
+                    COUNTER.unpack_from(self._mmap, COUNTER_OFFSET)[0] + 1
+                )
+                COUNTER.pack_into(self._mmap, COUNTER_OFFSET, sequence)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except OSError:
+            logger.warning(
+                'Tikibar: could not write to the live feed at %s',
+                self.path,
+                exc_info=True,
+            )
+            return False
+        offset = DATA_OFFSET + (sequence % self.slots) * self.slot_size
+        SEQUENCE.pack_into(self._mmap, offset, 0)
+        start = offset + SEQUENCE.size
+        self._mmap[start:start + len(data)] = data
+        SEQUENCE.pack_into(self._mmap, offset, sequence)
+        return True
+
+
+def read_feed(path, since=0, limit=None):
+    """Requests in the feed at `path` after sequence number `since`.
+
+    Oldest first. Returns (records, last sequence number), where the latter
+    is what to pass as `since` next time. Only the most recent `limit` are
+    returned.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return [], since
+    try:
+        if os.fstat(fd).st_size < DATA_OFFSET:
+            return [], since
+        mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    with mapped:
+        magic, version, slots, slot_size = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or len(mapped) < DATA_OFFSET + slots * slot_size:
+            return [], since
+        last = COUNTER.unpack_from(mapped, COUNTER_OFFSET)[0]
+        first = max(since + 1, last - slots + 1, 1)
+        if limit is not None:
+            first = max(first, last - limit + 1)
+        records = []
+        for sequence in range(first, last + 1):
+            offset = DATA_OFFSET + (sequence % slots) * slot_size
+            if SEQUENCE.unpack_from(mapped, offset)[0] != sequence:
+                continue
+            data = mapped[offset + SEQUENCE.size:offset + slot_size]
+            # Overwritten while it was being copied
+            if SEQUENCE.unpack_from(mapped, offset)[0] != sequence:
+                continue
+            records.append(_unpack(sequence, data))
+    return records, last
+
+
+def _unpack(sequence, data):
+    (
+        timestamp,
+        duration_ms,
+        sql_ms,
+        sql_count,
+        template_ms,
+        cpu_ms,
+        status,
+        pid,
+        flags,
+        method,
+        correlation_id,
+        path_length,
+    ) = RECORD.unpack_from(data)
+    return {
+        'seq': sequence,
+        't': timestamp,
+        'ms': duration_ms,
+        'sql_ms': sql_ms,
+        'sql_count': sql_count,
+        'template_ms': template_ms,
+        'cpu_ms': cpu_ms,
+        'status': status,
+        'pid': pid,
+        'recorded': bool(flags & RECORDED),
+        'method': method.rstrip(b'\0').decode('ascii'),
+        'correlation_id': correlation_id.rstrip(b'\0').decode('ascii'),
+        'path': data[RECORD.size:RECORD.size + path_length].decode(
+            'utf8', 'ignore'
+        ),
+    }
+
+
+_feeds = {}
+
+
+def get_feed(path, slots=DEFAULT_SLOTS):
+    """The process's LiveFeed for `path`."""
+    feed = _feeds.get(path)
+    if feed is None:
+        feed = _feeds.setdefault(path, LiveFeed(path, slots))
+    return feed
@@ -0,0 +1,76 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from tikibar.live_feed import read_feed
+
+
+class Command(BaseCommand):
+    help = (
+        "Follow the requests every worker on this host is handling, "
+        "from tikibar's live feed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            help=(
+                "The feed to read "
+                "(default TIKIBAR_SETTINGS['live_feed_path'])"
+            ),
+        )
+        parser.add_argument(
+            '--interval', type=float, default=0.5, help='Seconds between reads'
+        )
+        parser.add_argument(
+            '--last',
+            type=int,
+            default=20,
+            help='How many earlier requests to start with',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Print the last requests and exit',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.TIKIBAR_SETTINGS.get(
+            'live_feed_path'
+        )
+        if not path:
+            raise CommandError(
+                "Set TIKIBAR_SETTINGS['live_feed_path'] or pass --path"
+            )
+        records, since = read_feed(path, limit=options['last'])
+        try:
+            while True:
+                for record in records:
+                    self.stdout.write(
+                        '%s %6d %-6s %3d %8.1fms %5d queries '
+                        '%8.1fms SQL  %s %s'
+                        % (
+                            time.strftime(
+                                '%H:%M:%S', time.localtime(record['t'])
+                            ),
+                            record['pid'],
+                            record['method'],
+                            record['status'],
+                            record['ms'],
+                            record['sql_count'],
+                            record['sql_ms'],
+                            record['path'],
+                            (
+                                record['correlation_id']
+                                if record['recorded']
+                                else ''
+                            ),
+                        )
+                    )
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                records, since = read_feed(path, since)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,221 @@
+import json
+import os
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from tikibar.core import load_metrics
+from tikibar.offline import (
+    Summary,
+    diff_counts,
+    iter_records,
+    read_records,
+    write_records,
+)
+
+
+class Command(BaseCommand):
+    help = 'Dump, summarize and diff recorded requests outside the browser'
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+
+        dump = actions.add_parser(
+            'dump', help='Write payloads from the cache to JSON lines files'
+        )
+        dump.add_argument('correlation_ids', nargs='*')
+        dump.add_argument(
+            '--token',
+            help="Also dump the requests in this tikibar token's history",
+        )
+        dump.add_argument('--output-dir', default='.')
+
+        summary = actions.add_parser(
+            'summary',
+            help='Print the top queries, templates and stacks of a request',
+        )
+        summary.add_argument(
+            'source',
+            help='A dumped file, or a correlation id to read from the cache',
+        )
+        summary.add_argument('--limit', type=int, default=10)
+
+        diff = actions.add_parser(
+            'diff',
+            help='Compare two requests, e.g. before and after an optimization',
+        )
+        diff.add_argument(
+            'before',
+            help='A dumped file, or a correlation id to read from the cache',
+        )
+        diff.add_argument('after')
+        diff.add_argument('--limit', type=int, default=10)
+
+    def handle(self, *args, **options):
+        getattr(self, 'handle_' + options['action'])(options)
+
+    def load_payload(self, correlation_id):
+        metrics = load_metrics(cache, correlation_id)
+        if not metrics:
+            raise CommandError(
+                'No metrics stored for %s, they may have expired'
+                % correlation_id
+            )
+        return metrics
+
+    def summarize(self, source):
+        # Files are streamed a record at a time; payloads from the cache
+        # are already in memory, but aren't copied
+        if os.path.exists(source):
+            with open(source) as fp:
+                summary = Summary.from_records(read_records(fp))
+            if summary.request is None:
+                raise CommandError(
+                    '%s has no request record, is it a file written by dump?'
+                    % source
+                )
+            return summary
+        return Summary.from_records(
+            iter_records(self.load_payload(source), source)
+        )
+
+    def handle_dump(self, options):
+        correlation_ids = list(options['correlation_ids'])
+        if options['token']:
+            history = json.loads(
+                cache.get('tikibar:history:%s' % options['token']) or '[]'
+            )
+            correlation_ids.extend(entry['c'] for entry in history)
+        if not correlation_ids:
+            raise CommandError('Give correlation ids or a --token to dump')
+        correlation_ids = list(dict.fromkeys(correlation_ids))
+        os.makedirs(options['output_dir'], exist_ok=True)
+        for correlation_id in correlation_ids:
+            metrics = load_metrics(cache, correlation_id)
+            if not metrics:
+                self.stderr.write('%s: not in the cache' % correlation_id)
+                continue
+            path = os.path.join(
+                options['output_dir'], '%s.jsonl' % correlation_id
+            )
+            with open(path, 'w') as fp:
+                count = write_records(
+                    iter_records(metrics, correlation_id), fp
+                )
+            self.stdout.write('%s (%d records)' % (path, count))
+
+    def handle_summary(self, options):
+        summary = self.summarize(options['source'])
+        limit = options['limit']
+        request = summary.request
+        self.stdout.write(
+            '%s  %s  release %s'
+            % (
+                request['request_path'],
+                request['view'] or '',
+                request['release'],
+            )
+        )
+        self.stdout.write(
+            '%.1fms total, %.1fms in %d queries, %.1fms rendering templates%s'
+            % (
+                summary.total_time * 1000,
+                summary.query_time * 1000,
+                summary.query_count,
+                summary.template_time * 1000,
+                (
+                    ', %.1fms CPU'
+                    % ((request['user_cpu'] + request['system_cpu']) * 1000)
+                    if request['user_cpu'] is not None
+                    else ''
+                ),
+            )
+        )
+        if summary.queries:
+            self.stdout.write('\nTop queries (count, total ms):')
+            for text, count, seconds in summary.top_queries(limit):
+                self.stdout.write(
+                    '%6d %9.1f  %s' % (count, seconds * 1000, text[:200])
+                )
+        if summary.templates:
+            self.stdout.write('\nTop templates (renders, self ms):')
+            for name, count, seconds in summary.top_templates(limit):
+                self.stdout.write(
+                    '%6d %9.1f  %s' % (count, seconds * 1000, name)
+                )
+        if summary.stacks:
+            self.stdout.write('\nHot stacks (samples):')
+            for stack, count in summary.top_stacks(limit):
+                self.stdout.write(
+                    '%6d  %s'
+                    % (count, ' <- '.join(reversed(stack.split(';')[-5:])))
+                )
+        if summary.log_levels:
+            self.stdout.write(
+                '\nLog lines: %s'
+                % ', '.join(
+                    '%s %d' % (level, count)
+                    for level, count in sorted(summary.log_levels.items())
+                )
+            )
+
+    def handle_diff(self, options):
+        before = self.summarize(options['before'])
+        after = self.summarize(options['after'])
+        limit = options['limit']
+        for label, a, b in (
+            ('total', before.total_time * 1000, after.total_time * 1000),
+            ('queries', before.query_time * 1000, after.query_time * 1000),
+            (
+                'templates',
+                before.template_time * 1000,
+                after.template_time * 1000,
+            ),
+        ):
+            self.stdout.write(
+                '%-10s %9.1fms -> %9.1fms (%+.1fms)' % (label, a, b, b - a)
+            )
+        self.stdout.write(
+            '%-10s %9d   -> %9d   (%+d)'
+            % (
+                'count',
+                before.query_count,
+                after.query_count,
+                after.query_count - before.query_count,
+            )
+        )
+        for title, rows in (
+            ('Queries', diff_counts(before.queries, after.queries, limit)),
+            (
+                'Templates',
+                diff_counts(before.templates, after.templates, limit),
+            ),
+        ):
+            if rows:
+                self.stdout.write('\n%s that changed (count, ms):' % title)
+                for key, (count_a, seconds_a), (count_b, seconds_b) in rows:
+                    self.stdout.write(
+                        '%6d -> %-6d %9.1f -> %-9.1f %s'
+                        % (
+                            count_a,
+                            count_b,
+                            seconds_a * 1000,
+                            seconds_b * 1000,
+                            key[:200],
+                        )
+                    )
+        leaves = diff_counts(
+            {
+                frame: [count, count]
+                for frame, count in before.leaf_frames.items()
+            },
+            {
+                frame: [count, count]
+                for frame, count in after.leaf_frames.items()
+            },
+            limit,
+        )
+        if leaves:
+            self.stdout.write('\nLeaf frames that changed (samples):')
+            for frame, (count_a, _), (count_b, _) in leaves:
+                self.stdout.write('%6d -> %-6d %s' % (count_a, count_b, frame))
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tikibar.aggregates import aggregator
+from tikibar.regressions import find_regressions
+
+
+class Command(BaseCommand):
+    help = (
+        'List views whose latest release is slower, or runs more queries, '
+        'than the one before'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=float,
+            default=7 * 24,
+            help=(
+                'How far back to look for releases to compare '
+                '(default a week)'
+            ),
+        )
+        parser.add_argument(
+            '--fail',
+            action='store_true',
+            help=(
+                'Exit with an error if anything regressed, '
+                'for use in deploy checks'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        aggregator.flush()
+        regressions = find_regressions(
+            time.time() - options['hours'] * 60 * 60
+        )
+        for regression in regressions:
+            self.stdout.write('%s: %s -> %s (%d -> %d requests)' % (
+                regression['view'],
+                regression['baseline_release'],
+                regression['release'],
+                regression['baseline']['count'],
+                regression['current']['count'],
+            ))
+            for reason in regression['reasons']:
+                self.stdout.write('    %s' % reason)
+        if not regressions:
+            self.stdout.write('No regressions found')
+        elif options['fail']:
+            raise CommandError('%d view%s regressed' % (
+                len(regressions), '' if len(regressions) == 1 else 's',
+            ))
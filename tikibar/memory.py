@@ -0,0 +1,126 @@
+import os
+import threading
+import tracemalloc
+
+
+DEFAULT_FRAMES = 5
+DEFAULT_TOP = 10
+
+# tracemalloc is process-wide, so concurrently profiled requests share a
+# single tracing session. Tracing only runs while at least one of them is
+# in flight; everything else in the process pays nothing.
+_lock = threading.Lock()
+_active_profilers = 0
+# Whether we started tracing, rather than someone else in the process
+_started_tracing = False
+
+# Allocations made by tracemalloc itself while snapshotting, or by this
+# module, aren't interesting
+_snapshot_filters = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+)
+
+
+def _start_tracing(frames):
+    global _active_profilers, _started_tracing
+    with _lock:
+        _active_profilers += 1
+        if _active_profilers == 1:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                _started_tracing = True
+            # Python < 3.9 can't reset the peak; a fresh session starts at 0
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+
+def _stop_tracing():
+    global _active_profilers, _started_tracing
+    with _lock:
+        _active_profilers -= 1
+        if _active_profilers == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+class AllocationProfiler:
+    """
+    Records what a request allocates using tracemalloc: the peak traced
+    memory, plus the top allocation sites by size and by count from a diff
+    of snapshots taken at the start and end of the request. Tracing is
+    process-wide, so allocations made by other threads while the request
+    is running are included.
+    """
+    def __init__(self, frames=DEFAULT_FRAMES, top=DEFAULT_TOP):
+        self.frames = frames
+        self.top = top
+        self._started = False
+        self._start_snapshot = None
+        self._start_memory = 0
+        self._stats = None
+
+    def start(self):
+        _start_tracing(self.frames)
+        self._started = True
+        self._start_memory = tracemalloc.get_traced_memory()[0]
+        self._start_snapshot = tracemalloc.take_snapshot().filter_traces(
+            _snapshot_filters
+        )
+
+    def stop(self):
+        if not self._started:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        end_snapshot = tracemalloc.take_snapshot().filter_traces(
+            _snapshot_filters
+        )
+        self._started = False
+        _stop_tracing()
+
+        key_type = 'traceback' if self.frames > 1 else 'lineno'
+        diff = end_snapshot.compare_to(self._start_snapshot, key_type)
+        self._start_snapshot = None
+        self._stats = {
+            'frames': self.frames,
+            'start': self._start_memory,
+            'peak': peak - self._start_memory,
+            'net': current - self._start_memory,
+            'by_size': [
+                self._format_stat(stat)
+                for stat in sorted(
+                    diff, key=lambda s: s.size_diff, reverse=True
+                )[: self.top]
+                if stat.size_diff > 0
+            ],
+            'by_count': [
+                self._format_stat(stat)
+                for stat in sorted(
+                    diff, key=lambda s: s.count_diff, reverse=True
+                )[: self.top]
+                if stat.count_diff > 0
+            ],
+        }
+
+    def _format_stat(self, stat):
+        # Most recent frame first, to read like the SQL call sites
+        return {
+            'size': stat.size_diff,
+            'count': stat.count_diff,
+            'traceback': [
+                (self._format_filename(frame.filename), frame.lineno)
+                for frame in reversed(stat.traceback)
+            ],
+        }
+
+    def _format_filename(self, filename):
+        cwd = os.getcwd() + os.sep
+        if filename.startswith(cwd):
+            return filename[len(cwd):]
+        return filename
+
+    def output_stats(self):
+        self.stop()
+        return self._stats
@@ -1,84 +1,290 @@
-import json
-import os
+import contextlib
+import functools
 import resource
+import sys
 import time
-import threading
-import uuid
 
 from django.conf import settings
 from django.core.cache import cache
 from django.utils.deprecation import MiddlewareMixin
-from django.db import connection
-from .sampler import Sampler
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorWrapper
+from .context import (  # noqa: F401
+    clear_current_request,
+    get_current_request,
+    set_current_request,
+)
+from .core import (
+    add_to_history,
+    inject_toolbar,
+    new_correlation_id,
+    summarize_metrics,
+)
+from .overhead import process_overhead, record_request_overhead
+from .toolbar_metrics import get_toolbar
 
 from .utils import (
     _should_show_tikibar_for_request,
     get_tiki_token_or_false,
+    get_log_level_for_request,
+    memory_profiling_enabled,
     tikibar_feature_flag_enabled,
     set_tikibar_active_on_response,
-    TIKIBAR_DATA_STORAGE_TIMEOUT,
 )
 
 
-__current_instances = threading.local()
-
-
-def set_current_request(request):
-    """Store the current request for use by feature flag evaluation."""
-
-    __current_instances.request = request
-
-
-def get_current_request():
-    """Return the thread's current request, if any."""
-
-    return getattr(__current_instances, 'request', None)
-
-
-def clear_current_request():
-    """Clear the current request."""
-
-    __current_instances.request = None
-
-
 class SetCorrelationIDMiddleware(MiddlewareMixin):
     def process_request(self, request):
         # Add a correlation id to the request (needed later)
-        request.correlation_id = uuid.uuid1(
-            node=uuid.getnode(),
-            clock_seq=None
-        ).hex
+        request.correlation_id = new_correlation_id()
         return None
 
 
 class TikibarDatabaseWrapper:
+    def __init__(self):
+        # Optional features are imported and bound here, once, and only if
+        # they're turned on, so processes that leave them off never load
+        # them and queries don't look them up again
+        self.get_call_site = None
+        if settings.TIKIBAR_SETTINGS.get('capture_sql_call_sites', False):
+            from .call_sites import get_call_site, DEFAULT_MAX_DEPTH
+            self.get_call_site = get_call_site
+            self.call_site_max_depth = settings.TIKIBAR_SETTINGS.get(
+                'call_site_max_depth', DEFAULT_MAX_DEPTH
+            )
+        # Seconds; None disables EXPLAIN capture
+        explain_threshold = settings.TIKIBAR_SETTINGS.get('explain_threshold')
+        self.explain_threshold = None
+        if explain_threshold is not None:
+            from .explain import can_explain
+            self.can_explain = can_explain
+            self.explain_threshold = explain_threshold / 1000.0
+        self.explain_limit = settings.TIKIBAR_SETTINGS.get(
+            'explain_max_per_request', 5
+        )
+
     def __call__(self, execute, sql, params, many, context):
-        from .toolbar_metrics import get_toolbar
+        overhead_start = time.perf_counter()
         toolbar = get_toolbar()
+        overhead = time.perf_counter() - overhead_start
         start = time.time()
         result = execute(sql, params, many, context)
         if toolbar.is_active():
             stop = time.time()
-            toolbar.add_sql_query_metric('SQL', sql, start, stop)
+            overhead_start = time.perf_counter()
+            call_site = None
+            if self.get_call_site is not None:
+                call_site = self.get_call_site(
+                    sys._getframe(1), self.call_site_max_depth
+                )
+            toolbar.add_sql_query_metric(
+                context['connection'].alias,
+                sql,
+                start,
+                stop,
+                params=params,
+                call_site=call_site,
+            )
+            if (
+                self.explain_threshold is not None
+                and stop - start >= self.explain_threshold
+                and not many
+            ):
+                if self.can_explain(context['connection'], sql):
+                    toolbar.add_explain_candidate(
+                        context['connection'].alias,
+                        sql,
+                        params,
+                        start,
+                        stop,
+                        self.explain_limit,
+                    )
+            toolbar.add_overhead(
+                'database', overhead + time.perf_counter() - overhead_start
+            )
+        elif toolbar.capture_mode:
+            overhead_start = time.perf_counter()
+            toolbar.add_query_summary(
+                context['connection'].alias, start, time.time()
+            )
+            toolbar.add_overhead(
+                'database', overhead + time.perf_counter() - overhead_start
+            )
         return result
 
 
+# Connection methods timed as 'DB' events, labelled with the connection alias
+CONNECTION_EVENTS = ('connect', 'commit', 'rollback', 'set_autocommit')
+
+_database_hooks_installed = False
+
+
+def _current_database_wrapper():
+    """The TikibarDatabaseWrapper of this thread's request, if any."""
+    return getattr(get_current_request(), 'tikibar_database_wrapper', None)
+
+
+def _hook_execute_with_wrappers(original):
+    @functools.wraps(original)
+    def _execute_with_wrappers(self, sql, params, many, executor):
+        wrapper = _current_database_wrapper()
+        if wrapper is not None:
+            executor = functools.partial(wrapper, executor)
+        return original(self, sql, params, many, executor)
+    return _execute_with_wrappers
+
+
+def _hook_connection_method(original, name):
+    @functools.wraps(original)
+    def timed(self, *args, **kwargs):
+        if _current_database_wrapper() is None:
+            return original(self, *args, **kwargs)
+        start = time.time()
+        try:
+            return original(self, *args, **kwargs)
+        finally:
+            label = name.upper()
+            if name == 'set_autocommit':
+                # Only leaving autocommit marks a transaction boundary
+                autocommit = args[0] if args else kwargs.get('autocommit')
+                label = None if autocommit else 'BEGIN'
+            toolbar = get_toolbar()
+            if label and toolbar.is_active():
+                toolbar.add_query_metric(
+                    'DB', self.alias, label, start, time.time()
+                )
+    return timed
+
+
+def install_database_hooks():
+    """Record queries, connection setup and transactions on every alias.
+
+    The hooks are installed once, on the connection classes, so aliases a
+    request never touches cost nothing and connections opened on worker
+    threads (see tikibar.threads) are covered too. They only record for
+    requests TikibarMiddleware has given a TikibarDatabaseWrapper.
+    """
+    global _database_hooks_installed
+    if _database_hooks_installed:
+        return
+    _database_hooks_installed = True
+    CursorWrapper._execute_with_wrappers = _hook_execute_with_wrappers(
+        CursorWrapper._execute_with_wrappers
+    )
+    for name in CONNECTION_EVENTS:
+        setattr(
+            BaseDatabaseWrapper,
+            name,
+            _hook_connection_method(getattr(BaseDatabaseWrapper, name), name),
+        )
+
+
 class TikibarMiddleware(MiddlewareMixin):
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        install_database_hooks()
+        tikibar_settings = settings.TIKIBAR_SETTINGS
+        if tikibar_settings.get('instrument_http'):
+            from .http_metrics import install_http_hooks
+            install_http_hooks()
+        # Only holds settings, so every request can share it
+        self.database_wrapper = TikibarDatabaseWrapper()
+        # Optional features are imported and bound here, once, and only if
+        # they're turned on; None means the feature is off. The memory
+        # profiler is the exception, since a cookie can turn it on for a
+        # single request.
+        self.sampler_class = None
+        if tikibar_settings.get('enable_profiler'):
+            from .sampler import Sampler
+            self.sampler_class = Sampler
+        self.instrument_caches = None
+        if tikibar_settings.get('instrument_cache'):
+            from .cache_metrics import instrument_caches
+            self.instrument_caches = instrument_caches
+        self.capture_mode_for_request = None
+        if (
+            tikibar_settings.get('sample_rate')
+            or tikibar_settings.get('tail_threshold') is not None
+        ):
+            from .capture import (
+                add_to_capture_index,
+                capture_mode_for_request,
+                capture_reason,
+            )
+
+            self.capture_mode_for_request = capture_mode_for_request
+            self.capture_reason = capture_reason
+            self.add_to_capture_index = add_to_capture_index
+        self.record_request = None
+        if tikibar_settings.get('aggregate_views'):
+            from .aggregates import record_request
+            self.record_request = record_request
+        self.gc_summary = None
+        if tikibar_settings.get('instrument_gc'):
+            from .gc_metrics import gc_summary
+            self.gc_summary = gc_summary
+        if self.database_wrapper.explain_threshold is not None:
+            from .explain import explain_later
+            self.explain_later = explain_later
+        self.get_feed = None
+        if tikibar_settings.get('live_feed_path'):
+            from .live_feed import DEFAULT_SLOTS, get_feed
+            self.get_feed = get_feed
+            self.feed_path = tikibar_settings['live_feed_path']
+            self.feed_slots = tikibar_settings.get(
+                'live_feed_slots', DEFAULT_SLOTS
+            )
+
     def __call__(self, request):
-        with connection.execute_wrapper(TikibarDatabaseWrapper()):
+        request.tikibar_database_wrapper = self.database_wrapper
+        with contextlib.ExitStack() as stack:
+            # Lets process_request add instrumentation that only active
+            # requests should pay for
+            request.tikibar_exit_stack = stack
             return super().__call__(request)
 
     def process_request(self, request):
-        from .toolbar_metrics import get_toolbar
+        overhead_start = time.perf_counter()
         # set the request on tikibar's context
         set_current_request(request)
         if tikibar_feature_flag_enabled(request):
+            if self.get_feed is not None and not hasattr(
+                request, 'feed_start_time'
+            ):
+                request.feed_start_time = time.time()
             toolbar = get_toolbar()
             if toolbar.is_active():
-                if settings.TIKIBAR_SETTINGS.get('enable_profiler'):
+                if self.sampler_class is not None:
                     profile_interval = settings.TIKIBAR_SETTINGS.get('profile_interval', 0.01)
-                    request.sampler = Sampler(interval=profile_interval)
+                    request.sampler = self.sampler_class(
+                        interval=profile_interval
+                    )
                     request.sampler.start()
+                if memory_profiling_enabled(request) and not hasattr(
+                    request, 'allocation_profiler'
+                ):
+                    # Loads tracemalloc, which most processes never need
+                    from .memory import (
+                        AllocationProfiler,
+                        DEFAULT_FRAMES,
+                        DEFAULT_TOP,
+                    )
+
+                    request.allocation_profiler = AllocationProfiler(
+                        frames=settings.TIKIBAR_SETTINGS.get(
+                            'memory_profile_frames', DEFAULT_FRAMES
+                        ),
+                        top=settings.TIKIBAR_SETTINGS.get(
+                            'memory_profile_top', DEFAULT_TOP
+                        ),
+                    )
+                    request.allocation_profiler.start()
+                    # Makes sure tracing stops even if process_response
+                    # never runs
+                    if hasattr(request, 'tikibar_exit_stack'):
+                        request.tikibar_exit_stack.callback(
+                            request.allocation_profiler.stop
+                        )
                 rusage = resource.getrusage(resource.RUSAGE_SELF)
                 if not hasattr(request, 'req_start_time'):
                     request.req_start_time = time.time()
@@ -88,25 +294,137 @@ class TikibarMiddleware(MiddlewareMixin):
                     request.stime_start = rusage.ru_stime
                 if not hasattr(request, 'maxrss_start'):
                     request.maxrss_start = rusage.ru_maxrss
+                toolbar.log_level = get_log_level_for_request(request)
+                toolbar.log_buffer_size = settings.TIKIBAR_SETTINGS.get(
+                    'log_buffer_size', 200
+                )
+                if (
+                    self.instrument_caches is not None
+                    and hasattr(request, 'tikibar_exit_stack')
+                    and not hasattr(request, 'tikibar_caches_instrumented')
+                ):
+                    request.tikibar_exit_stack.enter_context(
+                        self.instrument_caches(toolbar)
+                    )
+                    request.tikibar_caches_instrumented = True
+            elif self.capture_mode_for_request is not None and not hasattr(
+                request, 'capture_start_time'
+            ):
+                toolbar.capture_mode = self.capture_mode_for_request()
+                if toolbar.capture_mode:
+                    rusage = resource.getrusage(resource.RUSAGE_SELF)
+                    request.capture_start_time = time.time()
+                    request.capture_rusage_start = (
+                        rusage.ru_utime,
+                        rusage.ru_stime,
+                    )
+            if toolbar.is_active() or toolbar.capture_mode:
+                toolbar.add_overhead(
+                    'process_request', time.perf_counter() - overhead_start
+                )
         return None
 
+    def publish_capture(self, request, response, toolbar, overhead_start):
+        """Publish the summary of a captured request, if it should be kept."""
+        stop = time.time()
+        duration = stop - request.capture_start_time
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        utime_start, stime_start = request.capture_rusage_start
+        toolbar.add_singular_metric(
+            'total_time', {'d': [request.capture_start_time, stop]}
+        )
+        toolbar.add_singular_metric(
+            'user_cpu', {'d': [utime_start, rusage.ru_utime]}
+        )
+        toolbar.add_singular_metric(
+            'system_cpu', {'d': [stime_start, rusage.ru_stime]}
+        )
+        if self.record_request is not None:
+            # Every captured request counts, not just the ones published
+            self.record_request(request, toolbar.metrics)
+        reason = self.capture_reason(
+            toolbar.capture_mode, duration, response.status_code
+        )
+        if reason is None:
+            toolbar.add_overhead(
+                'process_response', time.perf_counter() - overhead_start
+            )
+            record_request_overhead(duration, toolbar.overhead)
+            return
+        toolbar.add_singular_metric(
+            'release', getattr(settings, 'RELEASE', 'master')
+        )
+        toolbar.add_singular_metric('request_path', request.get_full_path())
+        toolbar.add_singular_metric('status', response.status_code)
+        toolbar.add_singular_metric('capture', {
+            'reason': reason,
+            'method': request.method,
+            'status': response.status_code,
+        })
+        toolbar.add_overhead(
+            'process_response', time.perf_counter() - overhead_start
+        )
+        toolbar.write_metrics()
+        overhead_start = time.perf_counter()
+        self.add_to_capture_index({
+            'd': duration,
+            't': request.capture_start_time,
+            'u': request.get_full_path(),
+            'c': request.correlation_id,
+            'v': request.method,
+            's': response.status_code,
+            'r': reason,
+        })
+        toolbar.add_overhead(
+            'process_response', time.perf_counter() - overhead_start
+        )
+        record_request_overhead(duration, toolbar.overhead)
+
+    def publish_to_feed(self, request, response, toolbar):
+        """Add the request to this host's live feed, see tikibar.live_feed."""
+        stop = time.time()
+        summary = {}
+        # Only recorded and captured requests know where their time went
+        if 'total_time' in toolbar.metrics:
+            summary = summarize_metrics(toolbar.metrics)
+        self.get_feed(self.feed_path, self.feed_slots).append(
+            stop - request.feed_start_time,
+            sql_time=summary.get('sql_ms', 0.0) / 1000,
+            sql_count=summary.get('sql_count', 0),
+            template_time=summary.get('template_ms', 0.0) / 1000,
+            cpu_time=summary.get('cpu_ms', 0.0) / 1000,
+            status=response.status_code,
+            method=request.method,
+            correlation_id=getattr(request, 'correlation_id', ''),
+            path=request.get_full_path(),
+            recorded=toolbar.is_active() or 'capture' in toolbar.metrics,
+            timestamp=request.feed_start_time,
+        )
+
     def process_view(self, request, view_func, view_args, view_kwargs):
-        from .toolbar_metrics import get_toolbar
         if not tikibar_feature_flag_enabled(request):
             return None
 
         toolbar = get_toolbar()
-        if toolbar.is_active():
-            toolbar.set_view_callable(view_func)
+        if toolbar.is_active() or toolbar.capture_mode:
+            overhead_start = time.perf_counter()
+            toolbar.set_view_callable(
+                view_func, getattr(request, 'resolver_match', None)
+            )
+            toolbar.add_overhead(
+                'process_view', time.perf_counter() - overhead_start
+            )
 
         return None
 
     def process_response(self, request, response):
-        from .toolbar_metrics import get_toolbar
         if not tikibar_feature_flag_enabled(request):
             return response
 
         toolbar = get_toolbar()
+        overhead_start = time.perf_counter()
+        if toolbar.capture_mode and hasattr(request, 'capture_start_time'):
+            self.publish_capture(request, response, toolbar, overhead_start)
         # hasattr handles edge case where is_active is false in process_request but true here
         if toolbar.is_active() and hasattr(request, 'req_start_time'):
             setattr(request, 'req_stop_time', time.time())
@@ -119,55 +437,50 @@ class TikibarMiddleware(MiddlewareMixin):
             toolbar.add_singular_metric('rss_growth', rss_growth)
             toolbar.add_singular_metric('release', getattr(settings, 'RELEASE', 'master'))
             toolbar.add_singular_metric('request_path', request.get_full_path())
-            if settings.TIKIBAR_SETTINGS.get('enable_profiler'):
+            toolbar.add_singular_metric('status', response.status_code)
+            if self.record_request is not None:
+                self.record_request(request, toolbar.metrics)
+            if self.gc_summary is not None:
+                toolbar.add_singular_metric('gc_summary', self.gc_summary())
+            if self.sampler_class is not None:
+                toolbar.add_overhead('sampler', request.sampler.overhead)
                 toolbar.add_stack_samples(request.sampler.output_stats())
                 toolbar.add_singular_metric('stack_sample_count', request.sampler.sample_count())
                 request.sampler.stop()
+            if hasattr(request, 'allocation_profiler'):
+                toolbar.add_memory_profile(
+                    request.allocation_profiler.output_stats()
+                )
+            toolbar.add_singular_metric('process_overhead', process_overhead())
+            toolbar.add_overhead(
+                'process_response', time.perf_counter() - overhead_start
+            )
             toolbar.write_metrics()
+            overhead_start = time.perf_counter()
+            if toolbar.explain_candidates:
+                self.explain_later(
+                    toolbar.correlation_id, toolbar.explain_candidates
+                )
             if response.get('content-type', '').startswith('text/html')\
                     and response.content \
                     and not response.get('x-suppress-tikibar')\
                     and not getattr(request, 'is_varnish_populating_cache', False):
-                content = response.content
-                content = content.replace(
-                    b'</head>', ('<meta name="correlation_id" value="{}"></head>'.format(
-                        request.correlation_id
-                    )).encode("utf8")
-                )
-                # TODO: Figure out a staticfiles implementation that
-                # works for this.
-                script_str = '<script>window.TIKI_PROTOCOL = "{protocol}";</script>\n'.format(
-                    protocol='http' if (settings.DEBUG and not request.is_secure()) else 'https'
+                insecure = settings.DEBUG and not request.is_secure()
+                response.content = inject_toolbar(
+                    response.content,
+                    request.correlation_id,
+                    'http' if insecure else 'https',
                 )
-                with open(os.path.join(os.path.dirname(__file__), 'static/js/tikibar.js'), 'r') as js:
-                    script_str += '<script type="text/javascript" charset="utf-8">{}</script>'.format(
-                        js.read()
-                    )
-                    content = content.replace(
-                        b'</body>', (script_str + '</body>').encode("utf8")
-                    )
-                    response.content = content
 
             request_duration = (request.req_stop_time - request.req_start_time)
             # And add the headers
             response['X-Tiki-Time'] = request_duration
             response['X-Correlation-ID'] = request.correlation_id
 
-            # Add correlation ID to list of most recent 20 correlation IDs
-            # in memcached. Note that this has a race condition which could be
-            # solved using memcached cas (or a Redis list), but in practice
-            # doesn't actually matter.
             tiki_token = get_tiki_token_or_false(request)
             if tiki_token and not response.get('x-suppress-tikibar'):
-                cache_key = 'tikibar:history:%s' % tiki_token
-                current = cache.get(cache_key) or ''
-                if current:
-                    current_list = json.loads(current)
-                else:
-                    current_list = []
-
                 # JSON blob with metadata about request
-                current_list.append({
+                add_to_history(cache, tiki_token, {
                     'd': request_duration,
                     't': request.req_start_time,
                     'u': request.get_full_path(),
@@ -175,15 +488,18 @@ class TikibarMiddleware(MiddlewareMixin):
                     'v': request.method,
                     's': response.status_code,
                 })
-                current_list = current_list[-15:]
-                cache.set(cache_key, json.dumps(
-                    current_list,
-                ), TIKIBAR_DATA_STORAGE_TIMEOUT)
+            toolbar.add_overhead(
+                'process_response', time.perf_counter() - overhead_start
+            )
+            record_request_overhead(request_duration, toolbar.overhead)
         else:
             if request.is_secure() or settings.DEBUG:
                 if _should_show_tikibar_for_request(request):
                     set_tikibar_active_on_response(response, request)
 
+        if hasattr(request, 'feed_start_time'):
+            self.publish_to_feed(request, response, toolbar)
+
         # Note: Process response will be called even in case of exceptions,
         # Django will catch exceptions, call process_exception,
         # and then call process_response in the end. Hence it is safe to clear
@@ -0,0 +1,267 @@
+"""
+Work with stored payloads outside the browser, for the tikibar_metrics
+management command.
+
+Payloads are written as JSON lines, one record per query, template, span,
+log line or stack, so summaries and diffs can stream through a file for a
+request with thousands of queries while only holding the totals. Captured
+requests only count their queries, and get one record per database alias
+instead.
+"""
+import json
+
+from .core import iter_loglines
+from .fingerprints import fingerprint_sql
+
+
+def _interval(timing):
+    start, stop = timing['d']
+    return start, stop
+
+
+def _parse_stack_samples(samples):
+    """(stack, count) pairs from the sampler's output string.
+
+    That is '"stack count","stack count"'.
+    """
+    if not samples:
+        return
+    for line in samples.strip('"').split('","'):
+        stack, _, count = line.rpartition(' ')
+        if stack:
+            yield stack, int(count)
+
+
+def iter_records(metrics, correlation_id=None):
+    """The records making up a stored payload, one at a time."""
+    start, stop = _interval(metrics['total_time'])
+    yield {
+        'record': 'request',
+        'correlation_id': correlation_id,
+        'request_path': metrics.get('request_path'),
+        'view': metrics.get('view'),
+        'release': metrics.get('release'),
+        'status': metrics.get('status')
+        or metrics.get('capture', {}).get('status'),
+        'start': start,
+        'stop': stop,
+        'user_cpu': _cpu_seconds(metrics, 'user_cpu'),
+        'system_cpu': _cpu_seconds(metrics, 'system_cpu'),
+    }
+    fingerprints = metrics.get('sql_fingerprints', {})
+    for metric_type, queries in metrics.get('queries', {}).items():
+        for query_type, val, needs_format, timing, *rest in queries:
+            # Oversized payloads refer to the fingerprint text by id
+            if (
+                isinstance(val, str)
+                and val.startswith('#')
+                and val[1:] in fingerprints
+            ):
+                val = fingerprints[val[1:]]['sql']
+            start, stop = _interval(timing)
+            yield {
+                'record': 'query',
+                'type': metric_type,
+                'alias': query_type,
+                'text': val,
+                'start': start,
+                'stop': stop,
+                'call_site': rest[0] if rest else None,
+            }
+    # Captured requests only count queries, see tikibar.capture
+    if not metrics.get('queries', {}).get('SQL'):
+        for alias, summary in sorted(metrics.get('query_summary', {}).items()):
+            yield {
+                'record': 'query_summary',
+                'alias': alias,
+                'count': summary['count'],
+                'time': summary['time'],
+            }
+
+    def visit(nodes, depth):
+        for node in nodes:
+            start, stop = _interval(node['timing'])
+            children = node.get('children', ())
+            child_time = sum(
+                _interval(child['timing'])[1] - _interval(child['timing'])[0]
+                for child in children
+            )
+            yield {
+                'record': 'template',
+                'name': node['name'],
+                'kind': node['kind'],
+                'depth': depth,
+                'start': start,
+                'stop': stop,
+                'self': stop - start - child_time,
+            }
+            yield from visit(children, depth + 1)
+
+    if metrics.get('template_tree'):
+        yield from visit(metrics['template_tree'], 0)
+    else:
+        for name, timing in metrics.get('templates', ()):
+            start, stop = _interval(timing)
+            yield {
+                'record': 'template',
+                'name': name,
+                'kind': 'template',
+                'depth': 0,
+                'start': start,
+                'stop': stop,
+                'self': stop - start,
+            }
+    for span in metrics.get('spans', ()):
+        start, stop = _interval(span['timing'])
+        yield {
+            'record': 'span',
+            'name': span['name'],
+            'tags': span['tags'],
+            'start': start,
+            'stop': stop,
+        }
+    for level, message, logger, created, thread in iter_loglines(
+        metrics.get('loglines', ())
+    ):
+        yield {
+            'record': 'log',
+            'level': level,
+            'message': message,
+            'logger': logger,
+            'created': created,
+            'thread': thread,
+        }
+    for stack, count in _parse_stack_samples(metrics.get('stack_samples')):
+        yield {'record': 'stack', 'stack': stack, 'count': count}
+
+
+def _cpu_seconds(metrics, key):
+    if key not in metrics:
+        return None
+    start, stop = _interval(metrics[key])
+    return stop - start
+
+
+def write_records(records, fp):
+    count = 0
+    for record in records:
+        fp.write(json.dumps(record, default=str))
+        fp.write('\n')
+        count += 1
+    return count
+
+
+def read_records(fp):
+    for line in fp:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+class Summary:
+    """Totals for one request, built up a record at a time."""
+    def __init__(self):
+        self.request = None
+        self.queries = {}
+        self.query_count = 0
+        self.query_time = 0.0
+        self.templates = {}
+        self.template_time = 0.0
+        self.stacks = {}
+        self.leaf_frames = {}
+        self.log_levels = {}
+
+    @classmethod
+    def from_records(cls, records):
+        summary = cls()
+        for record in records:
+            summary.add(record)
+        return summary
+
+    def add(self, record):
+        kind = record['record']
+        if kind == 'request':
+            self.request = record
+        elif kind == 'query':
+            duration = record['stop'] - record['start']
+            # Cache calls and HTTP requests are listed, but aren't queries
+            if record['type'] == 'SQL':
+                self.query_count += 1
+                self.query_time += duration
+            if record['type'] == 'SQL' and record['text']:
+                key = fingerprint_sql(record['text'])[1]
+            else:
+                key = '%s %s' % (record['type'], record['text'])
+            stats = self.queries.setdefault(key, [0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+        elif kind == 'query_summary':
+            self.query_count += record['count']
+            self.query_time += record['time']
+            stats = self.queries.setdefault(
+                'SQL on %s (not recorded individually)' % record['alias'],
+                [0, 0.0],
+            )
+            stats[0] += record['count']
+            stats[1] += record['time']
+        elif kind == 'template':
+            stats = self.templates.setdefault(record['name'], [0, 0.0])
+            stats[0] += 1
+            stats[1] += record['self']
+            if record['depth'] == 0:
+                self.template_time += record['stop'] - record['start']
+        elif kind == 'stack':
+            self.stacks[record['stack']] = (
+                self.stacks.get(record['stack'], 0) + record['count']
+            )
+            leaf = record['stack'].rsplit(';', 1)[-1]
+            self.leaf_frames[leaf] = (
+                self.leaf_frames.get(leaf, 0) + record['count']
+            )
+        elif kind == 'log':
+            self.log_levels[record['level']] = (
+                self.log_levels.get(record['level'], 0) + 1
+            )
+
+    @property
+    def total_time(self):
+        return (
+            self.request['stop'] - self.request['start']
+            if self.request
+            else 0.0
+        )
+
+    def top_queries(self, limit):
+        """(text, count, seconds), the most time first."""
+        rows = sorted(
+            self.queries.items(), key=lambda item: item[1][1], reverse=True
+        )
+        return [
+            (text, count, seconds) for text, (count, seconds) in rows[:limit]
+        ]
+
+    def top_templates(self, limit):
+        """(name, renders, self seconds), the most time first."""
+        rows = sorted(
+            self.templates.items(), key=lambda item: item[1][1], reverse=True
+        )
+        return [
+            (name, count, seconds) for name, (count, seconds) in rows[:limit]
+        ]
+
+    def top_stacks(self, limit):
+        return sorted(
+            self.stacks.items(), key=lambda item: item[1], reverse=True
+        )[:limit]
+
+
+def diff_counts(before, after, limit):
+    """Rows of (key, before stats, after stats) from two
+    {key: [count, seconds]} maps, the biggest change in time first."""
+    empty = [0, 0.0]
+    keys = set(before) | set(after)
+    rows = [
+        (key, before.get(key, empty), after.get(key, empty)) for key in keys
+    ]
+    rows.sort(key=lambda row: abs(row[2][1] - row[1][1]), reverse=True)
+    return [row for row in rows if row[1] != row[2]][:limit]
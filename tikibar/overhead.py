@@ -0,0 +1,43 @@
+import threading
+
+
+# Totals across every request this process has recorded, so the cost of
+# running tikibar can be watched (and alerted on) without reading payloads
+_lock = threading.Lock()
+_totals = {
+    'requests': 0,
+    'request_seconds': 0.0,
+    'overhead_seconds': 0.0,
+    'components': {},
+}
+
+
+def record_request_overhead(request_seconds, components):
+    """Add a recorded request's duration and tikibar's cost, per component."""
+    with _lock:
+        _totals['requests'] += 1
+        _totals['request_seconds'] += request_seconds
+        for component, seconds in components.items():
+            _totals['overhead_seconds'] += seconds
+            _totals['components'][component] = (
+                _totals['components'].get(component, 0.0) + seconds
+            )
+
+
+def process_overhead():
+    """Time tikibar has spent on recorded requests in this process.
+
+    'percent' is that time as a share of those requests' total duration.
+    Requests that aren't recorded or captured aren't timed, since timing
+    them would cost about as much as the checks being timed; run
+    benchmarks/suite.py to measure them.
+    """
+    with _lock:
+        totals = dict(_totals, components=dict(_totals['components']))
+    request_seconds = totals['request_seconds']
+    totals['percent'] = (
+        totals['overhead_seconds'] / request_seconds * 100
+        if request_seconds
+        else 0.0
+    )
+    return totals
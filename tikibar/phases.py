@@ -0,0 +1,143 @@
+import asyncio
+import functools
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.handlers import base
+from django.template.response import SimpleTemplateResponse
+
+from .core import PHASES_KEY, TIKIBAR_DATA_STORAGE_TIMEOUT
+
+
+# Per-thread timings for the request being handled. `layers` holds one
+# [name, start, stop] entry per middleware (outermost first) and `phases`
+# the URL resolution, view and response rendering timings.
+_state = threading.local()
+
+_hooks_installed = False
+
+
+def _record_phase(name, func, *args, **kwargs):
+    phases = getattr(_state, 'phases', None)
+    if phases is None:
+        return func(*args, **kwargs)
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        phases.append((name, start, time.time()))
+
+
+def _layer_name(handler):
+    if isinstance(handler, functools.partial):
+        handler = handler.func
+    if hasattr(handler, '__self__'):
+        # BaseHandler._get_response, wrapping everything inside the middleware
+        return 'Handler'
+    if hasattr(handler, '__qualname__'):
+        return handler.__qualname__
+    return type(handler).__name__
+
+
+def _publish(request, layers, phases):
+    toolbar = getattr(request, 'toolbar_metrics', None)
+    if toolbar is None or not toolbar.is_active():
+        return
+    # The outer middleware finish after TikibarMiddleware has published the
+    # payload, so the timings are stored apart and merged in by load_metrics
+    cache.set(
+        PHASES_KEY % toolbar.correlation_id,
+        {
+            'middleware_layers': [
+                (name, {'d': (start, stop)}) for name, start, stop in layers
+            ],
+            'phases': [
+                (name, {'d': (start, stop)}) for name, start, stop in phases
+            ],
+        },
+        TIKIBAR_DATA_STORAGE_TIMEOUT,
+    )
+
+
+def _timed_layer(handler):
+    name = _layer_name(handler)
+
+    def layer(request):
+        outermost = getattr(_state, 'layers', None) is None
+        if outermost:
+            _state.layers = []
+            _state.phases = []
+        entry = [name, time.time(), None]
+        layers, phases = _state.layers, _state.phases
+        layers.append(entry)
+        try:
+            return handler(request)
+        finally:
+            entry[2] = time.time()
+            if outermost:
+                _state.layers = _state.phases = None
+                _publish(request, layers, phases)
+
+    return layer
+
+
+def _hook_convert_exception_to_response(original):
+    @functools.wraps(original)
+    def convert_exception_to_response(get_response):
+        if asyncio.iscoroutinefunction(get_response):
+            return original(get_response)
+        return original(_timed_layer(get_response))
+    return convert_exception_to_response
+
+
+def _hook_resolve_request(original):
+    @functools.wraps(original)
+    def resolve_request(self, request):
+        return _record_phase('URL resolution', original, self, request)
+    return resolve_request
+
+
+def _hook_make_view_atomic(original):
+    @functools.wraps(original)
+    def make_view_atomic(self, view):
+        view = original(self, view)
+        if asyncio.iscoroutinefunction(view):
+            return view
+
+        @functools.wraps(view)
+        def timed_view(*args, **kwargs):
+            return _record_phase('View', view, *args, **kwargs)
+        return timed_view
+    return make_view_atomic
+
+
+def _hook_render(original):
+    @functools.wraps(original)
+    def render(self):
+        if self._is_rendered:
+            return original(self)
+        return _record_phase('Response rendering', original, self)
+    return render
+
+
+def install_phase_hooks():
+    """Time every middleware layer, URL resolution, the view and rendering.
+
+    Must run before the handler loads its middleware, so it is installed
+    from TikibarConfig.ready().
+    """
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+    base.convert_exception_to_response = _hook_convert_exception_to_response(
+        base.convert_exception_to_response
+    )
+    base.BaseHandler.resolve_request = _hook_resolve_request(
+        base.BaseHandler.resolve_request
+    )
+    base.BaseHandler.make_view_atomic = _hook_make_view_atomic(
+        base.BaseHandler.make_view_atomic
+    )
+    SimpleTemplateResponse.render = _hook_render(SimpleTemplateResponse.render)
@@ -0,0 +1,108 @@
+from django.conf import settings
+
+from .aggregates import load_windows
+
+
+DEFAULT_THRESHOLD = 20  # percent
+DEFAULT_MIN_MS = 5
+DEFAULT_MIN_REQUESTS = 20
+DEFAULT_QUERY_INCREASE = 2
+
+
+def release_baselines(since, until=None):
+    """Per-(view, release) aggregates, with releases in deploy order.
+
+    Returns ({view: [(release, ViewAggregate), ...]}, oldest release first),
+    where a release's place in the order is the first window it was seen in.
+    """
+    first_seen = {}
+    by_view = {}
+    for start, aggregates in load_windows(since, until):
+        for (view, release), aggregate in aggregates.items():
+            first_seen.setdefault(release, start)
+            releases = by_view.setdefault(view, {})
+            if release in releases:
+                releases[release].merge(aggregate)
+            else:
+                releases[release] = aggregate
+    return {
+        view: sorted(releases.items(), key=lambda item: first_seen[item[0]])
+        for view, releases in by_view.items()
+    }
+
+
+def _summarize(aggregate):
+    total = aggregate.histograms['total_ms']
+    return {
+        'count': aggregate.count,
+        'p50_ms': total.percentile(50),
+        'p95_ms': total.percentile(95),
+        'sql_ms': aggregate.histograms['sql_ms'].percentile(50),
+        'sql_count': aggregate.histograms['sql_count'].percentile(50),
+        'sql_count_p95': aggregate.histograms['sql_count'].percentile(95),
+    }
+
+
+def compare_releases(baseline, current):
+    """Why `current` is a regression on `baseline`, both from _summarize."""
+    tikibar_settings = settings.TIKIBAR_SETTINGS
+    threshold = (
+        1
+        + tikibar_settings.get('regression_threshold', DEFAULT_THRESHOLD)
+        / 100.0
+    )
+    min_ms = tikibar_settings.get('regression_min_ms', DEFAULT_MIN_MS)
+    query_increase = tikibar_settings.get(
+        'regression_query_increase', DEFAULT_QUERY_INCREASE
+    )
+    reasons = []
+    for key, label in (('p50_ms', 'median'), ('p95_ms', 'p95')):
+        before, after = baseline[key], current[key]
+        if after > before * threshold and after - before >= min_ms:
+            reasons.append('%s %.1fms -> %.1fms' % (label, before, after))
+    # Extra queries are flagged even when they don't cost much yet, since
+    # that's what a new N+1 looks like before the data grows
+    for key, label in (
+        ('sql_count', 'median queries'),
+        ('sql_count_p95', 'p95 queries'),
+    ):
+        before, after = baseline[key], current[key]
+        if after - before >= query_increase:
+            reasons.append('%s %.0f -> %.0f' % (label, before, after))
+    return reasons
+
+
+def find_regressions(since, until=None):
+    """Views whose latest release regressed on the release before it.
+
+    Only releases with at least TIKIBAR_SETTINGS['regression_min_requests']
+    requests to a view are compared, so the percentiles mean something.
+    """
+    min_requests = settings.TIKIBAR_SETTINGS.get(
+        'regression_min_requests', DEFAULT_MIN_REQUESTS
+    )
+    regressions = []
+    for view, releases in release_baselines(since, until).items():
+        releases = [
+            (release, _summarize(aggregate))
+            for release, aggregate in releases
+            if aggregate.count >= min_requests
+        ]
+        if len(releases) < 2:
+            continue
+        (baseline_release, baseline), (release, current) = releases[-2:]
+        reasons = compare_releases(baseline, current)
+        if reasons:
+            regressions.append({
+                'view': view,
+                'baseline_release': baseline_release,
+                'baseline': baseline,
+                'release': release,
+                'current': current,
+                'reasons': reasons,
+            })
+    regressions.sort(
+        key=lambda row: row['current']['p95_ms'] - row['baseline']['p95_ms'],
+        reverse=True,
+    )
+    return regressions
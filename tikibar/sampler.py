@@ -39,6 +39,8 @@ class Sampler:
         self.interval = interval
         self._started = None
         self._stack_counts = collections.defaultdict(int)
+        # Seconds spent in the signal handler
+        self.overhead = 0.0
 
     def start(self):
         self._started = time.time()
@@ -51,6 +53,7 @@ class Sampler:
         atexit.register(self.stop)
 
     def _sample(self, signum, frame):
+        sample_start = time.perf_counter()
         stack = []
         while frame is not None:
             stack.append(self._format_frame(frame))
@@ -59,6 +62,7 @@ class Sampler:
         stack = ';'.join(reversed(stack))
         self._stack_counts[stack] += 1
         signal.setitimer(signal.ITIMER_VIRTUAL, self.interval)
+        self.overhead += time.perf_counter() - sample_start
 
     def _format_frame(self, frame):
         return '{}({})'.format(frame.f_code.co_name,
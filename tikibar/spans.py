@@ -0,0 +1,84 @@
+import functools
+import time
+
+from .context import get_current_request
+from .toolbar_metrics import get_toolbar
+
+
+def _recording_toolbar():
+    """The current request's toolbar if it is active, without allocating."""
+    request = get_current_request()
+    if request is None or not hasattr(request, 'correlation_id'):
+        return None
+    toolbar = getattr(request, 'toolbar_metrics', None) or get_toolbar()
+    return toolbar if toolbar.is_active() else None
+
+
+class Span:
+    """A timed section of the current request, see `span`."""
+    __slots__ = ('toolbar', 'name', 'tags', 'span_id', 'start')
+
+    def __init__(self, toolbar, name, tags):
+        self.toolbar = toolbar
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        self.span_id = self.toolbar.start_span(
+            self.name, self.tags, self.start
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self.toolbar.stop_span(self.span_id, time.time())
+
+
+class InactiveSpan:
+    """Stands in for `Span` when nothing is being recorded.
+
+    There is a single instance, with no state, shared by every inactive
+    `span()` call.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_INACTIVE_SPAN = InactiveSpan()
+
+
+def span(name, tags=None):
+    """Time a section of the current request.
+
+        with tikibar.span('render-sidebar', {'user': user.id}):
+            ...
+
+    Spans nest, and show up in the tikibar waterfall alongside queries and
+    templates. When the toolbar isn't active this does no work beyond
+    finding the current request, and allocates nothing.
+    """
+    toolbar = _recording_toolbar()
+    if toolbar is None:
+        return _INACTIVE_SPAN
+    return Span(toolbar, name, tags)
+
+
+def timed(name, tags=None):
+    """Decorator timing every call of a function as a `span`.
+
+        @tikibar.timed('load-events')
+        def load_events():
+            ...
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, tags):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
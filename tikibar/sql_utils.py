@@ -1,6 +1,7 @@
 from django.utils.html import escape
 import sqlparse
 from sqlparse import tokens as T
+from .fingerprints import fingerprint_sql  # noqa: F401
 import re
 
 class BoldKeywordFilter:
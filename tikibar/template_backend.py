@@ -1,13 +1,150 @@
-from django.template.backends.django import DjangoTemplates
-from tikibar.toolbar_metrics import get_toolbar
+import functools
+import threading
 import time
 
+from django.conf import settings
+from django.template import base
+from django.template.backends.django import DjangoTemplates, Template
+from django.template.loader_tags import BlockNode, ExtendsNode, IncludeNode
+from django.template.loaders import cached
+from tikibar.toolbar_metrics import get_toolbar
+
+
+# Renders beyond this many nodes still happen, they just aren't recorded
+MAX_TREE_NODES = 1000
+
+# Per-thread render state. `stack` is only set while an active toolbar is
+# rendering through TikibarDjangoTemplates, so the hooks below cost a single
+# attribute lookup for everyone else.
+_state = threading.local()
+
+_hooks_installed = False
+
+
+def _record(name, kind, render, *args):
+    stack = getattr(_state, 'stack', None)
+    if stack is None:
+        return render(*args)
+    overhead_start = time.perf_counter()
+    if _state.node_count >= _state.max_nodes:
+        _state.dropped += 1
+        return render(*args)
+    _state.node_count += 1
+    node = {'name': name, 'kind': kind, 'children': []}
+    stack[-1].append(node)
+    stack.append(node['children'])
+    start = time.time()
+    render_start = time.perf_counter()
+    _state.overhead += render_start - overhead_start
+    try:
+        return render(*args)
+    finally:
+        overhead_start = time.perf_counter()
+        node['timing'] = {'d': (start, time.time())}
+        stack.pop()
+        _state.overhead += time.perf_counter() - overhead_start
+
+
+def _hook_template_render(original):
+    @functools.wraps(original)
+    def _render(self, context):
+        # Set by the extends and include hooks just before they render
+        kind = getattr(_state, 'kind', None) or 'template'
+        _state.kind = None
+        return _record(self.name or '<string>', kind, original, self, context)
+    return _render
+
+
+def _hook_block_render(original):
+    @functools.wraps(original)
+    def render(self, context):
+        return _record(self.name, 'block', original, self, context)
+    return render
+
+
+def _hook_kind(original, kind):
+    @functools.wraps(original)
+    def render(self, context):
+        _state.kind = kind
+        try:
+            return original(self, context)
+        finally:
+            _state.kind = None
+    return render
+
+
+def _hook_cached_loader(original):
+    @functools.wraps(original)
+    def get_template(self, template_name, skip=None):
+        toolbar = get_toolbar()
+        if toolbar.is_active():
+            hit = (
+                self.cache_key(template_name, skip) in self.get_template_cache
+            )
+            toolbar.add_template_cache_lookup(hit)
+        return original(self, template_name, skip)
+    return get_template
+
+
+def install_render_hooks():
+    """Wrap Django's template rendering so render trees can be recorded."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+    base.Template._render = _hook_template_render(base.Template._render)
+    BlockNode.render = _hook_block_render(BlockNode.render)
+    ExtendsNode.render = _hook_kind(ExtendsNode.render, 'extends')
+    IncludeNode.render = _hook_kind(IncludeNode.render, 'include')
+    cached.Loader.get_template = _hook_cached_loader(
+        cached.Loader.get_template
+    )
+
+
+class TikibarTemplate(Template):
+    def render(self, context=None, request=None):
+        toolbar = get_toolbar()
+        # Nested renders are recorded by the outermost one
+        if (
+            not toolbar.is_active()
+            or getattr(_state, 'stack', None) is not None
+        ):
+            return super().render(context, request)
+        roots = []
+        _state.stack = [roots]
+        _state.node_count = 0
+        _state.dropped = 0
+        _state.max_nodes = self.backend.max_tree_nodes
+        _state.overhead = 0.0
+        try:
+            return super().render(context, request)
+        finally:
+            _state.stack = None
+            overhead_start = time.perf_counter()
+            toolbar.add_template_tree(roots, _state.dropped)
+            toolbar.add_overhead(
+                'templates',
+                _state.overhead + time.perf_counter() - overhead_start,
+            )
+
 
 class TikibarDjangoTemplates(DjangoTemplates):
+    def __init__(self, params):
+        super().__init__(params)
+        self.max_tree_nodes = settings.TIKIBAR_SETTINGS.get(
+            'template_tree_max_nodes', MAX_TREE_NODES
+        )
+        install_render_hooks()
+
+    def from_string(self, template_code):
+        return TikibarTemplate(self.engine.from_string(template_code), self)
+
     def get_template(self, template_name):
         start = time.time()
         result = super().get_template(template_name)
-        get_toolbar().add_timed_metric(
-            'templates', template_name, start, time.time()
-        )
-        return result
+        toolbar = get_toolbar()
+        if toolbar.is_active():
+            toolbar.add_timed_metric(
+                'templates', template_name, start, time.time()
+            )
+        return TikibarTemplate(result.template, self)
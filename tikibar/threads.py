@@ -0,0 +1,61 @@
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .cache_metrics import instrument_caches
+from .middleware import (
+    clear_current_request,
+    get_current_request,
+    set_current_request,
+)
+from .toolbar_metrics import get_toolbar
+
+
+def propagate(func):
+    """Wrap `func` so that calls on other threads record into this request.
+
+    Queries, cache calls, spans and logs from the wrapped call are credited
+    to the request that was active when `propagate` was called, nested under
+    whichever span was open at that point. If the toolbar isn't active,
+    `func` is returned unchanged.
+    """
+    request = get_current_request()
+    if request is None or not hasattr(request, 'correlation_id'):
+        return func
+    toolbar = get_toolbar()
+    if not toolbar.is_active():
+        return func
+    parent_span = toolbar.current_span()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous_request = get_current_request()
+        if previous_request is request:
+            # Called on a thread that is already recording this request
+            return func(*args, **kwargs)
+        set_current_request(request)
+        toolbar.enter_thread(parent_span)
+        try:
+            # Queries are recorded through the request's database wrapper,
+            # see install_database_hooks
+            with contextlib.ExitStack() as stack:
+                if settings.TIKIBAR_SETTINGS.get('instrument_cache'):
+                    stack.enter_context(instrument_caches(toolbar))
+                return func(*args, **kwargs)
+        finally:
+            toolbar.exit_thread()
+            if previous_request is None:
+                clear_current_request()
+            else:
+                set_current_request(previous_request)
+
+    return wrapper
+
+
+class TikibarThreadPoolExecutor(ThreadPoolExecutor):
+    """A ThreadPoolExecutor whose tasks record into the submitting request."""
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(propagate(fn), *args, **kwargs)
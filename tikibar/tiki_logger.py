@@ -1,18 +1,34 @@
 import logging
+import time
+
+from .context import get_current_request
 
 
 class TikiLogHandler(logging.Handler):
-        def __init__(self,):
-            # run the regular Handler __init__
-            logging.Handler.__init__(self)
+    def __init__(self,):
+        # run the regular Handler __init__
+        logging.Handler.__init__(self)
+
+    def handle(self, record):
+        # Bail out before filters, locking or any allocation unless
+        # this thread's request is being recorded at this level
+        request = get_current_request()
+        if request is None:
+            return False
+        toolbar = getattr(request, 'toolbar_metrics', None)
+        if (
+            toolbar is None
+            or not toolbar.is_active()
+            or record.levelno < toolbar.log_level
+        ):
+            return False
+        start = time.perf_counter()
+        try:
+            return super().handle(record)
+        finally:
+            toolbar.add_overhead('logging', time.perf_counter() - start)
 
-        def emit(self, record):
-            # Needs to import here because of a dependency on
-            # feature flags, which are not available at app startup
-            from .toolbar_metrics import get_toolbar
-            toolbar = get_toolbar()
-            if toolbar.is_active():
-                toolbar.add_freeform_metric(
-                    'loglines',
-                    (record.levelname, getattr(record, 'message', ''))
-                )
+    def emit(self, record):
+        # Records are kept as-is and only formatted when the metrics
+        # are published, see ToolbarMetricsContainer.write_metrics
+        get_current_request().toolbar_metrics.add_log_record(record)
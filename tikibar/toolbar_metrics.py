@@ -1,23 +1,95 @@
-from collections import defaultdict
-import importlib
+import collections
+import functools
 import inspect
-import logging
-import re
+import sys
+import threading
 
 from django.core.cache import cache
 
-from .middleware import get_current_request
+from .core import MetricsContainer, publish_metrics
+from .context import get_current_request
 from .utils import (
     get_tiki_token_or_false,
-    TIKIBAR_DATA_STORAGE_TIMEOUT,
     find_view_subpath,
     format_dict_as_lines,
 )
 
 
-def publish_toolbar_metrics(correlation_id, metrics):
-    cache_key = "tikibar:%s" % (correlation_id)
-    cache.set(cache_key, metrics, TIKIBAR_DATA_STORAGE_TIMEOUT)
+# Most views seen by a process before the least recently used descriptions
+# are dropped
+VIEW_CACHE_SIZE = 1024
+
+_view_descriptions = collections.OrderedDict()
+_view_descriptions_lock = threading.Lock()
+
+
+def _view_key(view_func):
+    """What a view's description depends on, rather than a single callable.
+
+    Class-based views key on their class, bound methods on their function,
+    and partials on what they wrap, so views built per request don't each
+    get an entry.
+    """
+    if isinstance(view_func, functools.partial):
+        return _view_key(view_func.func)
+    view_class = getattr(view_func, 'view_class', None)
+    if view_class is not None:
+        return view_class
+    return getattr(view_func, '__func__', view_func)
+
+
+def _describe_view(view_func):
+    # Partials share an entry with the view they wrap, so they're described
+    # as that view rather than by the arguments one of them fills in
+    while isinstance(view_func, functools.partial):
+        view_func = view_func.func
+    # as_view() marks its view as wrapping dispatch(), whose signature has self
+    class_based = hasattr(view_func, 'view_class')
+    target = getattr(view_func, 'view_class', view_func)
+    name = (
+        getattr(target, '__qualname__', None)
+        or getattr(target, '__name__', None)
+        or type(target).__name__
+    )
+    try:
+        name += str(
+            inspect.signature(view_func, follow_wrapped=not class_based)
+        )
+    except (TypeError, ValueError):
+        pass
+
+    module = sys.modules.get(getattr(target, '__module__', None) or '')
+    filepath = getattr(module, '__file__', None)
+    if not filepath:
+        return name, None
+    if filepath.endswith('.pyc'):
+        filepath = filepath[:-4] + '.py'
+    return name, find_view_subpath(filepath)
+
+
+def describe_view(view_func):
+    """(name with signature, file) for a view.
+
+    The file is relative to TIKIBAR_SETTINGS['filepath'].
+
+    Worked out once per view and kept for the life of the process.
+    """
+    key = _view_key(view_func)
+    with _view_descriptions_lock:
+        description = _view_descriptions.get(key)
+        if description is not None:
+            _view_descriptions.move_to_end(key)
+            return description
+    description = _describe_view(view_func)
+    with _view_descriptions_lock:
+        _view_descriptions[key] = description
+        while len(_view_descriptions) > VIEW_CACHE_SIZE:
+            _view_descriptions.popitem(last=False)
+    return description
+
+
+def publish_toolbar_metrics(correlation_id, metrics, summary=None):
+    publish_metrics(cache, correlation_id, metrics, summary)
 
 
 def get_toolbar():
@@ -25,7 +97,7 @@ def get_toolbar():
     container = None
     request = get_current_request()
     if not request:
-        return ToolbarMetricsContainer('no-correlation-id-because-no-request', False)
+        return _NO_REQUEST_TOOLBAR
 
     if not hasattr(request, 'correlation_id'):
         return ToolbarMetricsContainer('no-correlation-id', False)
@@ -42,81 +114,30 @@ def get_toolbar():
     return container
 
 
-class ToolbarMetricsContainer:
-
-    # If the metrics are longer than this, they'll be dropped in an
-    # attempt to fit into memcached
-    max_size = 1000 * 1024
-
-    def __init__(self, correlation_id, is_active=True):
-        self.metrics = defaultdict(list)
-        self.metrics['queries'] = defaultdict(list)
-        self.correlation_id = correlation_id
-        self._is_active = is_active
-
-    def is_active(self):
-        return self._is_active
-
-    def set_view_callable(self, view_func):
-        module = view_func.__module__
-        filepath = importlib.import_module(module).__file__
-        if filepath.endswith('.pyc'):
-            filepath = filepath[:-4] + '.py'
-        try:
-            view_func_s = view_func.__name__ + inspect.formatargspec(*inspect.getargspec(view_func))
-        except Exception:
-            view_func_s = str(view_func)
-
-        self.add_singular_metric('view', view_func_s)
-        self.add_singular_metric(
-            'view_filepath',
-            find_view_subpath(filepath),
+class ToolbarMetricsContainer(MetricsContainer):
+    """A MetricsContainer in the Django cache, used by TikibarMiddleware."""
+
+    def set_view_callable(self, view_func, resolver_match=None):
+        view, filepath = describe_view(view_func)
+        self.add_singular_metric('view', view)
+        self.add_singular_metric('view_filepath', filepath)
+        # The same view can be routed to from several patterns, so these
+        # come from the request rather than the view's description
+        if resolver_match is not None:
+            self.add_singular_metric('url_name', resolver_match.view_name)
+            self.add_singular_metric(
+                'url_route', getattr(resolver_match, 'route', None)
+            )
+
+    def publish(self):
+        publish_toolbar_metrics(
+            self.correlation_id, self.metrics, self.summary
         )
 
-    def add_timed_metric(self, metric_type, val, start, stop):
-        self.metrics[metric_type].append((val, {'d': (start, stop)}))
 
-    def add_query_metric(self, metric_type, query_type, val, start, stop, needs_format=False):
-        self.metrics['queries'][metric_type].append(
-            (query_type, val, needs_format, {'d': (start, stop)})
-        )
-
-    def add_sql_query_metric(self, query_type, val, start, stop):
-        self.add_query_metric(
-            metric_type='SQL',
-            query_type=query_type,
-            val=val,
-            start=start,
-            stop=stop,
-            needs_format=True,
-        )
-
-    def add_freeform_metric(self, metric_type, data):
-        self.metrics[metric_type].append(data)
-
-    def add_singular_metric(self, metric_type, data):
-        self.metrics[metric_type] = data
-
-    def add_stack_samples(self, samples):
-        self.metrics['stack_samples'] = samples
-
-    def write_metrics(self):
-        # If the metrics seem too long, start dropping parts to try and fit
-        if len(repr(self.metrics)) > self.max_size:
-            self.metrics["loglines"] = [("ERROR", "Logs too big for memcached")]
-        if len(repr(self.metrics)) > self.max_size:
-            self.metrics["queries"]["SQL"] = [
-                (
-                    query_type,
-                    re.sub(r"/\*.+\*/", "", val)[:50] + "...",
-                    needs_format,
-                    timing,
-                )
-                for query_type, val, needs_format, timing in self.metrics["queries"]["SQL"]
-            ]
-        if len(repr(self.metrics)) > self.max_size:
-            self.metrics["queries"]["SQL"] = [
-                (query_type, "", needs_format, timing)
-                for query_type, val, needs_format, timing in self.metrics["queries"]["SQL"]
-            ]
-        publish_toolbar_metrics(self.correlation_id, self.metrics)
+# What get_toolbar returns outside requests, where the HTTP and template
+# hooks would otherwise build a container for every call. It's never
+# active, so nothing records into it.
+_NO_REQUEST_TOOLBAR = ToolbarMetricsContainer(
+    'no-correlation-id-because-no-request', False
+)
@@ -0,0 +1,368 @@
+"""
+Turn a stored tikibar payload into formats other tools can open: Chrome
+Trace Event JSON, for Perfetto (https://ui.perfetto.dev) or
+chrome://tracing, and OTLP JSON spans, for OpenTelemetry collectors.
+
+Both work on the payload exactly as it is stored, before the tikibar view
+expands its timings, so large requests never go through the templates.
+"""
+import json
+
+from .core import iter_loglines
+from .version import __version__
+
+
+# Longest event name; the full text is kept in the event's args
+MAX_NAME_LENGTH = 120
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+
+def _interval(timing):
+    start, stop = timing['d']
+    return start, stop
+
+
+def _name(text):
+    text = str(text)
+    return (
+        text
+        if len(text) <= MAX_NAME_LENGTH
+        else text[:MAX_NAME_LENGTH - 3] + '...'
+    )
+
+
+def _queries(metrics):
+    """(metric type, alias, text, timing, call site, thread) for each query."""
+    fingerprints = metrics.get('sql_fingerprints', {})
+    for metric_type, queries in metrics.get('queries', {}).items():
+        for query_type, val, needs_format, timing, *rest in queries:
+            call_site = rest[0] if rest else None
+            thread = rest[1] if len(rest) > 1 else None
+            # Oversized payloads refer to the fingerprint text by id
+            if (
+                isinstance(val, str)
+                and val.startswith('#')
+                and val[1:] in fingerprints
+            ):
+                val = fingerprints[val[1:]]['sql']
+            yield metric_type, query_type, val, timing, call_site, thread
+
+
+def _template_nodes(metrics):
+    """(node, parent index) for the render tree, depth first.
+
+    Payloads without a tree give their flat template timings instead.
+    """
+    nodes = []
+
+    def visit(children, parent):
+        for node in children:
+            nodes.append((node, parent))
+            visit(node.get('children', ()), len(nodes) - 1)
+
+    visit(metrics.get('template_tree', ()), None)
+    if not nodes:
+        for name, timing in metrics.get('templates', ()):
+            nodes.append(
+                ({'name': name, 'kind': 'template', 'timing': timing}, None)
+            )
+    return nodes
+
+
+def _cpu_ms(metrics, key):
+    if key not in metrics:
+        return None
+    start, stop = _interval(metrics[key])
+    return (stop - start) * 1000
+
+
+def chrome_trace(metrics, correlation_id=None):
+    """A stored payload as a Chrome Trace Event JSON object.
+
+    Every thread the request recorded on gets its own track. Stack samples
+    aren't timestamped, so they're included under 'otherData' rather than
+    on the timeline.
+    """
+    request_thread = metrics.get('request_thread') or 0
+    events = []
+    threads = {request_thread: 'main'}
+
+    def track(thread):
+        thread = thread or request_thread
+        if thread not in threads:
+            threads[thread] = 'thread %d' % (len(threads))
+        return thread
+
+    def complete(name, category, timing, thread=None, args=None):
+        start, stop = _interval(timing)
+        event = {
+            'name': _name(name),
+            'cat': category,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': max(stop - start, 0) * 1e6,
+            'pid': 1,
+            'tid': track(thread),
+        }
+        if args:
+            event['args'] = args
+        events.append(event)
+
+    complete(
+        metrics.get('request_path', 'request'),
+        'request',
+        metrics['total_time'],
+        args={
+            'view': metrics.get('view'),
+            'release': metrics.get('release'),
+            'user_cpu_ms': _cpu_ms(metrics, 'user_cpu'),
+            'system_cpu_ms': _cpu_ms(metrics, 'system_cpu'),
+        },
+    )
+    for name, timing in metrics.get('middleware_layers', ()):
+        complete(name, 'middleware', timing)
+    for name, timing in metrics.get('phases', ()):
+        complete(name, 'phase', timing)
+    for span in metrics.get('spans', ()):
+        complete(
+            span['name'],
+            'span',
+            span['timing'],
+            span.get('thread'),
+            span['tags'],
+        )
+    for node, parent in _template_nodes(metrics):
+        complete(node['name'], node['kind'], node['timing'])
+    for metric_type, alias, text, timing, call_site, thread in _queries(
+        metrics
+    ):
+        args = {'alias': alias, 'query': text}
+        if call_site:
+            args['call_site'] = '%s:%s in %s' % tuple(call_site)
+        complete(text, metric_type, timing, thread, args)
+    for collection in metrics.get('gc', ()):
+        complete(
+            'GC generation %d' % collection['generation'],
+            'gc',
+            collection['timing'],
+            args={
+                'collected': collection['collected'],
+                'uncollectable': collection['uncollectable'],
+            },
+        )
+    request_start, request_stop = _interval(metrics['total_time'])
+    for level, message, logger, created, thread in iter_loglines(
+        metrics.get('loglines', ())
+    ):
+        events.append({
+            'name': _name(message),
+            'cat': 'log',
+            'ph': 'i',
+            's': 't',
+            'ts': (created or request_start) * 1e6,
+            'pid': 1,
+            'tid': track(thread),
+            'args': {'level': level, 'logger': logger, 'message': message},
+        })
+
+    events.append(
+        {
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': 1,
+            'args': {'name': 'tikibar'},
+        }
+    )
+    for thread, label in threads.items():
+        events.append(
+            {
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': 1,
+                'tid': thread,
+                'args': {'name': label},
+            }
+        )
+    return {
+        'traceEvents': events,
+        'displayTimeUnit': 'ms',
+        'otherData': {
+            'correlation_id': correlation_id,
+            'release': metrics.get('release'),
+            'stack_samples': metrics.get('stack_samples'),
+        },
+    }
+
+
+def _attributes(values):
+    attributes = []
+    for key, value in values.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            typed = {'boolValue': value}
+        elif isinstance(value, int):
+            typed = {'intValue': str(value)}
+        elif isinstance(value, float):
+            typed = {'doubleValue': value}
+        else:
+            typed = {'stringValue': str(value)}
+        attributes.append({'key': key, 'value': typed})
+    return attributes
+
+
+def _nanos(seconds):
+    return str(int(seconds * 1e9))
+
+
+def otlp_spans(metrics, correlation_id, service_name='tikibar'):
+    """A stored payload as an OTLP JSON ExportTraceServiceRequest.
+
+    The correlation id is the trace id. Spans and templates keep their
+    nesting; queries, middleware and GC are children of the request span,
+    and log lines are its events.
+    """
+    spans = []
+
+    def add(name, timing, kind=SPAN_KIND_INTERNAL, parent=0, attributes=None):
+        start, stop = _interval(timing)
+        span = {
+            'traceId': correlation_id,
+            'spanId': '%016x' % (len(spans) + 1),
+            'name': _name(name),
+            'kind': kind,
+            'startTimeUnixNano': _nanos(start),
+            'endTimeUnixNano': _nanos(stop),
+            'attributes': _attributes(attributes or {}),
+        }
+        if parent:
+            span['parentSpanId'] = '%016x' % parent
+        spans.append(span)
+        return len(spans)
+
+    root = add(
+        metrics.get('request_path', 'request'),
+        metrics['total_time'],
+        SPAN_KIND_SERVER,
+        attributes={
+            'http.target': metrics.get('request_path'),
+            'code.function': metrics.get('view'),
+            'service.version': metrics.get('release'),
+            'tikibar.user_cpu_ms': _cpu_ms(metrics, 'user_cpu'),
+            'tikibar.system_cpu_ms': _cpu_ms(metrics, 'system_cpu'),
+        },
+    )
+    request_start, request_stop = _interval(metrics['total_time'])
+    spans[0]['events'] = [
+        {
+            'timeUnixNano': _nanos(created or request_start),
+            'name': _name(message),
+            'attributes': _attributes(
+                {
+                    'log.severity': level,
+                    'log.logger': logger,
+                    'log.message': message,
+                    'thread.id': thread,
+                }
+            ),
+        }
+        for level, message, logger, created, thread in iter_loglines(
+            metrics.get('loglines', ())
+        )
+    ]
+    for name, timing in metrics.get('middleware_layers', ()):
+        add(
+            name,
+            timing,
+            parent=root,
+            attributes={'tikibar.kind': 'middleware'},
+        )
+    for name, timing in metrics.get('phases', ()):
+        add(name, timing, parent=root, attributes={'tikibar.kind': 'phase'})
+    span_ids = []
+    for span in metrics.get('spans', ()):
+        parent = (
+            span_ids[span['parent']] if span['parent'] is not None else root
+        )
+        span_ids.append(
+            add(
+                span['name'],
+                span['timing'],
+                parent=parent,
+                attributes=span['tags'],
+            )
+        )
+    node_ids = []
+    for node, parent in _template_nodes(metrics):
+        parent = node_ids[parent] if parent is not None else root
+        node_ids.append(
+            add(
+                node['name'],
+                node['timing'],
+                parent=parent,
+                attributes={'tikibar.kind': node['kind']},
+            )
+        )
+    for metric_type, alias, text, timing, call_site, thread in _queries(
+        metrics
+    ):
+        attributes = {'tikibar.kind': metric_type, 'tikibar.alias': alias}
+        if metric_type == 'SQL':
+            attributes['db.statement'] = text
+        if call_site:
+            (
+                attributes['code.filepath'],
+                attributes['code.lineno'],
+                attributes['code.function'],
+            ) = call_site
+        add(text, timing, SPAN_KIND_CLIENT, root, attributes)
+    for collection in metrics.get('gc', ()):
+        add(
+            'GC generation %d' % collection['generation'],
+            collection['timing'],
+            parent=root,
+            attributes={
+                'tikibar.kind': 'gc',
+                'tikibar.collected': collection['collected'],
+            },
+        )
+    return {
+        'resourceSpans': [
+            {
+                'resource': {
+                    'attributes': _attributes({'service.name': service_name})
+                },
+                'scopeSpans': [
+                    {
+                        'scope': {'name': 'tikibar', 'version': __version__},
+                        'spans': spans,
+                    }
+                ],
+            }
+        ],
+    }
+
+
+def write_trace(trace, path):
+    """Write a chrome_trace or otlp_spans result to a file."""
+    with open(path, 'w') as fp:
+        json.dump(trace, fp)
+
+
+def post_otlp(trace, endpoint, timeout=10):
+    """Send an otlp_spans result to an OTLP/HTTP collector.
+
+    `endpoint` is e.g. http://localhost:4318/v1/traces.
+    """
+    import urllib.request
+    request = urllib.request.Request(
+        endpoint,
+        data=json.dumps(trace).encode('utf8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
@@ -3,7 +3,12 @@ from tikibar import views
 
 urlpatterns = [
     url(r'^$', views.tikibar),
+    url(r'^export/$', views.tikibar_export),
     url(r'^settings/$', views.tikibar_settings),
+    url(r'^captured/$', views.tikibar_captured),
+    url(r'^live/$', views.tikibar_live),
+    url(r'^aggregates/$', views.tikibar_aggregates),
+    url(r'^regressions/$', views.tikibar_regressions),
     url(r'^on/$', views.tikibar_on),
     url(r'^set-for-api-domain/$', views.tikibar_set_for_api_domain),
     url(r'^off/$', views.tikibar_off),
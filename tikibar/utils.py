@@ -7,13 +7,18 @@ from functools import wraps
 from django.conf import settings
 from django.http import HttpResponse, HttpResponsePermanentRedirect, Http404
 
-TIKIBAR_DATA_STORAGE_TIMEOUT = 3000 # time to store cache data
-TIKI_COOKIE = 'tikibar_active'
+from .core import (  # noqa: F401
+    TIKIBAR_DATA_STORAGE_TIMEOUT,
+    TIKI_COOKIE,
+    TIKI_COOKIE_ENABLED_EXPIRATION,
+    TIKIBAR_DISABLED_STRING,
+)
+
 TIKIBAR_VIEW_COOKIE_NAME = 'tikiok'
 TIKI_SALT_HTTPS = 'tiki-salt-extra-https'
-TIKI_COOKIE_ENABLED_EXPIRATION = 24 * 60 * 60  # 24 hours, in seconds
 TIKI_COOKIE_DISABLED_EXPIRATION = 30 * 24 * 60 * 60  # 30 days, in seconds
-TIKIBAR_DISABLED_STRING = 'disabled'
+TIKIBAR_LOG_LEVEL_COOKIE = 'tikibar_log_level'
+TIKIBAR_MEMORY_PROFILE_COOKIE = 'tikibar_memory_profile'
 
 
 def get_tiki_token_or_false_for_tikibar_view(request):
@@ -107,6 +112,31 @@ def get_tiki_token_or_false(request):
     return False
 
 
+def get_log_level_for_request(request):
+    """Return the minimum log level to capture for this request.
+
+    Defaults to TIKIBAR_SETTINGS['log_level'] and can be overridden per
+    request with a tikibar_log_level cookie holding a level name.
+    """
+    level = request.COOKIES.get(
+        TIKIBAR_LOG_LEVEL_COOKIE,
+        settings.TIKIBAR_SETTINGS.get('log_level', 'DEBUG'),
+    )
+    level = logging.getLevelName(str(level).upper())
+    return level if isinstance(level, int) else logging.DEBUG
+
+
+def memory_profiling_enabled(request):
+    """Should this request's allocations be traced with tracemalloc?
+
+    On for every active request with TIKIBAR_SETTINGS['memory_profile'],
+    or just this one with a tikibar_memory_profile=1 cookie.
+    """
+    if settings.TIKIBAR_SETTINGS.get('memory_profile'):
+        return True
+    return request.COOKIES.get(TIKIBAR_MEMORY_PROFILE_COOKIE) == '1'
+
+
 def set_tikibar_active_on_response(response, request):
     # Tikibar is only available over HTTPS. Callers to this function
     # should (and do, at the time of writing) check this.
@@ -13,12 +13,30 @@ from .utils import (
     tikibar_feature_flag_enabled,
     get_tiki_token_or_false_for_tikibar_view,
     ssl_required,
+    format_dict_as_lines,
 )
 import json, hashlib, itertools, time, os
 
-from .sql_utils import reformat_sql
+from .aggregates import aggregator, load_aggregates
+from .capture import get_capture_index
+from .core import get_summaries, iter_loglines, load_metrics, summary_record
+from .live_feed import read_feed
+from .regressions import find_regressions
+from .trace_export import chrome_trace, otlp_spans
 
 TIKI_ANGER_THRESHOLD = 500 # 500ms
+TIKI_N_PLUS_ONE_THRESHOLD = 5  # repeats of one fingerprint with varying params
+
+# Time windows offered by the aggregates dashboard, in seconds
+TIKI_AGGREGATE_WINDOWS = [
+    ('1h', 60 * 60),
+    ('6h', 6 * 60 * 60),
+    ('24h', 24 * 60 * 60),
+    ('7d', 7 * 24 * 60 * 60),
+]
+
+# Requests shown by the live feed page
+TIKI_LIVE_FEED_ROWS = 100
 
 TIKI_BAR_COLORS = ['#8adb1e', '#1c4dcb', '#b21ccb', '#f53522', '#f5aa22', '#e7f021']
 
@@ -70,12 +88,18 @@ def tikibar(request):
     if not correlation_id:
         return tiki_response(HttpResponse(''))
 
-    data = cache.get('tikibar:%s' % correlation_id)
+    if request.GET.get('render') and request.GET.get('template') == 'minibar':
+        return tikibar_minibar(request, correlation_id)
+
+    data = load_metrics(cache, correlation_id)
 
     history_cache_key = 'tikibar:history:%s' % tiki_token
     request_history = json.loads(cache.get(history_cache_key) or '[]')
     request_history.reverse()
     request_history = [r for r in request_history if r['c'] != correlation_id]
+    summaries = get_summaries(cache, [r['c'] for r in request_history])
+    for row in request_history:
+        row['summary'] = summaries.get(row['c'])
 
     if data:
         data['correlation_id'] = correlation_id
@@ -106,19 +130,82 @@ def tikibar(request):
         queries, total_query_time = format_queries(
             data.get('queries', {}),
             total_time,
-            data['bars']
+            data['bars'],
+            data.get('sql_fingerprints', {}),
         )
+        # Captured requests only have per-database totals
+        for alias, summary in sorted(data.get('query_summary', {}).items()):
+            summary['ms'] = summary['time'] * 1000
+            data['bars'].append({
+                'name': 'SQL (%s)' % alias,
+                'ms': summary['ms'],
+            })
+            total_query_time += summary['ms']
         data['queries'] = queries
         data['sum_sql'] = total_query_time
+        data['sql_fingerprints'] = format_sql_fingerprints(
+            data.get('sql_fingerprints', {}),
+            data['total_time']['start'],
+            settings.TIKIBAR_SETTINGS.get(
+                'n_plus_one_threshold', TIKI_N_PLUS_ONE_THRESHOLD
+            ),
+        )
+        data['slow_queries'] = format_slow_queries(
+            data.get('sql_explains', {})
+        )
+        data['sql_fingerprints_flagged'] = len(
+            [
+                f
+                for f in data['sql_fingerprints']
+                if f['n_plus_one'] or f['duplicates']
+            ]
+        )
         data['source_control_url'] = settings.TIKIBAR_SETTINGS.get('source_control_url')
         data['splunk_url'] = settings.TIKIBAR_SETTINGS.get('splunk_url')
 
+        data['template_tree'] = format_template_tree(
+            data.get('template_tree', [])
+        )
         templates = format_templates(
             data.get('templates', []),
             total_time,
             data['bars'],
+            data['template_tree'],
         )
         data['templates'] = templates
+        data['waterfall'] = format_waterfall(
+            data.get('spans', []),
+            data['queries'],
+            data['template_tree'],
+            data['total_time'],
+        )
+        data['loglines'] = format_loglines(
+            data.get('loglines', []),
+            data['total_time']['start'],
+        )
+        label_threads(
+            data['waterfall'] + data['loglines'], data.get('request_thread')
+        )
+        data['phase_waterfall'] = format_phases(
+            data.get('middleware_layers', []),
+            data.get('phases', []),
+        )
+        if data.get('memory'):
+            data['memory_sites'] = [
+                ('Top allocations by size', data['memory']['by_size']),
+                ('Top allocations by count', data['memory']['by_count']),
+            ]
+        data['gc'], gc_time = format_gc(
+            data.get('gc', []), data['total_time']['start']
+        )
+        if data['gc']:
+            data['bars'].append({
+                'name': 'GC',
+                'ms': gc_time,
+            })
+        data['overhead'], data['overhead_ms'] = format_overhead(
+            data.get('overhead', {}), total_time
+        )
         other_time = total_time
         for bar in data['bars']:
             other_time -= bar['ms']
@@ -140,17 +227,52 @@ def tikibar(request):
             data['angry'] = True
 
     if request.GET.get('render'):
-        template_name = 'tikibar.html'
-        if request.GET.get('template') == 'minibar':
-            template_name = 'minibar.html'
-        return tiki_response(HttpResponse(render(request, 'tikibar/%s' % template_name, {
-            'tiki': data
-        })))
+        return tiki_response(
+            HttpResponse(
+                render(request, 'tikibar/tikibar.html', {'tiki': data})
+            )
+        )
     else:
         return tiki_response(HttpResponse(json.dumps(data, indent=2), content_type='application/json'))
 
 
-def format_templates(input_templates, total_time, bars):
+def tikibar_minibar(request, correlation_id):
+    """An earlier request's headline numbers, from its summary record alone."""
+    summary = get_summaries(cache, [correlation_id]).get(correlation_id)
+    if summary is None:
+        # Payloads written before summary records existed
+        data = cache.get('tikibar:%s' % correlation_id)
+        summary = summary_record(data) if data else None
+    return tiki_response(HttpResponse(render(request, 'tikibar/minibar.html', {
+        'correlation_id': correlation_id,
+        'summary': summary,
+    })))
+
+
+@ssl_required
+def tikibar_export(request):
+    """A stored payload as a Chrome trace (the default) or OTLP JSON file."""
+    if not tikibar_feature_flag_enabled(request):
+        return tiki_response(HttpResponse('Tikibar is turned off'))
+    # Same check as the tikibar view, see the comments there
+    if not get_tiki_token_or_false_for_tikibar_view(request):
+        return tiki_response(HttpResponse('No tiki-token!'))
+    correlation_id = request.GET.get('correlation_id', '')
+    data = load_metrics(cache, correlation_id) if correlation_id else None
+    if not data:
+        raise Http404('No metrics for this correlation id')
+    if request.GET.get('format') == 'otlp':
+        trace = otlp_spans(data, correlation_id)
+        filename = 'tikibar-%s.otlp.json' % correlation_id
+    else:
+        trace = chrome_trace(data, correlation_id)
+        filename = 'tikibar-%s.trace.json' % correlation_id
+    response = HttpResponse(json.dumps(trace), content_type='application/json')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return tiki_response(response)
+
+
+def format_templates(input_templates, total_time, bars, template_tree=None):
     # Add funky slashes to the template paths
     templates = []
     total_template_time = 0.0
@@ -160,8 +282,12 @@ def format_templates(input_templates, total_time, bars):
             'timing': timing,
             'filepath_with_slashes': slasherize(filepath),
         })
-        # Templates are nested, so we want to find the max template render.
+        # Without a render tree, the best guess is the max template load.
         total_template_time = max(total_template_time, timing['duration'])
+    if template_tree:
+        total_template_time = sum(
+            row['ms'] for row in template_tree if row['depth'] == 0
+        )
     bars.append({
         'name': 'Template Rendering',
         'ms': total_template_time,
@@ -172,25 +298,182 @@ def format_templates(input_templates, total_time, bars):
     return templates
 
 
-def format_queries(input_queries, total_time, bars):
+def format_template_tree(roots):
+    """Flatten the render tree into rows with inclusive and self time."""
+    rows = []
+
+    def visit(nodes, depth, parent_path):
+        for i, node in enumerate(nodes):
+            path = '%s.%d' % (parent_path, i) if parent_path else str(i)
+            children = node.get('children', [])
+            ms = node['timing']['duration']
+            rows.append(
+                {
+                    'name': node['name'],
+                    'kind': node['kind'],
+                    'timing': node['timing'],
+                    'ms': ms,
+                    'self_ms': ms
+                    - sum(child['timing']['duration'] for child in children),
+                    'depth': depth,
+                    'indent': depth * 16,
+                    'path': path,
+                    'has_children': bool(children),
+                }
+            )
+            visit(children, depth + 1, path)
+
+    visit(roots, 0, '')
+    return rows
+
+
+def format_phases(layers, phases):
+    """Split nested middleware layers into request and response segments."""
+    if not layers:
+        return []
+    layers = sorted(layers, key=lambda layer: layer[1]['start'])
+    outer = layers[0][1]
+    segments = []
+    for i, (name, timing) in enumerate(layers):
+        inner = layers[i + 1][1] if i + 1 < len(layers) else None
+        if inner is None or inner['start'] > timing['end']:
+            # The innermost layer, or one that returned without calling
+            # the next
+            segments.append((name, '', timing['start'], timing['end']))
+        else:
+            segments.append((name, 'request', timing['start'], inner['start']))
+            segments.append((name, 'response', inner['end'], timing['end']))
+    for name, timing in phases:
+        segments.append((name, 'phase', timing['start'], timing['end']))
+
+    total_ms = (outer['end'] - outer['start']) * 1000 or 1
+    rows = []
+    for name, direction, start, end in segments:
+        ms = (end - start) * 1000
+        rows.append({
+            'name': name,
+            'direction': direction,
+            'ms': ms,
+            'start': start,
+            'bar': {
+                'left': (start - outer['start']) * 1000 / total_ms * 99,
+                'width': ms / total_ms * 99,
+            },
+        })
+    rows.sort(key=lambda row: row['start'])
+    return rows
+
+
+def label_threads(rows, request_thread):
+    """Replace thread ids with 'main' or 'thread N', in order of appearance."""
+    labels = {request_thread: 'main', None: 'main'}
+    for row in rows:
+        if row['thread'] not in labels:
+            labels[row['thread']] = 'thread %d' % (len(labels) - 1)
+        row['thread'] = labels[row['thread']]
+
+
+def format_waterfall(spans, queries, template_tree, total_time):
+    """Lay spans, queries and top-level template renders on one timeline."""
+    rows = []
+    for span in spans:
+        depth = 0
+        parent = span['parent']
+        while parent is not None:
+            depth += 1
+            parent = spans[parent]['parent']
+        rows.append({
+            'kind': 'span',
+            'name': span['name'],
+            'detail': format_dict_as_lines(span['tags']).replace('\n', ', '),
+            'timing': span['timing'],
+            'depth': depth,
+            'thread': span.get('thread'),
+        })
+    for query in queries:
+        rows.append({
+            'kind': query['type'],
+            'name': query['sql'][:120],
+            'detail': '',
+            'timing': query['timing'],
+            'depth': 0,
+            'thread': query.get('thread'),
+        })
+    for node in template_tree:
+        if node['depth'] == 0:
+            rows.append({
+                'kind': node['kind'],
+                'name': node['name'],
+                'detail': '',
+                'timing': node['timing'],
+                'depth': 0,
+                'thread': None,
+            })
+    rows.sort(key=lambda row: row['timing']['start'])
+
+    request_start_ms = total_time['start'] * 1000
+    total_ms = total_time['duration'] or 1
+    for row in rows:
+        row['indent'] = row['depth'] * 16
+        row['bar'] = {
+            'left': (row['timing']['start'] * 1000 - request_start_ms)
+            / total_ms
+            * 99,
+            'width': row['timing']['duration'] / total_ms * 99,
+        }
+    return rows
+
+
+def format_queries(input_queries, total_time, bars, fingerprints=None):
+    fingerprints = fingerprints or {}
     queries = []
     total_query_time = 0.0
     for metric_type in input_queries:
         metric_timing = 0.0
-        for query_type, val, needs_format, timing in input_queries.get(metric_type, []):
+        timing_by_query_type = {}
+        for query_type, val, needs_format, timing, *rest in input_queries.get(
+            metric_type, []
+        ):
+            # Payloads written before call sites and threads were recorded
+            # have fewer items
+            call_site = rest[0] if rest else None
+            thread = rest[1] if len(rest) > 1 else None
+            # Oversized payloads refer to the fingerprint text by id
+            if (
+                isinstance(val, str)
+                and val.startswith('#')
+                and val[1:] in fingerprints
+            ):
+                val = fingerprints[val[1:]]['sql']
+            # Query text is escaped by the template: cache keys and URLs
+            # often come from user input. Only reformat_sql's output is
+            # HTML, so it would need mark_safe.
             # TODO: This was throwing an error
             # if needs_format:
-            #     val = reformat_sql(val)
+            #     val = mark_safe(reformat_sql(val))
             queries.append({
                 'sql': val,
                 'type': query_type,
                 'timing': timing,
+                'call_site': format_call_site(call_site),
+                'thread': thread,
             })
             metric_timing += timing['duration']
-        bars.append({
-            'name': metric_type,
-            'ms': metric_timing,
-        })
+            timing_by_query_type[query_type] = (
+                timing_by_query_type.get(query_type, 0.0) + timing['duration']
+            )
+        if metric_type == 'SQL' and len(timing_by_query_type) > 1:
+            # One bar per database alias
+            for alias in sorted(timing_by_query_type):
+                bars.append({
+                    'name': '%s (%s)' % (metric_type, alias),
+                    'ms': timing_by_query_type[alias],
+                })
+        else:
+            bars.append({
+                'name': metric_type,
+                'ms': metric_timing,
+            })
         total_query_time += metric_timing
 
     queries.sort(key=lambda x: x['timing']['start'])
@@ -198,6 +481,84 @@ def format_queries(input_queries, total_time, bars):
     return queries, total_query_time
 
 
+def format_call_site(call_site):
+    if not call_site:
+        return None
+    filepath, line, function = call_site
+    return {
+        'filepath': filepath,
+        'line': line,
+        'function': function,
+        'filepath_with_slashes': slasherize(filepath),
+    }
+
+
+def format_sql_fingerprints(fingerprints, request_start, n_plus_one_threshold):
+    """Turn per-fingerprint aggregates into rows, flagging N+1s and repeats."""
+    rows = []
+    for fingerprint_id, stats in fingerprints.items():
+        count = stats['count']
+        rows.append({
+            'id': fingerprint_id,
+            'sql': stats['sql'],
+            'count': count,
+            'total_ms': stats['total'] * 1000,
+            'mean_ms': stats['total'] * 1000 / count,
+            'max_ms': stats['max'] * 1000,
+            'first_ms': (stats['first'] - request_start) * 1000,
+            'last_ms': (stats['last'] - request_start) * 1000,
+            'duplicates': count - stats['distinct'],
+            'n_plus_one': stats['distinct'] >= n_plus_one_threshold,
+        })
+    rows.sort(key=lambda row: row['total_ms'], reverse=True)
+    return rows
+
+
+def format_slow_queries(explains):
+    slow_queries = [
+        dict(explain, id=fingerprint_id, ms=explain['time'] * 1000)
+        for fingerprint_id, explain in explains.items()
+    ]
+    slow_queries.sort(key=lambda row: row['ms'], reverse=True)
+    return slow_queries
+
+
+def format_gc(collections, request_start):
+    rows = []
+    for collection in collections:
+        rows.append(dict(
+            collection,
+            start_ms=(collection['timing']['start'] - request_start) * 1000,
+        ))
+    return rows, sum(row['timing']['duration'] for row in rows)
+
+
+def format_overhead(overhead, total_time):
+    rows = [
+        {
+            'component': component,
+            'ms': seconds * 1000,
+            'percent': seconds * 1000 / total_time * 100,
+        }
+        for component, seconds in overhead.items()
+    ]
+    rows.sort(key=lambda row: row['ms'], reverse=True)
+    return rows, sum(row['ms'] for row in rows)
+
+
+def format_loglines(loglines, request_start):
+    rows = []
+    for level, message, logger, created, thread in iter_loglines(loglines):
+        rows.append({
+            'level': level,
+            'message': message,
+            'logger': logger,
+            'thread': thread,
+            'ms': (created - request_start) * 1000 if created else None,
+        })
+    return rows
+
+
 def add_bars_to_items(items, unique_keyname):
     if not items:
         return
@@ -217,6 +578,109 @@ def add_bars_to_items(items, unique_keyname):
         item['color'] = hashlib.md5(smart_bytes(item[unique_keyname])).hexdigest()[:6]
 
 
+@ssl_required
+def tikibar_captured(request):
+    """Staff-only list of requests published by sampled or tail capture."""
+    if not tikibar_feature_flag_enabled(request):
+        raise Http404('Tikibar is turned off')
+    if not request.user or not request.user.is_staff:
+        raise Http404('Staff required')
+    captured = get_capture_index()
+    now = time.time()
+    for row in captured:
+        row['ago'] = now - row['t']
+        row['ms'] = row['d'] * 1000
+    return HttpResponse(render(request, 'tikibar/tikibar_captured.html', {
+        'captured': captured,
+    }))
+
+
+@ssl_required
+def tikibar_live(request):
+    """Staff-only list of the latest requests on this host, from the feed."""
+    if not tikibar_feature_flag_enabled(request):
+        raise Http404('Tikibar is turned off')
+    if not request.user or not request.user.is_staff:
+        raise Http404('Staff required')
+    path = settings.TIKIBAR_SETTINGS.get('live_feed_path')
+    records = []
+    if path:
+        records, last = read_feed(path, limit=TIKI_LIVE_FEED_ROWS)
+        records.reverse()
+    now = time.time()
+    for row in records:
+        row['ago'] = now - row['t']
+    return HttpResponse(render(request, 'tikibar/tikibar_live.html', {
+        'enabled': bool(path),
+        'requests': records,
+    }))
+
+
+@ssl_required
+def tikibar_aggregates(request):
+    """Staff-only latency percentiles and costs per view and release."""
+    if not tikibar_feature_flag_enabled(request):
+        raise Http404('Tikibar is turned off')
+    if not request.user or not request.user.is_staff:
+        raise Http404('Staff required')
+    windows = dict(TIKI_AGGREGATE_WINDOWS)
+    window = request.GET.get('window')
+    if window not in windows:
+        window = TIKI_AGGREGATE_WINDOWS[0][0]
+    # Include whatever this process hasn't flushed yet
+    aggregator.flush()
+    aggregates = load_aggregates(time.time() - windows[window])
+    return HttpResponse(render(request, 'tikibar/tikibar_aggregates.html', {
+        'windows': [name for name, seconds in TIKI_AGGREGATE_WINDOWS],
+        'window': window,
+        'rows': format_aggregates(aggregates),
+    }))
+
+
+def format_aggregates(aggregates):
+    rows = []
+    for (view, release), aggregate in aggregates.items():
+        total = aggregate.histograms['total_ms']
+        sql_count = aggregate.histograms['sql_count']
+        rows.append({
+            'view': view,
+            'release': release,
+            'count': aggregate.count,
+            'total_ms': total.total,
+            'p50_ms': total.percentile(50),
+            'p95_ms': total.percentile(95),
+            'p99_ms': total.percentile(99),
+            'sql_share': (aggregate.sql_share() or 0) * 100,
+            'sql_ms': aggregate.histograms['sql_ms'].mean(),
+            'sql_count': sql_count.mean(),
+            'sql_count_p95': sql_count.percentile(95),
+            'template_ms': aggregate.histograms['template_ms'].mean(),
+            'cpu_ms': aggregate.histograms['cpu_ms'].mean(),
+        })
+    # Where the time goes, across all requests
+    rows.sort(key=lambda row: row['total_ms'], reverse=True)
+    return rows
+
+
+@ssl_required
+def tikibar_regressions(request):
+    """Staff-only list of views that got slower, or chattier, in a release."""
+    if not tikibar_feature_flag_enabled(request):
+        raise Http404('Tikibar is turned off')
+    if not request.user or not request.user.is_staff:
+        raise Http404('Staff required')
+    aggregator.flush()
+    windows = dict(TIKI_AGGREGATE_WINDOWS)
+    window = request.GET.get('window')
+    if window not in windows:
+        window = TIKI_AGGREGATE_WINDOWS[-1][0]
+    return HttpResponse(render(request, 'tikibar/tikibar_regressions.html', {
+        'windows': [name for name, seconds in TIKI_AGGREGATE_WINDOWS],
+        'window': window,
+        'regressions': find_regressions(time.time() - windows[window]),
+    }))
+
+
 @ssl_required
 def tikibar_on(request):
 
@@ -0,0 +1,61 @@
+from .core import parse_cookies
+
+
+def _full_path(environ):
+    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+    if environ.get('QUERY_STRING'):
+        path += '?' + environ['QUERY_STRING']
+    return path
+
+
+class TikibarWSGIMiddleware:
+    """
+    Records requests to a WSGI application with the tikibar turned on,
+    using a tikibar.core.Recorder:
+
+        recorder = Recorder(storage, SignedCookieVerifier(SECRET_KEY))
+        app = TikibarWSGIMiddleware(app, recorder)
+
+    Other requests are passed straight through. Recorded responses are
+    buffered so the tikibar can be added to HTML pages.
+    """
+    def __init__(self, app, recorder):
+        self.app = app
+        self.recorder = recorder
+
+    def __call__(self, environ, start_response):
+        recording = self.recorder.start(
+            environ.get('REQUEST_METHOD', 'GET'),
+            environ.get('PATH_INFO', ''),
+            _full_path(environ),
+            parse_cookies(environ.get('HTTP_COOKIE', '')),
+            environ.get('wsgi.url_scheme') == 'https',
+        )
+        if recording is None:
+            return self.app(environ, start_response)
+
+        response = {}
+        chunks = []
+
+        def buffering_start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            response['exc_info'] = exc_info
+            return chunks.append
+
+        try:
+            result = self.app(environ, buffering_start_response)
+            try:
+                chunks.extend(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except BaseException:
+            recording.finish(500, [])
+            raise
+        status = response['status']
+        headers, body = recording.finish(
+            int(status.split(' ', 1)[0]), response['headers'], b''.join(chunks)
+        )
+        start_response(status, headers, response['exc_info'])
+        return [body]